@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from logger import logger
+from config import config_manager
+
+
+# config.py 中 API_KEY 的默认值，仍在使用时启动告警
+DEFAULT_MASTER_KEY = "sk-123456"
+
+
+def hash_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充量，capacity 为桶容量"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def charge(self, now, amount):
+        # 用量在请求结束后才知道，允许透支，余额恢复为正之前拒绝新请求
+        self.refill(now)
+        self.tokens -= amount
+
+
+USAGE_FIELDS = ("requests", "upstream_seconds", "stream_bytes", "prompt_tokens", "completion_tokens")
+
+
+class ApiKey:
+    __slots__ = ("name", "key_hash", "rpm", "tpm", "max_streams", "priority", "bucket", "token_bucket",
+                 "streams", "usage", "pending")
+
+    def __init__(self, name, key_hash, rpm=0, max_streams=0, priority=None, tpm=0):
+        self.name = name
+        self.key_hash = key_hash
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_streams = max_streams
+        self.priority = priority
+        self.bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.streams = 0
+        # usage 为累计值，pending 为尚未落盘的增量
+        self.usage = {name: 0 for name in USAGE_FIELDS}
+        self.pending = {name: 0 for name in USAGE_FIELDS}
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "hash": self.key_hash,
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "max_streams": self.max_streams,
+            "priority": self.priority
+        }
+
+
+class ApiKeyRegistry:
+    """多租户 API Key 注册表：只保存 sha256 哈希，限流与用量统计均为 O(1)"""
+
+    def __init__(self):
+        self.keys = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def set_master(self, master):
+        """应用主 API_KEY（不限流）；配置重新加载后旧的主 Key 立即失效"""
+        key_hash = hash_key(master) if master else None
+        with self._lock:
+            for old_hash in [h for h, key in self.keys.items() if key.name == "default" and h != key_hash]:
+                del self.keys[old_hash]
+            if key_hash and key_hash not in self.keys:
+                self.keys[key_hash] = ApiKey("default", key_hash)
+        if master == DEFAULT_MASTER_KEY:
+            logger.warning("主 API_KEY 仍为默认值，请通过 API_KEY 环境变量修改", "ApiKeys")
+
+    def load(self):
+        """加载主 API_KEY 以及 API_KEYS_FILE 中的租户 Key"""
+        self.set_master(config_manager.get("API.API_KEY"))
+
+        path = config_manager.get("API_KEYS.FILE")
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for item in json.load(f).get("keys", []):
+                        key = ApiKey(
+                            item["name"],
+                            item["hash"],
+                            int(item.get("rpm", 0)),
+                            int(item.get("max_streams", 0)),
+                            item.get("priority"),
+                            int(item.get("tpm", 0))
+                        )
+                        self.keys[key.key_hash] = key
+                logger.info(f"API Key 加载完成，共 {len(self.keys)} 个", "ApiKeys")
+            except Exception as error:
+                logger.error(f"加载 API Key 文件失败: {str(error)}", "ApiKeys")
+
+    def save(self):
+        path = config_manager.get("API_KEYS.FILE")
+        if not path:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._lock:
+            items = [key.to_dict() for key in self.keys.values() if key.name != "default"]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"keys": items}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def create(self, name, rpm=0, max_streams=0, priority=None, tpm=0):
+        """生成新 Key，明文只在此处返回一次"""
+        if name == "default":
+            raise ValueError("default 为主 API_KEY 保留的名称")
+        api_key = f"sk-{secrets.token_urlsafe(32)}"
+        key = ApiKey(name, hash_key(api_key), rpm, max_streams, priority, tpm)
+        with self._lock:
+            self.keys[key.key_hash] = key
+        self.save()
+        return api_key, key
+
+    def delete(self, name):
+        with self._lock:
+            removed = [h for h, key in self.keys.items() if key.name == name and name != "default"]
+            for key_hash in removed:
+                del self.keys[key_hash]
+        if removed:
+            self.save()
+        return bool(removed)
+
+    def authenticate(self, api_key):
+        # 以哈希查表，比较的是哈希而非明文，耗时与 Key 内容无关
+        if not api_key:
+            return None
+        return self.keys.get(hash_key(api_key))
+
+    def allow_request(self, key):
+        """按每分钟请求数和每分钟 token 数限流，通过时计入请求数"""
+        with self._lock:
+            now = time.monotonic()
+            if key.token_bucket is not None:
+                key.token_bucket.refill(now)
+                if key.token_bucket.tokens <= 0:
+                    return False
+            if key.bucket is not None and not key.bucket.take(now):
+                return False
+            key.usage["requests"] += 1
+            key.pending["requests"] += 1
+            return True
+
+    def acquire_stream(self, key):
+        with self._lock:
+            if key.max_streams and key.streams >= key.max_streams:
+                return False
+            key.streams += 1
+            return True
+
+    def release_stream(self, key):
+        with self._lock:
+            key.streams = max(0, key.streams - 1)
+
+    def record(self, key, **values):
+        with self._lock:
+            for name, value in values.items():
+                key.usage[name] = key.usage.get(name, 0) + value
+                key.pending[name] = key.pending.get(name, 0) + value
+
+    def record_tokens(self, key, usage):
+        """记录一次请求的 token 用量，并从该 Key 的每分钟 token 额度中扣除"""
+        with self._lock:
+            for name in ("prompt_tokens", "completion_tokens"):
+                key.usage[name] += usage[name]
+                key.pending[name] += usage[name]
+            if key.token_bucket is not None:
+                key.token_bucket.charge(time.monotonic(), usage["total_tokens"])
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {**key.to_dict(), "streams": key.streams, "usage": dict(key.usage)}
+                for key in self.keys.values()
+            ]
+
+    def flush(self):
+        """把内存中累积的用量增量批量追加到用量文件"""
+        path = config_manager.get("API_KEYS.USAGE_FILE")
+        now = int(time.time())
+        lines = []
+        with self._lock:
+            for key in self.keys.values():
+                if any(key.pending.values()):
+                    lines.append(json.dumps({"ts": now, "key": key.name, **key.pending}, ensure_ascii=False))
+                    key.pending = {name: 0 for name in key.pending}
+        if not lines or not path:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def start_flusher(self):
+        if self._flusher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(config_manager.get("API_KEYS.FLUSH_INTERVAL", 10))
+                try:
+                    self.flush()
+                except Exception as error:
+                    logger.error(f"用量落盘失败: {str(error)}", "ApiKeys")
+
+        self._flusher = threading.Thread(target=run, name="usage-flusher", daemon=True)
+        self._flusher.start()
+
+
+api_keys = ApiKeyRegistry()
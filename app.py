@@ -1,33 +1,208 @@
 import os
+import io
+import signal
+import csv
 import time
 import json
 import secrets
-from flask import Flask, request, Response, jsonify, render_template, redirect, session
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, Response, jsonify, render_template, redirect, session, stream_with_context, g, send_file
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import config_manager
 from logger import logger
 from token_manager import AuthTokenManager
 from request_handler import RequestHandler
+from message_processor import MessageProcessor
+from token_validator import TokenValidator
+from batch import BatchManager
+from metrics import metrics
+from api_keys import api_keys
+from lifecycle import lifecycle, Supervisor, LISTEN_FD_ENV
+from cluster import create_coordinator
+from image_cache import BLOB_NAME
+from profiler import profiler, collapsed, thread_snapshot
+from ingest import BodyTooLarge, loads, read_body, parse_chat_request
+from ws_gateway import WebSocketSession
+from dashboard import Dashboard
+from capture import recorder
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(16)
 app.json.sort_keys = False
+app.config['SOCK_SERVER_OPTIONS'] = {
+    'ping_interval': config_manager.get("WEBSOCKET.PING_INTERVAL", 25) or None,
+    'max_message_size': config_manager.get("REQUEST.MAX_BODY_BYTES", 0) or None
+}
+sock = Sock(app) if Sock is not None else None
 
 token_manager = AuthTokenManager()
 request_handler = RequestHandler(token_manager)
+token_validator = TokenValidator(request_handler)
+batch_manager = BatchManager(request_handler)
+dashboard = Dashboard(token_manager, request_handler.upstream)
+api_keys.load()
+
+# 需要 API Key 鉴权的路径前缀，以及其中无需鉴权的路径
+PROTECTED_PREFIXES = ('/v1/', '/get/tokens', '/add/token', '/delete/token')
+PUBLIC_PATHS = ('/v1/models',)
 
 
 def initialization():
+    # 先恢复上一个进程落盘的令牌状态，再合并环境变量中的令牌
+    token_manager.load_state()
     token_manager.load_from_env()
+    token_manager.start_state_saver()
+    token_manager.cluster = create_coordinator()
+    if token_manager.cluster is not None:
+        logger.info(f"已启用多节点协调: {token_manager.cluster.status()['store']}", "Server")
     
     if config_manager.get("API.PROXY"):
         logger.info(f"代理已设置: {config_manager.get('API.PROXY')}", "Server")
 
+    # 继续执行上次未完成的批处理任务
+    batch_manager.load_existing()
+
+    # 按固定间隔批量落盘各 API Key 的用量
+    api_keys.start_flusher()
+
+    # 上游连接池在后台预热，服务无需等待即可开始监听
+    request_handler.warm_up()
+
+    # 优雅退出时先暂停批处理任务并释放任务锁，由新工作进程从检查点接手，避免两个进程重复执行同一任务
+    lifecycle.on_drain(batch_manager.suspend_all)
+    lifecycle.on_shutdown(flush_state)
+
     logger.info("初始化完成", "Server")
 
 
+def flush_state():
+    """退出前落盘令牌状态、批处理进度、各 Key 用量与待写入的采样记录"""
+    token_manager.save_state()
+    for job in list(batch_manager.jobs.values()):
+        if job.status == "in_progress":
+            job.save_meta()
+    api_keys.flush()
+    recorder.close()
+    logger.info(f"退出时指标: {json.dumps(metrics.snapshot()['counters'], ensure_ascii=False)}", "Server")
+
+
+def reload_config():
+    """SIGHUP 或管理接口触发：整体替换配置快照并应用日志级别"""
+    config_manager.reload()
+    logger.set_level(config_manager.get_log_level())
+    api_keys.set_master(config_manager.get("API.API_KEY"))
+    logger.info("配置已重新加载", "Server")
+
+
+@app.before_request
+def track_lifecycle():
+    """优雅退出期间拒绝新的 API 请求；统计进行中的请求，流式响应在关闭时才计为结束"""
+    if not request.path.startswith('/v1/'):
+        return None
+    if lifecycle.is_draining():
+        response = jsonify({
+            "error": {
+                "message": "服务正在重启，请稍后重试",
+                "type": "service_unavailable"
+            }
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    lifecycle.begin()
+    g.lifecycle_tracked = True
+    return None
+
+
+@app.after_request
+def finish_lifecycle(response):
+    if g.pop('lifecycle_tracked', False):
+        response.call_on_close(lifecycle.end)
+    return response
+
+
+@app.after_request
+def report_context_trim(response):
+    trim = g.pop('context_trim', None)
+    if trim is not None:
+        response.headers['X-Context-Trimmed'] = trim.header()
+    return response
+
+
+@app.before_request
+def authenticate_request():
+    """统一的 API Key 鉴权与按 Key 限流"""
+    if not request.path.startswith(PROTECTED_PREFIXES) or request.path in PUBLIC_PATHS:
+        return None
+
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not auth_token:
+        return jsonify({"error": 'API_KEY缺失'}), 401
+
+    api_key = api_keys.authenticate(auth_token)
+    if api_key is None:
+        return jsonify({"error": 'Unauthorized'}), 401
+
+    if not api_keys.allow_request(api_key):
+        return jsonify({
+            "error": {
+                "message": "请求过于频繁，已超出该 API Key 的速率限制",
+                "type": "rate_limit_error"
+            }
+        }), 429
+
+    g.api_key = api_key
+    return None
+
+
+def resolve_priority(api_key):
+    """请求头 X-Priority 指定优先级，但不能高于该 API Key 配置的上限"""
+    classes = ["high", "normal", "low"]
+    requested = request.headers.get('X-Priority', '').lower() or config_manager.get("SCHEDULER.DEFAULT_PRIORITY", "normal")
+    if requested not in classes:
+        requested = "normal"
+
+    ceiling = api_key.priority
+    if ceiling in classes and classes.index(requested) < classes.index(ceiling):
+        return ceiling
+    return requested
+
+
+def resolve_affinity_key(data, api_key):
+    """按配置返回亲和路由的键：会话指纹（可由 X-Conversation-Id 指定）或 API Key"""
+    mode = config_manager.get("ROUTING.AFFINITY", "off")
+    if mode == "api_key":
+        return api_key.key_hash
+    if mode == "conversation":
+        return request.headers.get('X-Conversation-Id') or MessageProcessor.conversation_fingerprint(data.get("messages", []))
+    return None
+
+
+def track_usage(response, api_key, started):
+    """统计流式响应的输出字节数，并在响应关闭时记录上游耗时、释放流名额"""
+    sent = [0]
+    body = response.response
+
+    def counting():
+        for chunk in body:
+            sent[0] += len(chunk)
+            yield chunk
+
+    def finish():
+        api_keys.record(api_key, upstream_seconds=time.time() - started, stream_bytes=sent[0])
+        api_keys.release_stream(api_key)
+
+    response.response = counting()
+    response.call_on_close(finish)
+    return response
+
+
 @app.route('/manager/login', methods=['GET', 'POST'])
 def manager_login():
     return redirect('/manager')
@@ -81,6 +256,197 @@ def add_manager_token():
         return jsonify({"error": str(e)}), 500
 
 
+def parse_import_line(line, fmt, columns=None):
+    """解析导入文件中的一行，返回令牌字符串或 None"""
+    if fmt == 'ndjson':
+        item = json.loads(line)
+        if isinstance(item, dict):
+            return item.get('token') or item.get('cookie') or item.get('sso')
+        return item if isinstance(item, str) else None
+    if fmt == 'csv':
+        row = next(csv.reader([line]), [])
+        if columns is not None:
+            return row[columns] if len(row) > columns else None
+        return row[0] if row else None
+    return line
+
+
+@app.route('/manager/api/import', methods=['POST'])
+def import_manager_tokens():
+    """流式导入令牌，支持 NDJSON / CSV / 纯文本（每行一个），按批写入"""
+    try:
+        fmt = request.args.get('format')
+        if not fmt:
+            content_type = request.content_type or ''
+            fmt = 'ndjson' if 'ndjson' in content_type else 'csv' if 'csv' in content_type else 'text'
+        batch_size = config_manager.get("TOKENS.IMPORT_BATCH_SIZE", 1000)
+
+        totals = {"added": 0, "duplicates": 0, "failed": 0}
+        batch = []
+        column = None
+        first = True
+
+        def flush():
+            result = token_manager.add_tokens_batch(batch)
+            totals["added"] += result["success"]
+            totals["duplicates"] += result["duplicates"]
+            totals["failed"] += result["failed"]
+            batch.clear()
+
+        for raw in request.stream:
+            line = raw.decode('utf-8').strip()
+            if not line:
+                continue
+
+            # CSV 首行若为表头，则按 token/cookie/sso 列读取
+            if fmt == 'csv' and first:
+                first = False
+                header = [h.strip().lower() for h in next(csv.reader([line]), [])]
+                for name in ('token', 'cookie', 'sso'):
+                    if name in header:
+                        column = header.index(name)
+                        break
+                if column is not None:
+                    continue
+                column = 0
+
+            try:
+                token = parse_import_line(line, fmt, column)
+            except (ValueError, csv.Error):
+                token = None
+            if token:
+                batch.append(token.strip())
+            else:
+                totals["failed"] += 1
+
+            if len(batch) >= batch_size:
+                flush()
+
+        if batch:
+            flush()
+
+        return jsonify({"success": True, **totals, "total": len(token_manager.tokens)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/manager/api/export', methods=['GET'])
+def export_manager_tokens():
+    """流式导出令牌及状态，format 可选 ndjson（默认）或 csv"""
+    fmt = request.args.get('format', 'ndjson')
+    status = request.args.get('status')
+    query = request.args.get('q')
+    fields = ['sso', 'token', 'isValid', 'checked', 'lastChecked', 'error']
+
+    def generate():
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(fields)
+            for token_str, entry in token_manager.iter_token_status(status, query):
+                writer.writerow([entry['sso'], token_str, entry['isValid'], entry['checked'], entry['lastChecked'], entry['error'] or ''])
+                if buffer.tell() >= 65536:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            for token_str, entry in token_manager.iter_token_status(status, query):
+                yield json.dumps({**{k: entry[k] for k in fields if k != 'token'}, 'token': token_str}, ensure_ascii=False) + '\n'
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = f"tokens_{time.strftime('%Y%m%d_%H%M%S')}.{'csv' if fmt == 'csv' else 'ndjson'}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+@app.route('/manager/api/tokens', methods=['GET'])
+def list_manager_tokens():
+    """分页、可过滤的令牌状态列表"""
+    try:
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = min(max(1, request.args.get('limit', 100, type=int)), 1000)
+        status = request.args.get('status')
+        if status and status not in ('valid', 'invalid', 'unchecked'):
+            return jsonify({"error": "status must be one of valid, invalid, unchecked"}), 400
+        page = token_manager.list_tokens(offset, limit, status, request.args.get('q'))
+        # 游标对应这一页快照的版本，之后从 /manager/api/events 或 /manager/api/changes 只获取增量
+        page["cursor"] = dashboard.cursor(page["version"])
+        return jsonify(page)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/manager/api/changes', methods=['GET'])
+def get_token_changes():
+    """自 cursor 以来的令牌变更；reset 为 true 时需要重新获取 /manager/api/tokens 快照"""
+    try:
+        since = dashboard.parse_cursor(request.args.get('cursor'))
+        if since is None:
+            return jsonify({"reset": True, "cursor": dashboard.cursor(token_manager.version), "changes": []})
+        cursor, changes = dashboard.changes(since)
+        return jsonify({"reset": changes is None, "cursor": cursor, "changes": changes or []})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/manager/api/events', methods=['GET'])
+def stream_manager_events():
+    """管理页面的事件流：令牌增量、定时聚合指标；EventSource 重连时按 Last-Event-ID 续传"""
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    return Response(
+        dashboard.subscribe(cursor),
+        content_type='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route('/manager/api/validate', methods=['POST'])
+def start_token_validation():
+    """启动后台令牌校验任务，可指定 sso 列表，默认校验全部令牌"""
+    try:
+        data = request.get_json(silent=True) or {}
+        tokens = None
+        if data.get('tokens'):
+            tokens = []
+            for value in data['tokens']:
+                token = token_manager.sso_index.get(value) or (value if value in token_manager.token_info else None)
+                if token:
+                    tokens.append(token)
+
+        job = token_validator.start_job(
+            tokens=tokens,
+            concurrency=data.get('concurrency'),
+            model=data.get('model', 'grok-3'),
+            remove_invalid=bool(data.get('removeInvalid', False))
+        )
+        return jsonify(job.snapshot(limit=0))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/manager/api/validate/<job_id>', methods=['GET'])
+def get_token_validation(job_id):
+    job = token_validator.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    since = max(0, request.args.get('since', 0, type=int))
+    limit = min(max(0, request.args.get('limit', 1000, type=int)), 10000)
+    return jsonify(job.snapshot(since, limit))
+
+
+@app.route('/manager/api/validate/<job_id>/cancel', methods=['POST'])
+def cancel_token_validation(job_id):
+    job = token_validator.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    job.cancel()
+    return jsonify({"success": True})
+
+
 @app.route('/manager/api/delete', methods=['POST'])
 def delete_manager_token():
     try:
@@ -95,6 +461,169 @@ def delete_manager_token():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/manager/api/metrics', methods=['GET'])
+def get_manager_metrics():
+    return jsonify(metrics.snapshot())
+
+
+def require_master_key():
+    """Key 管理与诊断接口只允许主 API_KEY 调用，返回错误响应或 None"""
+    api_key = api_keys.authenticate(request.headers.get('Authorization', '').replace('Bearer ', ''))
+    if api_key is None or api_key.name != "default":
+        return jsonify({"error": 'Unauthorized'}), 401
+    return None
+
+
+@app.route('/manager/api/keys', methods=['GET'])
+def get_manager_keys():
+    denied = require_master_key()
+    if denied:
+        return denied
+    return jsonify(api_keys.snapshot())
+
+
+@app.route('/manager/api/keys', methods=['POST'])
+def create_manager_key():
+    """创建 API Key，明文只在响应中返回一次"""
+    denied = require_master_key()
+    if denied:
+        return denied
+    try:
+        data = request.get_json(silent=True) or {}
+        name = data.get('name')
+        if not name:
+            return jsonify({"error": "Key name is required"}), 400
+        api_key, key = api_keys.create(
+            name,
+            rpm=int(data.get('rpm', 0)),
+            max_streams=int(data.get('max_streams', 0)),
+            priority=data.get('priority'),
+            tpm=int(data.get('tpm', 0))
+        )
+        return jsonify({"success": True, "key": api_key, **key.to_dict()})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/manager/api/keys/delete', methods=['POST'])
+def delete_manager_key():
+    denied = require_master_key()
+    if denied:
+        return denied
+    name = (request.get_json(silent=True) or {}).get('name')
+    if not name:
+        return jsonify({"error": "Key name is required"}), 400
+    return jsonify({"success": api_keys.delete(name)})
+
+
+@app.route('/manager/api/scheduler', methods=['GET'])
+def get_manager_scheduler():
+    return jsonify(request_handler.scheduler.snapshot())
+
+
+@app.route('/manager/api/reload', methods=['POST'])
+def reload_manager_config():
+    """由主进程管理时替换工作进程（加载新代码与配置），否则在进程内重新加载配置"""
+    try:
+        if os.environ.get(LISTEN_FD_ENV) and config_manager.get("LIFECYCLE.WORKER_RELOAD", False):
+            os.kill(os.getppid(), signal.SIGHUP)
+            return jsonify({"success": True, "mode": "workers"})
+        reload_config()
+        return jsonify({"success": True, "mode": "config"})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/manager/api/streams', methods=['GET'])
+def get_manager_streams():
+    return jsonify(request_handler.upstream.stream_stats())
+
+
+@app.route('/manager/api/capture', methods=['GET'])
+def get_capture_status():
+    return jsonify(recorder.status())
+
+
+@app.route('/images/<name>', methods=['GET'])
+def get_generated_image(name):
+    """缓存的生成图片；文件名即内容摘要，支持 Range 与条件请求"""
+    if not BLOB_NAME.match(name):
+        return jsonify({"error": "Not Found"}), 404
+    path = request_handler.generated_images.cache.path(name)
+    if path is None:
+        return jsonify({"error": "Not Found"}), 404
+    response = send_file(path, conditional=True, etag=name.split('.')[0], max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/manager/api/images', methods=['GET'])
+def get_manager_images():
+    return jsonify(request_handler.generated_images.cache.stats())
+
+
+@app.route('/manager/api/profile', methods=['GET', 'POST'])
+def profile_manager():
+    """对所有线程采样 seconds 秒，默认返回折叠栈文本（format=json 返回结构化结果）"""
+    denied = require_master_key()
+    if denied:
+        return denied
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), config_manager.get("PROFILER.MAX_SECONDS", 60))
+        interval = max(float(request.args.get('interval', 0.01)), 0.001)
+        include_idle = request.args.get('idle', 'false').lower() == 'true'
+
+        result = profiler.profile(seconds, interval, include_idle)
+        if result is None:
+            return jsonify({"error": "已有采样任务在运行"}), 409
+        logger.info(
+            f"采样完成: {result['samples']} 个样本，开销 {result['overhead'] * 100:.2f}%", "Profiler"
+        )
+
+        if request.args.get('format', 'collapsed') == 'json':
+            stacks = result.pop("stacks")
+            limit = int(request.args.get('limit', 200))
+            result["stacks"] = [{"stack": stack, "count": count} for stack, count in stacks.most_common(limit)]
+            return jsonify(result)
+        return Response(collapsed(result["stacks"]), mimetype='text/plain')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/manager/api/introspect', methods=['GET'])
+def introspect_manager():
+    """当前各线程的执行位置、进行中的请求与上游流状态"""
+    denied = require_master_key()
+    if denied:
+        return denied
+    threads = thread_snapshot()
+    return jsonify({
+        "lifecycle": {"state": lifecycle.state, "active": lifecycle.active},
+        "profiling": profiler.is_running(),
+        "threads": {
+            "total": len(threads),
+            "busy": sum(1 for thread in threads if thread["state"] == "busy"),
+            "items": threads
+        },
+        "streams": request_handler.upstream.stream_stats(),
+        "scheduler": request_handler.scheduler.snapshot()
+    })
+
+
+@app.route('/manager/api/rate-limits', methods=['GET'])
+def get_manager_rate_limits():
+    return jsonify(token_manager.get_rate_limits())
+
+
+@app.route('/manager/api/cluster', methods=['GET'])
+def get_manager_cluster():
+    if token_manager.cluster is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **token_manager.cluster.status()})
+
+
 @app.route('/manager/api/log-level', methods=['GET'])
 def get_log_level():
     """获取当前日志级别"""
@@ -145,59 +674,67 @@ def test_manager_token():
         cookie = request.json.get('cookie')
         if not cookie:
             return jsonify({"error": "Cookie is required"}), 400
-        
-        # 构造测试请求数据
-        test_data = {
-            "model": "grok-3",
-            "messages": [{"role": "user", "content": "hi"}],
-            "stream": False
-        }
-        
-        # 临时设置token进行测试
-        original_tokens = token_manager.get_all_tokens()
-        token_manager.tokens = [cookie]  # 临时替换为测试cookie
-        token_manager.current_index = 0
-        token_manager.last_round_index = -1
-        
+
+        # 直接在指定cookie上发送探测请求，不替换全局令牌列表
         try:
-            # 发送测试请求
-            response = request_handler.make_grok_request(test_data, "grok-3", False)
-            
-            # 恢复原始tokens
-            token_manager.tokens = original_tokens
-            token_manager.current_index = 0 
-            token_manager.last_round_index = -1
-            
-            if response and isinstance(response, dict) and 'choices' in response:
-                return jsonify({"success": True, "message": "Cookie测试成功"})
-            else:
-                return jsonify({"success": False, "error": "响应格式异常"})
-                
+            result = request_handler.probe_token(token_manager.normalize_token(cookie), "grok-3")
         except Exception as test_error:
-            # 恢复原始tokens
-            token_manager.tokens = original_tokens
-            token_manager.current_index = 0
-            token_manager.last_round_index = -1
             return jsonify({"success": False, "error": str(test_error)})
-            
+
+        if result["success"]:
+            return jsonify({"success": True, "message": "Cookie测试成功", "latency_ms": result["latency_ms"]})
+        return jsonify({"success": False, "error": result["error"], "latency_ms": result["latency_ms"]})
+
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route('/manager/api/probe', methods=['POST'])
+def probe_manager_tokens():
+    """并发探测一组cookie，逐个返回结果及耗时"""
+    try:
+        data = request.get_json(silent=True) or {}
+        cookies = data.get('cookies') or []
+        if not cookies:
+            return jsonify({"error": "Cookies list is required"}), 400
+
+        model = data.get('model', 'grok-3')
+        max_concurrency = config_manager.get("VALIDATION.MAX_CONCURRENCY", 256)
+        concurrency = min(data.get('concurrency') or config_manager.get("VALIDATION.CONCURRENCY", 32), max_concurrency, len(cookies))
+
+        def probe(cookie):
+            started = time.perf_counter()
+            try:
+                result = request_handler.probe_token(token_manager.normalize_token(cookie), model)
+            except Exception as error:
+                result = {
+                    "success": False,
+                    "status_code": None,
+                    "error": str(error),
+                    "latency_ms": int((time.perf_counter() - started) * 1000)
+                }
+            return {"cookie": cookie, **result}
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(probe, cookies))
+
+        return jsonify({
+            "success": True,
+            "total": len(results),
+            "valid": sum(1 for r in results if r["success"]),
+            "results": results
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/get/tokens', methods=['GET'])
 def get_tokens():
-    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    if auth_token != config_manager.get("API.API_KEY"):
-        return jsonify({"error": 'Unauthorized'}), 401
     return jsonify(token_manager.get_token_status_map())
 
 
 @app.route('/add/token', methods=['POST'])
 def add_token():
-    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    if auth_token != config_manager.get("API.API_KEY"):
-        return jsonify({"error": 'Unauthorized'}), 401
-
     try:
         sso = request.json.get('sso')
         token_str = f"sso-rw={sso};sso={sso}"
@@ -210,10 +747,6 @@ def add_token():
 
 @app.route('/delete/token', methods=['POST'])
 def delete_token():
-    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    if auth_token != config_manager.get("API.API_KEY"):
-        return jsonify({"error": 'Unauthorized'}), 401
-
     try:
         sso = request.json.get('sso')
         token_str = f"sso-rw={sso};sso={sso}"
@@ -241,30 +774,56 @@ def get_models():
 
 
 @app.route('/v1/chat/completions', methods=['POST'])
-def chat_completions():
+@app.route('/v1/passthrough/chat/completions', methods=['POST'], defaults={'passthrough': True})
+def chat_completions(passthrough=False):
     response_status_code = 500
     
     try:
-        auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-        if auth_token:
-            if auth_token != config_manager.get("API.API_KEY"):
-                return jsonify({"error": 'Unauthorized'}), 401
-        else:
-            return jsonify({"error": 'API_KEY缺失'}), 401
-
-        data = request.json
-        model = data.get("model")
-        stream = data.get("stream", False)
-        
+        # 先按大小上限读取，再解析为校验过的 ChatRequest，格式错误的请求不会进入上游流程
         try:
-            request_handler.validate_request(data)
+            data = parse_chat_request(loads(read_body(request, config_manager.get("REQUEST.MAX_BODY_BYTES", 0))))
+        except BodyTooLarge as e:
+            return jsonify({"error": str(e)}), 413
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
+        model = data.model
+        stream = data.stream
 
         try:
-            response = request_handler.make_grok_request(data, model, stream)
+            api_key = g.api_key
+            priority = resolve_priority(api_key)
+            affinity_key = resolve_affinity_key(data, api_key)
+            started = time.time()
+
+            def on_usage(usage):
+                api_keys.record_tokens(api_key, usage)
+
+            if stream or passthrough:
+                if not api_keys.acquire_stream(api_key):
+                    return jsonify({
+                        "error": {
+                            "message": "并发流数量已达到该 API Key 的上限",
+                            "type": "rate_limit_error"
+                        }
+                    }), 429
+                try:
+                    # 透传模式直接转发上游原始 NDJSON 帧
+                    response = request_handler.make_grok_request(
+                        data, model, True, passthrough=passthrough, priority=priority, affinity_key=affinity_key,
+                        on_usage=on_usage
+                    )
+                except Exception:
+                    api_keys.release_stream(api_key)
+                    raise
+                return track_usage(response, api_key, started)
+
+            response = request_handler.make_grok_request(
+                data, model, stream, stream_body=config_manager.get("RESPONSE.STREAM_BODY", False), priority=priority,
+                affinity_key=affinity_key, on_usage=on_usage
+            )
+            api_keys.record(api_key, upstream_seconds=time.time() - started)
             
-            if stream:
+            if isinstance(response, Response):
                 return response
             else:
                 return jsonify(response)
@@ -289,6 +848,87 @@ def chat_completions():
         }), response_status_code
 
 
+def chat_websocket(ws):
+    """在一条连接上复用多个补全，帧格式见 WebSocketSession"""
+    api_key = g.api_key
+    WebSocketSession(ws, request_handler, api_key, resolve_priority(api_key), resolve_affinity_key).run()
+
+
+if sock is not None:
+    sock.route('/v1/ws')(chat_websocket)
+else:
+    @app.route('/v1/ws')
+    def chat_websocket_unavailable():
+        return jsonify({"error": "WebSocket 接口需要安装 flask-sock"}), 501
+
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    """请求体为 NDJSON，每行一个 {"custom_id", "body"} 或直接为聊天请求体"""
+    try:
+        job = batch_manager.create(request.stream)
+        return jsonify(job.to_dict())
+    except Exception as error:
+        logger.error(str(error), "Batch")
+        return jsonify({"error": str(error)}), 500
+
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    return jsonify({"object": "list", "data": [job.to_dict() for job in batch_manager.jobs.values()]})
+
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    job = batch_manager.get(batch_id)
+    if not job:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/v1/batches/<batch_id>/output', methods=['GET'])
+def get_batch_output(batch_id):
+    job = batch_manager.get(batch_id)
+    if not job or not os.path.exists(job.output_path):
+        return jsonify({"error": "Batch output not found"}), 404
+
+    def generate():
+        with open(job.output_path, "rb") as f:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    return
+                yield chunk
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/v1/batches/<batch_id>/<action>', methods=['POST'])
+def control_batch(batch_id, action):
+    job = batch_manager.get(batch_id)
+    if not job:
+        return jsonify({"error": "Batch not found"}), 404
+    if action == 'cancel':
+        job.cancel()
+    elif action == 'resume':
+        batch_manager.resume(batch_id)
+    else:
+        return jsonify({"error": f"Unknown action: {action}"}), 400
+    return jsonify(job.to_dict())
+
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    ready = request_handler.upstream.is_ready() and not token_manager.is_empty() and not lifecycle.is_draining()
+    return jsonify({
+        "ready": ready,
+        "state": lifecycle.state,
+        "active": lifecycle.active,
+        "tokens": len(token_manager.tokens),
+        "warmup": request_handler.upstream.warmup_status
+    }), 200 if ready else 503
+
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def catch_all(path):
@@ -296,10 +936,10 @@ def catch_all(path):
 
 
 if __name__ == '__main__':
-    initialization()
-    
-    app.run(
-        host='0.0.0.0',
-        port=config_manager.get("SERVER.PORT"),
-        debug=False
-    )
+    if config_manager.get("LIFECYCLE.WORKER_RELOAD", False) and not os.environ.get(LISTEN_FD_ENV):
+        # 主进程只负责监听 socket 和工作进程的替换
+        Supervisor('0.0.0.0', config_manager.get("SERVER.PORT")).run()
+    else:
+        initialization()
+
+        lifecycle.serve(app, '0.0.0.0', config_manager.get("SERVER.PORT"), reload_config)
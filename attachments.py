@@ -0,0 +1,282 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import ipaddress
+import json
+import socket
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+from logger import logger
+from config import config_manager
+from metrics import metrics
+
+
+MIME_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/gif": "gif",
+    "image/webp": "webp"
+}
+
+
+class AttachmentError(ValueError):
+    """图片本身无效或无法获取，换令牌重试也无济于事"""
+
+
+class UploadError(Exception):
+    """上游拒绝了附件上传，可换令牌重试"""
+
+
+def image_urls(messages):
+    """按出现顺序取出消息中所有 image_url 部分的地址"""
+    urls = []
+    for message in messages or []:
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [content]
+        for part in parts:
+            if not isinstance(part, dict) or part.get("type") != "image_url":
+                continue
+            image_url = part.get("image_url")
+            url = image_url.get("url") if isinstance(image_url, dict) else image_url
+            if url:
+                urls.append(url)
+    return urls
+
+
+class ImageRef:
+    """一张输入图片；内容只在需要上传时才解码或下载，同一请求的多次重试共享"""
+
+    __slots__ = ("url", "digest", "mime", "data")
+
+    def __init__(self, url):
+        self.url = url
+        self.digest = None
+        self.mime = None
+        self.data = None
+
+    @property
+    def is_remote(self):
+        return self.url.startswith(("http://", "https://"))
+
+    def decode(self):
+        """解析 data URL：data:image/png;base64,...."""
+        if not self.url.startswith("data:") or "," not in self.url:
+            raise AttachmentError("不支持的图片地址，仅支持 data URL 和 http(s) 地址")
+        header, payload = self.url[5:].split(",", 1)
+        if not header.endswith(";base64"):
+            raise AttachmentError("图片 data URL 必须使用 base64 编码")
+        try:
+            data = base64.b64decode(payload, validate=False)
+        except (binascii.Error, ValueError):
+            raise AttachmentError("图片 base64 内容无效")
+        self.set_content(data, header[:-7] or "image/png")
+
+    def set_content(self, data, mime):
+        max_bytes = config_manager.get("ATTACHMENTS.MAX_BYTES", 0)
+        if max_bytes and len(data) > max_bytes:
+            raise AttachmentError(f"图片大小超过 {max_bytes} 字节")
+        self.data = data
+        self.mime = mime.split(";")[0].strip().lower()
+        self.digest = hashlib.sha256(data).hexdigest()
+
+
+class AttachmentCache:
+    """(令牌 id, 内容摘要) -> 上游附件 id 的 LRU 缓存，另记录远程图片地址 -> 内容摘要"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _touch(self, table, key):
+        value = table.get(key)
+        if value is not None:
+            table.move_to_end(key)
+        return value
+
+    def _store(self, table, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        while len(table) > self.capacity:
+            table.popitem(last=False)
+
+    def get(self, token_id, digest):
+        with self._lock:
+            return self._touch(self.entries, (token_id, digest))
+
+    def put(self, token_id, digest, file_id):
+        with self._lock:
+            self._store(self.entries, (token_id, digest), file_id)
+
+    def url_digest(self, url):
+        with self._lock:
+            return self._touch(self.urls, url)
+
+    def remember_url(self, url, digest):
+        with self._lock:
+            self._store(self.urls, url, digest)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self.entries), "urls": len(self.urls), "capacity": self.capacity}
+
+
+def _host_allowed(host, address):
+    """主机名或解析到的地址在 ATTACHMENTS.ALLOWED_HOSTS 中时例外放行"""
+    for entry in config_manager.get("ATTACHMENTS.ALLOWED_HOSTS", []):
+        if entry == host:
+            return True
+        try:
+            if address in ipaddress.ip_network(entry, strict=False):
+                return True
+        except ValueError:
+            continue
+    return False
+
+
+async def check_remote_host(url):
+    """拒绝解析到回环、内网、链路本地等非公网地址的图片地址，避免借图片下载访问内部服务
+
+    返回 curl RESOLVE 条目 "host:port:address"，下载时固定连接到检查过的地址，
+    避免检查后再次解析得到另一个地址（DNS rebinding）。
+    """
+    parsed = urlparse(url)
+    host = parsed.hostname
+    if not host:
+        raise AttachmentError("图片地址缺少主机名")
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        raise AttachmentError("图片地址端口无效")
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        raise AttachmentError(f"无法解析图片地址的主机: {host}")
+    if not infos:
+        raise AttachmentError(f"无法解析图片地址的主机: {host}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global and not _host_allowed(host.lower(), address):
+            raise AttachmentError("不允许下载内网或本机地址的图片")
+    address = infos[0][4][0].split("%")[0]
+    return f"{host}:{port}:{f'[{address}]' if ':' in address else address}"
+
+
+def encode_upload(ref):
+    extension = MIME_EXTENSIONS.get(ref.mime, "png")
+    return json.dumps({
+        "fileName": f"{ref.digest[:16]}.{extension}",
+        "fileMimeType": ref.mime,
+        "content": base64.b64encode(ref.data).decode("ascii")
+    })
+
+
+class AttachmentUploader:
+    """把请求中的图片上传为上游附件
+
+    同一令牌下内容相同的图片只上传一次：多轮对话中重复出现的截图直接复用缓存的附件 id。
+    下载和上传在上游事件循环中并发执行，并发数不超过 ATTACHMENTS.MAX_PARALLEL；
+    base64 解码、摘要和请求体编码在线程池中执行，不阻塞共享的事件循环。
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.cache = AttachmentCache(config_manager.get("ATTACHMENTS.CACHE_SIZE", 4096))
+        # 正在上传的 (令牌 id, 摘要) -> Future，同一请求或并发请求中的相同图片共享一次上传；只在事件循环线程中访问
+        self._pending = {}
+
+    def start(self, token_id, refs, headers, request_options):
+        """开始解析并上传图片，返回 concurrent.futures.Future，结果为附件 id 列表"""
+        return self.upstream.submit(self._resolve_all(token_id, refs, headers, request_options))
+
+    async def _resolve_all(self, token_id, refs, headers, request_options):
+        semaphore = asyncio.Semaphore(max(1, config_manager.get("ATTACHMENTS.MAX_PARALLEL", 4)))
+        return list(await asyncio.gather(
+            *(self._resolve(token_id, ref, headers, request_options, semaphore) for ref in refs)
+        ))
+
+    async def _resolve(self, token_id, ref, headers, request_options, semaphore):
+        digest = ref.digest or (self.cache.url_digest(ref.url) if ref.is_remote else None)
+        if digest:
+            file_id = self.cache.get(token_id, digest)
+            if file_id:
+                metrics.incr("attachment_cache_hits")
+                return file_id
+
+        async with semaphore:
+            if ref.data is None:
+                if ref.is_remote:
+                    await self._download(ref, request_options)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(None, ref.decode)
+            file_id = self.cache.get(token_id, ref.digest)
+            if file_id:
+                metrics.incr("attachment_cache_hits")
+                return file_id
+
+            key = (token_id, ref.digest)
+            pending = self._pending.get(key)
+            if pending is not None:
+                return await asyncio.shield(pending)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            try:
+                file_id = await self._upload(ref, headers, request_options)
+                self.cache.put(token_id, ref.digest, file_id)
+                future.set_result(file_id)
+                return file_id
+            except Exception as error:
+                future.set_exception(error)
+                # 没有其他等待者时避免 "exception was never retrieved" 警告
+                future.exception()
+                raise
+            finally:
+                self._pending.pop(key, None)
+
+    async def _download(self, ref, request_options):
+        if not config_manager.get("ATTACHMENTS.ALLOW_REMOTE", False):
+            raise AttachmentError("未开启远程图片下载，请使用 base64 data URL")
+        resolve = await check_remote_host(ref.url)
+        try:
+            # 不跟随重定向：重定向目标未经过主机检查
+            status_code, headers, body = await self.upstream.fetch(
+                "GET", ref.url,
+                max_bytes=config_manager.get("ATTACHMENTS.MAX_BYTES", 0),
+                resolve=resolve,
+                timeout=config_manager.get("ATTACHMENTS.FETCH_TIMEOUT", 15),
+                allow_redirects=False,
+                **request_options
+            )
+        except ValueError:
+            raise AttachmentError(f"图片大小超过 {config_manager.get('ATTACHMENTS.MAX_BYTES', 0)} 字节")
+        except Exception as error:
+            raise AttachmentError(f"图片下载失败: {str(error)[:100]}")
+        if status_code != 200:
+            raise AttachmentError(f"图片下载失败，状态码 {status_code}")
+        await asyncio.get_running_loop().run_in_executor(
+            None, ref.set_content, body, headers.get("content-type") or "image/png"
+        )
+        self.cache.remember_url(ref.url, ref.digest)
+        metrics.incr("attachment_downloads")
+
+    async def _upload(self, ref, headers, request_options):
+        data = await asyncio.get_running_loop().run_in_executor(None, encode_upload, ref)
+        status_code, _, body = await self.upstream.fetch(
+            "POST", f"{config_manager.get('API.BASE_URL')}/rest/app-chat/upload-file",
+            headers={**headers, "Content-Type": "application/json"},
+            data=data,
+            impersonate="chrome133a",
+            timeout=config_manager.get("ATTACHMENTS.FETCH_TIMEOUT", 15),
+            **request_options
+        )
+        if status_code != 200:
+            raise UploadError(f"图片上传失败，状态码 {status_code}")
+        file_id = json.loads(body or b"{}").get("fileMetadataId")
+        if not file_id:
+            raise UploadError("图片上传失败，响应中没有附件 id")
+        metrics.incr("attachment_uploads")
+        logger.info(f"图片上传成功: {ref.digest[:16]} -> {file_id}", "Attachments")
+        return file_id
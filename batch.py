@@ -0,0 +1,338 @@
+import json
+import os
+import threading
+import time
+import uuid
+from logger import logger
+from config import config_manager
+from ingest import parse_chat_request
+from request_handler import RetryableError
+from scheduler import QueueTimeout
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class BatchJob:
+    """本地批处理任务：输入/输出均为 NDJSON，输出文件同时作为断点续跑的检查点"""
+
+    def __init__(self, manager, batch_id, meta=None):
+        self.manager = manager
+        self.id = batch_id
+        self.directory = os.path.join(manager.directory, batch_id)
+        self.input_path = os.path.join(self.directory, "input.ndjson")
+        self.output_path = os.path.join(self.directory, "output.ndjson")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.lock_path = os.path.join(self.directory, "lock")
+
+        meta = meta or {}
+        self.status = meta.get("status", "validating")
+        self.created_at = meta.get("created_at", int(time.time()))
+        self.completed_at = meta.get("completed_at")
+        self.total = meta.get("total", 0)
+        self.completed = 0
+        self.failed = 0
+        # 重试后仍暂时失败、未写入检查点的行数，续跑时重新执行
+        self.deferred = 0
+
+        self._done_lines = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reader = None
+        self._line_no = 0
+        self._output = None
+        self._workers = []
+        # 持有任务锁文件期间只有本进程执行该任务；滚动发布时新旧工作进程据此交接
+        self._lock_file = None
+        self._suspended = False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": self.status,
+            "created_at": self.created_at,
+            "completed_at": self.completed_at,
+            "request_counts": {
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed
+            }
+        }
+
+    def save_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _load_checkpoint(self):
+        """读取已有输出，恢复已完成的行号；截掉崩溃时写了一半的末行"""
+        self.completed = 0
+        self.failed = 0
+        self.deferred = 0
+        self._done_lines = set()
+        if not os.path.exists(self.output_path):
+            return
+
+        good_offset = 0
+        with open(self.output_path, "rb") as f:
+            for raw in f:
+                try:
+                    record = json.loads(raw)
+                except ValueError:
+                    break
+                if not raw.endswith(b"\n"):
+                    break
+                good_offset += len(raw)
+                self._done_lines.add(record["line"])
+                if record.get("error"):
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+        if good_offset != os.path.getsize(self.output_path):
+            with open(self.output_path, "r+b") as f:
+                f.truncate(good_offset)
+
+    def _try_lock(self):
+        """以非阻塞方式获取任务锁文件，其他进程（如正在退出的旧工作进程）仍在执行时返回 False"""
+        if fcntl is None:
+            return True
+        lock_file = open(self.lock_path, "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _unlock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def start(self):
+        self._stop.clear()
+        self._suspended = False
+        if self._lock_file is None and not self._try_lock():
+            logger.info(f"批处理任务 {self.id} 正由其他进程执行，等待其释放后继续", "Batch")
+            threading.Thread(target=self._wait_lock, name=f"batch-{self.id}-lock", daemon=True).start()
+            return
+        self._run()
+
+    def _wait_lock(self):
+        while not self._stop.wait(config_manager.get("BATCH.LOCK_RETRY", 1)):
+            if self._try_lock():
+                self._run()
+                return
+        if not self._suspended:
+            self.status = "cancelled"
+
+    def _run(self):
+        self._load_checkpoint()
+        self._reader = open(self.input_path, "rb")
+        self._line_no = 0
+        self._output = open(self.output_path, "ab")
+        self.status = "in_progress"
+        self.save_meta()
+
+        workers = max(1, config_manager.get("BATCH.WORKERS", 32))
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"batch-{self.id}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+        threading.Thread(target=self._wait, name=f"batch-{self.id}", daemon=True).start()
+        logger.info(f"批处理任务 {self.id} 开始执行，已完成 {len(self._done_lines)}/{self.total}", "Batch")
+
+    def cancel(self):
+        self._stop.set()
+
+    def suspend(self):
+        """停止领取新行，进行中的行完成后释放任务锁；状态保持 in_progress，由下一个进程从检查点继续"""
+        self._suspended = True
+        self._stop.set()
+
+    def _next_item(self):
+        with self._lock:
+            while not self._stop.is_set():
+                raw = self._reader.readline()
+                if not raw:
+                    return None
+                line_no = self._line_no
+                self._line_no += 1
+                if raw.strip() and line_no not in self._done_lines:
+                    return line_no, raw
+            return None
+
+    def _execute(self, line_no, raw):
+        """执行一行，返回 (输出记录, 是否为可重试的暂时性失败)"""
+        custom_id = f"line-{line_no}"
+        try:
+            item = json.loads(raw)
+            custom_id = item.get("custom_id") or custom_id
+            body = dict(item.get("body", item))
+            body["stream"] = False
+            data = parse_chat_request(body)
+
+            result = self.manager.request_handler.make_grok_request(
+                data,
+                data.model,
+                False,
+                max_inflight=config_manager.get("BATCH.PER_TOKEN_CONCURRENCY", 2),
+                healthy_only=True,
+                acquire_timeout=config_manager.get("BATCH.ACQUIRE_TIMEOUT", 300),
+                priority=config_manager.get("BATCH.PRIORITY", "low")
+            )
+            if not result:
+                raise RetryableError("所有令牌均不可用或已被限流")
+            return {
+                "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                "custom_id": custom_id,
+                "line": line_no,
+                "response": {"status_code": 200, "body": result},
+                "error": None
+            }, False
+        except Exception as error:
+            return {
+                "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                "custom_id": custom_id,
+                "line": line_no,
+                "response": None,
+                "error": {"message": str(error)}
+            }, isinstance(error, (RetryableError, QueueTimeout))
+
+    def _attempt(self, line_no, raw):
+        """执行一行；暂时性失败按指数退避重试，仍然失败时返回 None，不写入检查点，留给续跑重新执行"""
+        retries = config_manager.get("BATCH.MAX_RETRIES", 3)
+        attempt = 0
+        while True:
+            # 全局并发名额在所有批处理任务之间共享，退避等待期间不占用
+            with self.manager.slots:
+                record, retryable = self._execute(line_no, raw)
+            if not retryable:
+                return record
+            if attempt >= retries or self._stop.wait(config_manager.get("BATCH.RETRY_DELAY", 5) * 2 ** attempt):
+                with self._lock:
+                    self.deferred += 1
+                logger.warning(f"批处理任务 {self.id} 第 {line_no} 行暂时失败，留待续跑: {record['error']['message']}", "Batch")
+                return None
+            attempt += 1
+
+    def _worker(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                return
+
+            record = self._attempt(*item)
+            if record is None:
+                continue
+
+            data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            with self._lock:
+                self._output.write(data)
+                self._output.flush()
+                self._done_lines.add(record["line"])
+                if record["error"]:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                if (self.completed + self.failed) % config_manager.get("BATCH.CHECKPOINT_EVERY", 100) == 0:
+                    self.save_meta()
+
+    def _wait(self):
+        for worker in self._workers:
+            worker.join()
+        self._reader.close()
+        self._output.close()
+
+        if self._suspended:
+            self.save_meta()
+            self._unlock()
+            logger.info(f"批处理任务 {self.id} 已暂停，已完成 {self.completed + self.failed}/{self.total}", "Batch")
+            return
+        if self._stop.is_set():
+            self.status = "cancelled"
+        elif self.deferred:
+            # 有行未能完成，状态不是 completed，可通过 resume 继续
+            self.status = "failed"
+        else:
+            self.status = "completed"
+            self.completed_at = int(time.time())
+        self.save_meta()
+        self._unlock()
+        logger.info(
+            f"批处理任务 {self.id} 结束: 成功 {self.completed} 个，失败 {self.failed} 个，待重试 {self.deferred} 个", "Batch"
+        )
+
+
+class BatchManager:
+    def __init__(self, request_handler):
+        self.request_handler = request_handler
+        self.directory = config_manager.get("BATCH.DIR")
+        self.slots = threading.BoundedSemaphore(config_manager.get("BATCH.CONCURRENCY", 64))
+        self.jobs = {}
+
+    def create(self, stream):
+        """从请求体流式写入输入文件并启动任务"""
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        job = BatchJob(self, batch_id)
+        os.makedirs(job.directory, exist_ok=True)
+
+        total = 0
+        with open(job.input_path, "wb") as f:
+            for raw in stream:
+                f.write(raw)
+                if raw.strip():
+                    total += 1
+        job.total = total
+
+        self.jobs[batch_id] = job
+        job.start()
+        return job
+
+    def get(self, batch_id):
+        return self.jobs.get(batch_id)
+
+    def resume(self, batch_id):
+        job = self.jobs.get(batch_id)
+        if job is None or job.status == "in_progress":
+            return job
+        if job.status != "completed":
+            job.start()
+        return job
+
+    def suspend_all(self):
+        """优雅退出开始时暂停所有执行中的任务，让新工作进程尽快接手"""
+        for job in list(self.jobs.values()):
+            if job.status == "in_progress":
+                job.suspend()
+
+    def load_existing(self):
+        """启动时加载磁盘上的任务，未完成的任务从检查点继续执行"""
+        if not os.path.isdir(self.directory):
+            return
+
+        for batch_id in os.listdir(self.directory):
+            meta_path = os.path.join(self.directory, batch_id, "meta.json")
+            if not os.path.exists(meta_path):
+                continue
+            try:
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+                meta["total"] = meta.get("request_counts", {}).get("total", 0)
+                job = BatchJob(self, batch_id, meta)
+                self.jobs[batch_id] = job
+                if job.status == "in_progress":
+                    job.start()
+                else:
+                    job._load_checkpoint()
+            except Exception as error:
+                logger.error(f"加载批处理任务 {batch_id} 失败: {str(error)}", "Batch")
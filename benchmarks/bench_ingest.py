@@ -0,0 +1,63 @@
+"""请求体解析基准：对比 Flask request.json 的解析方式（解码为 str 后用标准库解析）与 ingest
+
+用法: python benchmarks/bench_ingest.py [--messages 400] [--image-kb 2048] [--rounds 20]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_body(messages, image_kb):
+    image = "data:image/png;base64," + base64.b64encode(os.urandom(image_kb * 1024)).decode("ascii")
+    history = []
+    for i in range(messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        history.append({"role": role, "content": f"第 {i} 轮：" + "some agent transcript text " * 40})
+    history.append({"role": "user", "content": [
+        {"type": "text", "text": "看看这张截图"},
+        {"type": "image_url", "image_url": {"url": image}}
+    ]})
+    return json.dumps({"model": "grok-3", "stream": True, "messages": history}).encode("utf-8")
+
+
+def measure(name, parse, body, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        parse(body)
+    elapsed = (time.perf_counter() - started) / rounds
+
+    tracemalloc.start()
+    parse(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10}: {elapsed * 1000:8.2f}ms/request  peak {peak / 1024 / 1024:8.2f}MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--image-kb", type=int, default=2048)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    import ingest
+    from config import config_manager
+
+    body = make_body(args.messages, args.image_kb)
+    print(f"body: {len(body) / 1024 / 1024:.2f}MiB, backend: {'orjson' if ingest.orjson else 'json'}")
+
+    measure("stdlib", lambda data: json.loads(data.decode("utf-8")), body, args.rounds)
+    measure("ingest", lambda data: ingest.parse_chat_request(ingest.loads(data)), body, args.rounds)
+    config_manager.set("ATTACHMENTS.ENABLED", False)
+    measure("no-images", lambda data: ingest.parse_chat_request(ingest.loads(data)), body, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""冷启动基准：测量导入 app 的耗时以及批量加载令牌的耗时
+
+用法: python benchmarks/bench_startup.py [--runs 5] [--tokens 50000]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import sys, time
+t = time.perf_counter()
+import app
+elapsed = time.perf_counter() - t
+heavy = [m for m in ("curl_cffi", "loguru", "sqlalchemy") if m in sys.modules]
+print(f"{elapsed * 1000:.1f} {','.join(heavy) or '-'}")
+"""
+
+
+def bench_import(runs):
+    timings = []
+    heavy = "-"
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.split()
+        timings.append(float(output[0]))
+        heavy = output[1]
+    print(f"import app: median {statistics.median(timings):.1f}ms, min {min(timings):.1f}ms ({runs} runs)")
+    print(f"heavy modules loaded at import: {heavy}")
+
+
+def bench_tokens(count):
+    sys.path.insert(0, ROOT)
+    from token_manager import AuthTokenManager
+
+    os.environ["TOK_E"] = ",".join(f"token{i}" for i in range(count))
+    manager = AuthTokenManager()
+    t = time.perf_counter()
+    manager.load_from_env()
+    print(f"load_from_env ({count} tokens): {(time.perf_counter() - t) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=50000)
+    args = parser.parse_args()
+
+    bench_import(args.runs)
+    bench_tokens(args.tokens)
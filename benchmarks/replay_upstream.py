@@ -0,0 +1,88 @@
+"""用采样文件回放上游：按记录顺序为每次会话请求返回当时的状态码和原始 NDJSON 帧
+
+用法: python benchmarks/replay_upstream.py data/capture/capture-*.ndjson.zst [--port 5300] [--speed 1.0] [--loop]
+再以 UPSTREAM_BASE_URL=http://127.0.0.1:5300 启动代理（即 API.BASE_URL）。--speed 0 表示不等待，按最快速度发送帧。
+"""
+import argparse
+import itertools
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONVERSATION_PATH = "/rest/app-chat/conversations/new"
+
+
+def load_attempts(paths):
+    """展开为 (状态码, 帧列表) 序列；一条记录中的多次上游请求（重试、续写）按发生顺序排列"""
+    sys.path.insert(0, ROOT)
+    from capture import read_records
+
+    attempts = []
+    for path in paths:
+        for record in read_records(path):
+            for attempt in record.get("attempts", []):
+                attempts.append((attempt["status"], attempt["frames"]))
+    return attempts
+
+
+def make_handler(attempts, speed, loop):
+    source = itertools.cycle(attempts) if loop else iter(attempts)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path != CONVERSATION_PATH:
+                self.send_error(404)
+                return
+            with lock:
+                attempt = next(source, None)
+            if attempt is None:
+                self.send_error(410, "captured traffic exhausted")
+                return
+
+            status, frames = attempt
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            started = time.perf_counter()
+            first = frames[0][0] if frames else 0
+            for offset, line in frames:
+                if speed:
+                    delay = (offset - first) / 1000 / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                data = line.encode("utf-8") + b"\n"
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--port", type=int, default=5300)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--loop", action="store_true")
+    args = parser.parse_args()
+
+    attempts = load_attempts(args.files)
+    print(f"loaded {len(attempts)} upstream responses from {len(args.files)} files")
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(attempts, args.speed, args.loop))
+    print(f"replaying on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
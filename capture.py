@@ -0,0 +1,305 @@
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from logger import logger
+from config import config_manager
+from metrics import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# 记录中不保存的响应头；令牌本身只以 token_id（哈希）出现
+REDACT_HEADERS = ("cookie", "set-cookie", "authorization", "x-statsig-id")
+REDACTED = "[redacted]"
+CAPTURE_PREFIX = "capture-"
+
+
+def redact_headers(headers):
+    return {
+        key: REDACTED if key.lower() in REDACT_HEADERS else value
+        for key, value in (headers or {}).items()
+    }
+
+
+def _dumps(record):
+    if orjson is not None:
+        return orjson.dumps(record, default=str) + b"\n"
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+
+class Capture:
+    """单个被采样请求的记录：发给上游的请求体、每次上游响应的原始 NDJSON 帧、发给客户端的输出
+
+    帧和输出都带相对请求开始的毫秒偏移，回放时可按原节奏发送。记录在 finish 时交给写入线程，
+    请求线程只做列表追加。
+    """
+
+    __slots__ = ("recorder", "started", "record", "items", "finished")
+
+    def __init__(self, recorder, model, stream):
+        self.recorder = recorder
+        self.started = time.perf_counter()
+        self.items = 0
+        self.finished = False
+        self.record = {
+            "v": 1,
+            "id": uuid.uuid4().hex,
+            "time": round(time.time(), 3),
+            "model": model,
+            "stream": stream,
+            "payload": None,
+            "attempts": [],
+            "output": []
+        }
+
+    def offset(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def _room(self):
+        # 单条记录的帧和输出总数有上限，超出的部分只标记截断
+        self.items += 1
+        if self.items > config_manager.get("CAPTURE.MAX_ITEMS", 20000):
+            self.record["truncated"] = True
+            return False
+        return True
+
+    def payload(self, payload):
+        if self.record["payload"] is None:
+            self.record["payload"] = payload
+
+    def upstream(self, response, token_id):
+        """记录一次上游响应，并在其逐块读取时按行记录原始帧"""
+        frames = []
+        # 同一响应可能分多次读取（透传先读首帧再转发其余部分），跨块的半行在多次读取之间保留
+        pending = b""
+        self.record["attempts"].append({
+            "at": self.offset(),
+            "status": response.status_code,
+            "token": token_id,
+            "headers": redact_headers(response.headers),
+            "frames": frames
+        })
+
+        def frame(line):
+            if self._room():
+                frames.append([self.offset(), line.decode("utf-8", "replace")])
+
+        def tap(chunks):
+            nonlocal pending
+            for chunk in chunks:
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    frame(line)
+                yield chunk
+            if pending:
+                frame(pending)
+                pending = b""
+
+        response.tap = tap
+
+    def output(self, item):
+        if not self._room():
+            return
+        if isinstance(item, bytes):
+            item = item.decode("utf-8", "replace")
+        self.record["output"].append([self.offset(), item])
+
+    def wrap(self, iterable):
+        """转发输出的同时记录，输出结束或客户端断开时提交记录"""
+        try:
+            for item in iterable:
+                self.output(item)
+                yield item
+        finally:
+            self.finish()
+
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.record["duration_ms"] = self.offset()
+        if error is not None:
+            self.record["error"] = error
+        self.recorder.submit(self.record)
+
+
+class CaptureRecorder:
+    """按 CAPTURE.SAMPLE_RATE 采样请求，由后台线程从有界队列取出记录，写入压缩的 NDJSON 文件
+
+    文件超过 CAPTURE.MAX_FILE_BYTES 时轮转，只保留最新的 CAPTURE.MAX_FILES 个。每次刷新都结束当前的
+    压缩帧（zstd 帧或 gzip member），正在写入的文件也能被完整读取。队列满时丢弃记录，不阻塞请求线程。
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._raw = None
+        self._writer = None
+        self._path = None
+        self._file_seq = 0
+
+    def start(self, model, stream):
+        """按采样率决定是否记录该请求，未采样时返回 None"""
+        rate = config_manager.get("CAPTURE.SAMPLE_RATE", 0)
+        if rate <= 0 or random.random() >= rate:
+            return None
+        metrics.incr("capture_sampled")
+        return Capture(self, model, stream)
+
+    def submit(self, record):
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.Queue(maxsize=config_manager.get("CAPTURE.QUEUE_SIZE", 1000))
+                self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr("capture_dropped")
+
+    def compression(self):
+        if config_manager.get("CAPTURE.COMPRESSION", "zstd") == "zstd" and zstandard is not None:
+            return "zst"
+        return "gz"
+
+    def _open(self):
+        directory = config_manager.get("CAPTURE.DIR", "data/capture")
+        os.makedirs(directory, exist_ok=True)
+        self._file_seq += 1
+        name = f"{CAPTURE_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._file_seq}.ndjson.{self.compression()}"
+        self._path = os.path.join(directory, name)
+        self._raw = open(self._path, "ab")
+        self._prune(directory)
+        logger.info(f"开始写入采样文件: {self._path}", "Capture")
+
+    def _prune(self, directory):
+        keep = config_manager.get("CAPTURE.MAX_FILES", 20)
+        files = sorted(
+            (os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(CAPTURE_PREFIX)),
+            key=os.path.getmtime
+        )
+        for path in files[:max(0, len(files) - keep)]:
+            if path != self._path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _write(self, record):
+        if self._raw is None:
+            self._open()
+        if self._writer is None:
+            if self.compression() == "zst":
+                self._writer = zstandard.ZstdCompressor(level=3).stream_writer(self._raw, closefd=False)
+            else:
+                self._writer = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        self._writer.write(_dumps(record))
+        metrics.incr("capture_records")
+
+    def _flush(self):
+        """结束当前压缩帧并写入磁盘，文件超过大小上限时轮转"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._raw is None:
+            return
+        self._raw.flush()
+        if self._raw.tell() >= config_manager.get("CAPTURE.MAX_FILE_BYTES", 64 * 1024 * 1024):
+            self._raw.close()
+            self._raw = None
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self._queue.get(timeout=config_manager.get("CAPTURE.FLUSH_INTERVAL", 1))
+            except queue.Empty:
+                record = False
+            try:
+                if record is None:
+                    self._flush()
+                    if self._raw is not None:
+                        self._raw.close()
+                        self._raw = None
+                    return
+                if record:
+                    self._write(record)
+                # 空闲或距上次刷新超过间隔时结束当前压缩帧，避免每条记录一个小帧降低压缩率
+                if self._writer is not None and (
+                    record is False or time.monotonic() - last_flush >= config_manager.get("CAPTURE.FLUSH_INTERVAL", 1)
+                ):
+                    self._flush()
+                    last_flush = time.monotonic()
+            except Exception as error:
+                metrics.incr("capture_errors")
+                logger.error(f"采样记录写入失败: {str(error)}", "Capture")
+                self._writer = None
+                if self._raw is not None:
+                    try:
+                        self._raw.close()
+                    except OSError:
+                        pass
+                self._raw = None
+
+    def close(self, timeout=5):
+        """写完队列中的记录并结束当前文件"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def status(self):
+        return {
+            "sample_rate": config_manager.get("CAPTURE.SAMPLE_RATE", 0),
+            "compression": self.compression(),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "file": self._path
+        }
+
+
+def read_records(path):
+    """逐条读取采样文件（.zst 或 .gz），正在写入的文件读到最后一个完整的压缩帧为止"""
+    with open(path, "rb") as raw:
+        if path.endswith(".zst"):
+            if zstandard is None:
+                raise ValueError("读取 .zst 采样文件需要安装 zstandard")
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode="rb")
+        pending = b""
+        try:
+            while True:
+                chunk = stream.read(65536)
+                if not chunk:
+                    break
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    if line:
+                        yield json.loads(line)
+        except (EOFError, zstandard.ZstdError if zstandard is not None else EOFError):
+            # 写入进程尚未结束当前压缩帧
+            pass
+
+
+recorder = CaptureRecorder()
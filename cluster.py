@@ -0,0 +1,411 @@
+import queue
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+from logger import logger
+from config import config_manager
+from metrics import metrics
+
+
+class StoreError(Exception):
+    pass
+
+
+class RespClient:
+    """最小的 Redis 协议（RESP2）客户端，只支持管道方式批量执行命令"""
+
+    def __init__(self, host, port, password=None, db=0, timeout=0.2):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        self._reader = sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self._send(setup)
+
+    @staticmethod
+    def _encode(command):
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise StoreError("connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            return StoreError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise StoreError(f"unexpected reply: {line[:20]!r}")
+
+    def _send(self, commands):
+        self._sock.sendall(b"".join(self._encode(command) for command in commands))
+        return [self._read_reply() for _ in commands]
+
+    def pipeline(self, commands):
+        """一次往返执行多条命令，返回各自的结果（命令级错误以 StoreError 实例返回）"""
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                return self._send(commands)
+            except (OSError, StoreError) as error:
+                self.close()
+                raise StoreError(str(error))
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+
+class LocalStore:
+    """进程内的存储替身，实现协调所需的少量 Redis 命令，同一进程内的多个协调器共享状态"""
+
+    _data = {}
+    _expiry = {}
+    _lock = threading.Lock()
+
+    def _alive(self, key, now):
+        expires = self._expiry.get(key)
+        if expires is not None and expires <= now:
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+        return key in self._data
+
+    def pipeline(self, commands):
+        now = time.time() * 1000
+        with self._lock:
+            return [self._execute(command[0].upper(), command[1:], now) for command in commands]
+
+    def _execute(self, name, args, now):
+        if name == "PING":
+            return "PONG"
+        if name == "PEXPIRE":
+            key = args[0]
+            if not self._alive(key, now):
+                return 0
+            self._expiry[key] = now + int(args[1])
+            return 1
+        if name == "ZADD":
+            key = args[0]
+            if not self._alive(key, now):
+                self._data[key] = {}
+            zset = self._data[key]
+            pairs = list(zip(args[1::2], args[2::2]))
+            added = sum(1 for _, member in pairs if member not in zset)
+            for score, member in pairs:
+                zset[member] = float(score)
+            return added
+        if name == "ZRANGEBYSCORE":
+            key, low, high = args[0], args[1], args[2]
+            if not self._alive(key, now):
+                return []
+            low = float("-inf") if low == "-inf" else float(low)
+            high = float("inf") if high == "+inf" else float(high)
+            return [member for member, score in sorted(self._data[key].items(), key=lambda x: x[1]) if low <= score <= high]
+        if name == "DEL":
+            return sum(1 for key in args if self._alive(key, now) and self._data.pop(key, None) is not None)
+        if name == "HSET":
+            key = args[0]
+            if not self._alive(key, now):
+                self._data[key] = {}
+            table = self._data[key]
+            pairs = list(zip(args[1::2], args[2::2]))
+            added = sum(1 for field, _ in pairs if field not in table)
+            for field, value in pairs:
+                table[field] = str(value)
+            return added
+        if name == "HDEL":
+            key = args[0]
+            if not self._alive(key, now):
+                return 0
+            table = self._data[key]
+            return sum(1 for field in args[1:] if table.pop(field, None) is not None)
+        if name == "HGETALL":
+            key = args[0]
+            if not self._alive(key, now):
+                return []
+            return [item for pair in self._data[key].items() for item in pair]
+        if name == "ZREMRANGEBYSCORE":
+            key, low, high = args[0], args[1], args[2]
+            if not self._alive(key, now):
+                return 0
+            low = float("-inf") if low == "-inf" else float(low)
+            high = float("inf") if high == "+inf" else float(high)
+            zset = self._data[key]
+            removed = [member for member, score in zset.items() if low <= score <= high]
+            for member in removed:
+                del zset[member]
+            return len(removed)
+        return StoreError(f"unknown command '{name}'")
+
+    def close(self):
+        pass
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._data.clear()
+            cls._expiry.clear()
+
+
+def create_store(url):
+    """redis://[:password@]host:port/db 使用 Redis 协议存储；local:// 使用进程内替身"""
+    parsed = urlparse(url)
+    if parsed.scheme == "local":
+        return LocalStore()
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RespClient(
+            parsed.hostname or "127.0.0.1",
+            parsed.port or 6379,
+            parsed.password,
+            db,
+            config_manager.get("CLUSTER.TIMEOUT", 0.2)
+        )
+    raise ValueError(f"不支持的协调存储地址: {url}")
+
+
+class ClusterCoordinator:
+    """多节点共享令牌冷却状态与进行中租约
+
+    读：选择令牌前用一次管道往返读取冷却集合（及需要时各节点的租约计数），结果缓存 VIEW_TTL 秒；
+    写：冷却上报和租约增减进入队列，由后台线程批量写入，不占用请求路径。
+    存储不可达时进入本地模式（返回 None），RETRY_INTERVAL 秒后再尝试。
+
+    每个节点把本节点各令牌的进行中请求数（绝对值）写入自己的哈希，只写变化的令牌；读取时按存活节点汇总，
+    命令数与节点数相关而与令牌数无关。节点每 LEASE_TTL/3 秒整体重写一次并续期，崩溃后其哈希到期自然消失，
+    存储不可用期间未写入的变化在恢复后整体重写，计数不会漂移。
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.prefix = config_manager.get("CLUSTER.PREFIX", "grok2api:")
+        self.available = True
+        self._retry_at = 0.0
+        self._views = {}
+        self._node = uuid.uuid4().hex[:12]
+        # 已知的存活节点，上一次读取视图时更新，读取时据此汇总各节点的租约计数
+        self._nodes = [self._node]
+        # 本节点各令牌的进行中请求数，以及尚未写入存储的令牌
+        self._counts = {}
+        self._dirty = set()
+        self._resync = True
+        self._counts_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="cluster-writer", daemon=True)
+        self._writer.start()
+
+    def _key(self, *parts):
+        return self.prefix + ":".join(parts)
+
+    def _mark_down(self, error):
+        if self.available:
+            logger.warning(f"协调存储不可用，切换为本地模式: {str(error)}", "Cluster")
+        self.available = False
+        self._retry_at = time.monotonic() + config_manager.get("CLUSTER.RETRY_INTERVAL", 5)
+        metrics.incr("cluster_store_errors")
+
+    def _usable(self):
+        if self.available:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            self.store.pipeline([("PING",)])
+        except StoreError as error:
+            self._mark_down(error)
+            return False
+        self.available = True
+        logger.info("协调存储已恢复", "Cluster")
+        return True
+
+    def view(self, model_id, with_inflight=False):
+        """返回 (冷却中的令牌 id 集合, 令牌 id -> 集群内进行中请求数)，本地模式下返回 None
+
+        with_inflight 为 False 时只读取冷却集合。
+        """
+        now = time.monotonic()
+        cache_key = (model_id, with_inflight)
+        cached = self._views.get(cache_key)
+        if cached and cached[0] > now:
+            return cached[1]
+        if not self._usable():
+            return None
+
+        wall_ms = int(time.time() * 1000)
+        commands = [("ZRANGEBYSCORE", self._key("cooldown", model_id), wall_ms, "+inf")]
+        nodes = self._nodes
+        if with_inflight:
+            commands.append(("ZRANGEBYSCORE", self._key("nodes"), wall_ms, "+inf"))
+            commands.extend(("HGETALL", self._key("inflight", node)) for node in nodes)
+        try:
+            replies = self.store.pipeline(commands)
+        except StoreError as error:
+            self._mark_down(error)
+            return None
+        metrics.incr("cluster_view_reads")
+
+        cooling = set(replies[0]) if isinstance(replies[0], list) else set()
+        inflight = {}
+        if with_inflight:
+            counts = replies[2:]
+            if isinstance(replies[1], list):
+                self._nodes = replies[1] or [self._node]
+                # 新加入的节点本次才出现在节点集合中，补读一次它们的计数
+                joined = [node for node in self._nodes if node not in nodes]
+                if joined:
+                    try:
+                        counts += self.store.pipeline([("HGETALL", self._key("inflight", node)) for node in joined])
+                    except StoreError as error:
+                        self._mark_down(error)
+                        return None
+            for reply in counts:
+                if not isinstance(reply, list):
+                    continue
+                for token_id, count in zip(reply[::2], reply[1::2]):
+                    inflight[token_id] = inflight.get(token_id, 0) + int(count)
+        result = (cooling, inflight)
+        self._views[cache_key] = (now + config_manager.get("CLUSTER.VIEW_TTL", 0.2), result)
+        return result
+
+    def report_cooldown(self, token_id, model_id, until):
+        """until 为冷却结束的 wall-clock 时间（秒）"""
+        key = self._key("cooldown", model_id)
+        self._writes.put([
+            ("ZADD", key, int(until * 1000), token_id),
+            ("ZREMRANGEBYSCORE", key, "-inf", int(time.time() * 1000))
+        ])
+
+    def acquire_lease(self, token_id):
+        with self._counts_lock:
+            self._counts[token_id] = self._counts.get(token_id, 0) + 1
+            self._dirty.add(token_id)
+        # 空命令只用于唤醒写入线程
+        self._writes.put([])
+
+    def release_lease(self, token_id):
+        with self._counts_lock:
+            count = self._counts.get(token_id, 0) - 1
+            if count > 0:
+                self._counts[token_id] = count
+            else:
+                self._counts.pop(token_id, None)
+            self._dirty.add(token_id)
+        self._writes.put([])
+
+    def _lease_writes(self, full):
+        """本节点租约计数的写入命令：full 时整体重写，否则只写变化的令牌；同时续期节点哈希和节点心跳"""
+        key = self._key("inflight", self._node)
+        with self._counts_lock:
+            if full:
+                self._dirty.clear()
+                self._resync = False
+                changed = dict(self._counts)
+                removed = []
+            else:
+                if not self._dirty:
+                    return []
+                changed = {token_id: self._counts[token_id] for token_id in self._dirty if token_id in self._counts}
+                removed = [token_id for token_id in self._dirty if token_id not in self._counts]
+                self._dirty = set()
+        commands = [("DEL", key)] if full else []
+        if changed:
+            commands.append(("HSET", key) + tuple(item for pair in changed.items() for item in pair))
+        if removed:
+            commands.append(("HDEL", key) + tuple(removed))
+        ttl_ms = config_manager.get("CLUSTER.LEASE_TTL", 60) * 1000
+        now_ms = int(time.time() * 1000)
+        nodes_key = self._key("nodes")
+        commands.extend([
+            ("PEXPIRE", key, ttl_ms),
+            ("ZADD", nodes_key, now_ms + ttl_ms, self._node),
+            ("ZREMRANGEBYSCORE", nodes_key, "-inf", now_ms),
+            ("PEXPIRE", nodes_key, ttl_ms)
+        ])
+        return commands
+
+    def _write_loop(self):
+        renew_at = time.monotonic()
+        while True:
+            interval = config_manager.get("CLUSTER.LEASE_TTL", 60) / 3
+            try:
+                commands = list(self._writes.get(timeout=max(0.0, renew_at - time.monotonic())))
+            except queue.Empty:
+                commands = []
+            # 合并队列中已有的写入，一次管道发送
+            while len(commands) < 512:
+                try:
+                    commands.extend(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            full = self._resync or time.monotonic() >= renew_at
+            if full:
+                renew_at = time.monotonic() + interval
+            try:
+                if not self._usable():
+                    raise StoreError("store unavailable")
+                commands.extend(self._lease_writes(full))
+                if commands:
+                    self.store.pipeline(commands)
+            except StoreError as error:
+                if self.available:
+                    self._mark_down(error)
+                # 冷却上报直接丢弃；租约计数在存储恢复后整体重写
+                self._resync = True
+                renew_at = self._retry_at
+                metrics.incr("cluster_writes_dropped", len(commands))
+
+    def status(self):
+        return {
+            "available": self.available,
+            "store": type(self.store).__name__,
+            "pending_writes": self._writes.qsize(),
+            "leases": sum(self._counts.values()),
+            "nodes": len(self._nodes)
+        }
+
+
+def create_coordinator():
+    url = config_manager.get("CLUSTER.STORE_URL")
+    if not url:
+        return None
+    return ClusterCoordinator(create_store(url))
@@ -4,6 +4,25 @@ from pathlib import Path
 
 class ConfigManager:
     def __init__(self):
+        self._apply_env_file()
+        self.config = self._load_config()
+
+    def _apply_env_file(self):
+        """CONFIG_ENV_FILE 指定的 KEY=VALUE 文件覆盖进程环境变量，重新加载时会再次读取"""
+        path = os.environ.get("CONFIG_ENV_FILE")
+        if not path or not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                os.environ[key.strip()] = value.strip().strip('"').strip("'")
+
+    def reload(self):
+        """重新读取环境变量生成新的配置快照并整体替换，正在处理的请求不受影响"""
+        self._apply_env_file()
         self.config = self._load_config()
         
     def _load_config(self):
@@ -13,9 +32,16 @@ class ConfigManager:
                 "grok-4": "grok-4",
                 "grok-4-fast": "grok-4-mini-thinking-tahoe"
             },
+            # 模型注册表：是否为推理模型，以及响应处理流水线在 decode/classify 之后的阶段
+            "MODEL_REGISTRY": {
+                "grok-3": {"reasoning": False, "pipeline": ["plain", "text"], "context": 131072},
+                "grok-4": {"reasoning": True, "pipeline": ["think", "tools"], "context": 256000},
+                "grok-4-fast": {"reasoning": True, "pipeline": ["think", "tools"], "context": 2000000}
+            },
             "API": {
                 "IS_TEMP_CONVERSATION": os.environ.get("IS_TEMP_CONVERSATION", "true").lower() == "true",
-                "BASE_URL": "https://grok.com",
+                # 上游地址；回放采样流量时指向 benchmarks/replay_upstream.py
+                "BASE_URL": os.environ.get("UPSTREAM_BASE_URL", "https://grok.com"),
                 "API_KEY": os.environ.get("API_KEY", "sk-123456"),
                 "SIGNATURE_COOKIE": None,
                 "RETRY_TIME": 1000,
@@ -26,6 +52,185 @@ class ConfigManager:
                 "COOKIE": None,
                 "PORT": int(os.environ.get("PORT", 5200))
             },
+            "UPSTREAM": {
+                "MAX_CLIENTS": int(os.environ.get("UPSTREAM_MAX_CLIENTS", 256)),
+                "WARMUP_CONNECTIONS": int(os.environ.get("WARMUP_CONNECTIONS", 2)),
+                # 上游 HTTP 版本: 1.1 / 2 / 3；2 和 3 在少量连接上多路复用会话流
+                "HTTP_VERSION": os.environ.get("UPSTREAM_HTTP_VERSION", "2"),
+                # 每个连接上的最大并发流数，以及每个出口（上游或代理主机）的最大连接数，0 表示不限制；
+                # 协商退回 HTTP/1.1 时连接数上限即为并发上限，因此默认不限制
+                "MAX_CONCURRENT_STREAMS": int(os.environ.get("UPSTREAM_MAX_STREAMS", 100)),
+                "MAX_HOST_CONNECTIONS": int(os.environ.get("UPSTREAM_MAX_HOST_CONNECTIONS", 0))
+            },
+            "STREAM": {
+                # 单个流的缓冲高水位（字节），0 表示不限制
+                "HIGH_WATER": int(os.environ.get("STREAM_HIGH_WATER", 1024 * 1024)),
+                # 客户端读取过慢时的处理策略: pause / coalesce / drop
+                "BACKPRESSURE": os.environ.get("STREAM_BACKPRESSURE", "pause").lower(),
+                # 流式响应中途断开或收到 error 帧时换令牌续写的最多次数，0 表示不续写
+                "FAILOVER_ATTEMPTS": int(os.environ.get("STREAM_FAILOVER_ATTEMPTS", 2)),
+                "CONTINUE_PROMPT": "请从上一条回复中断的位置直接继续输出，不要重复已经输出的内容，也不要添加任何说明。"
+            },
+            "VALIDATION": {
+                "CONCURRENCY": int(os.environ.get("VALIDATION_CONCURRENCY", 32)),
+                "MAX_CONCURRENCY": 256,
+                "KEEP_JOBS": 10
+            },
+            "TOKENS": {
+                "IMPORT_BATCH_SIZE": 1000,
+                # 令牌及校验状态的落盘文件，重启或滚动发布后据此恢复；文件中保存明文 Cookie，默认不落盘
+                "STATE_FILE": os.environ.get("TOKEN_STATE_FILE", ""),
+                "STATE_INTERVAL": 5,
+                # 保留的令牌变更条数，管理页面断线重连时据此补发增量
+                "CHANGE_LOG_SIZE": 10000
+            },
+            "DASHBOARD": {
+                # 管理页面事件流检查令牌变更的间隔、推送聚合指标的间隔和单次增量的最大条数（超过时让页面重新加载快照）
+                "TICK": 1,
+                "STATS_INTERVAL": int(os.environ.get("DASHBOARD_STATS_INTERVAL", 5)),
+                "MAX_DIFF": 5000,
+                "KEEPALIVE": 15
+            },
+            "LIFECYCLE": {
+                # SIGTERM 后等待进行中请求（含 SSE 流）结束的最长时间（秒）
+                "DRAIN_TIMEOUT": int(os.environ.get("DRAIN_TIMEOUT", 120)),
+                # 以主进程 + 工作进程方式运行，SIGHUP 时无中断地替换工作进程
+                "WORKER_RELOAD": os.environ.get("WORKER_RELOAD", "false").lower() == "true",
+                "READY_TIMEOUT": 60
+            },
+            "RESPONSE": {
+                # 非流式响应的最大字符数，0 表示不限制
+                "MAX_CHARS": int(os.environ.get("MAX_RESPONSE_CHARS", 0)),
+                # 非流式响应是否以增量方式输出 JSON 正文
+                "STREAM_BODY": os.environ.get("STREAM_NON_STREAM_BODY", "false").lower() == "true"
+            },
+            "BATCH": {
+                "DIR": os.environ.get("BATCH_DIR", "data/batches"),
+                # 所有批处理任务共享的全局并发上限
+                "CONCURRENCY": int(os.environ.get("BATCH_CONCURRENCY", 64)),
+                # 单个令牌上同时进行的批处理请求数
+                "PER_TOKEN_CONCURRENCY": int(os.environ.get("BATCH_PER_TOKEN_CONCURRENCY", 2)),
+                "WORKERS": int(os.environ.get("BATCH_WORKERS", 32)),
+                "ACQUIRE_TIMEOUT": 300,
+                # 暂时性失败（无可用令牌、限流、被抢占）的重试次数和首次退避秒数，仍失败的行不写入输出，续跑时重新执行
+                "MAX_RETRIES": int(os.environ.get("BATCH_MAX_RETRIES", 3)),
+                "RETRY_DELAY": 5,
+                "CHECKPOINT_EVERY": 100,
+                # 任务锁被其他进程持有时重试获取的间隔（秒）
+                "LOCK_RETRY": 1,
+                "PRIORITY": "low"
+            },
+            "SCHEDULER": {
+                # 上游总并发名额，0 表示不限制（不排队）
+                "MAX_CONCURRENT": int(os.environ.get("UPSTREAM_MAX_CONCURRENT", 0)),
+                # 只允许 high 优先级使用的保留名额
+                "RESERVED_HIGH": int(os.environ.get("RESERVED_HIGH_SLOTS", 0)),
+                "WEIGHTS": {"high": 8, "normal": 4, "low": 1},
+                "QUEUE_TIMEOUT": int(os.environ.get("SCHEDULER_QUEUE_TIMEOUT", 60)),
+                "DEFAULT_PRIORITY": os.environ.get("DEFAULT_PRIORITY", "normal")
+            },
+            "API_KEYS": {
+                # 租户 Key 文件，只保存 sha256 哈希
+                "FILE": os.environ.get("API_KEYS_FILE", "data/api_keys.json"),
+                "USAGE_FILE": os.environ.get("USAGE_FILE", "data/usage.ndjson"),
+                "FLUSH_INTERVAL": int(os.environ.get("USAGE_FLUSH_INTERVAL", 10))
+            },
+            "USAGE": {
+                # 本地分词计数的消息缓存条数
+                "CACHE_SIZE": int(os.environ.get("USAGE_CACHE_SIZE", 20000))
+            },
+            "CONTEXT": {
+                # 全局上下文预算（token），与模型注册表中的上下文长度取较小值，0 表示只按注册表
+                "BUDGET": int(os.environ.get("CONTEXT_BUDGET", 0)),
+                # 裁剪时始终保留的最近消息数，以及单条工具输出的 token 上限
+                "KEEP_RECENT": int(os.environ.get("CONTEXT_KEEP_RECENT", 8)),
+                "TOOL_OUTPUT_MAX": int(os.environ.get("CONTEXT_TOOL_OUTPUT_MAX", 4000))
+            },
+            "REQUEST": {
+                # 聊天请求体大小上限（字节），0 表示不限制；单个请求的消息条数上限，0 表示不限制
+                "MAX_BODY_BYTES": int(os.environ.get("MAX_BODY_BYTES", 32 * 1024 * 1024)),
+                "MAX_MESSAGES": int(os.environ.get("MAX_MESSAGES", 0))
+            },
+            "CAPTURE": {
+                # 记录的请求比例（0~1），0 表示关闭；记录写入 DIR 下按大小轮转的压缩 NDJSON 文件
+                "SAMPLE_RATE": float(os.environ.get("CAPTURE_SAMPLE_RATE", 0)),
+                "DIR": os.environ.get("CAPTURE_DIR", "data/capture"),
+                # zstd（需要 zstandard）或 gzip，未安装 zstandard 时使用 gzip
+                "COMPRESSION": os.environ.get("CAPTURE_COMPRESSION", "zstd").lower(),
+                "MAX_FILE_BYTES": int(os.environ.get("CAPTURE_MAX_FILE_BYTES", 64 * 1024 * 1024)),
+                "MAX_FILES": int(os.environ.get("CAPTURE_MAX_FILES", 20)),
+                # 待写入记录的队列长度，写入跟不上时丢弃新记录
+                "QUEUE_SIZE": 1000,
+                "FLUSH_INTERVAL": 1,
+                # 单条记录中帧和输出的总条数上限
+                "MAX_ITEMS": 20000
+            },
+            "WEBSOCKET": {
+                # 单个 WebSocket 连接上同时进行的补全数量上限
+                "MAX_CONCURRENT": int(os.environ.get("WS_MAX_CONCURRENT", 32)),
+                # 服务端发送 ping 的间隔（秒），0 表示不发送
+                "PING_INTERVAL": int(os.environ.get("WS_PING_INTERVAL", 25))
+            },
+            "ATTACHMENTS": {
+                # 是否把输入图片上传为上游附件；关闭时图片只作为 "[图片]" 占位
+                "ENABLED": os.environ.get("IMAGE_INPUT", "true").lower() == "true",
+                # (令牌, 图片内容摘要) -> 上游附件 id 的缓存条目数
+                "CACHE_SIZE": int(os.environ.get("ATTACHMENT_CACHE_SIZE", 4096)),
+                # 单个请求内并发下载/上传图片的数量
+                "MAX_PARALLEL": int(os.environ.get("ATTACHMENT_MAX_PARALLEL", 4)),
+                "MAX_BYTES": int(os.environ.get("IMAGE_MAX_BYTES", 20 * 1024 * 1024)),
+                "FETCH_TIMEOUT": 15,
+                # 是否允许下载请求中的 http(s) 图片地址；开启后仍拒绝回环、内网等非公网地址，且不跟随重定向
+                "ALLOW_REMOTE": os.environ.get("IMAGE_FETCH_REMOTE", "false").lower() == "true",
+                # 例外放行的主机名或网段（逗号分隔，如 images.internal,10.1.0.0/16），可解析到非公网地址
+                "ALLOWED_HOSTS": [
+                    host.strip().lower()
+                    for host in os.environ.get("IMAGE_FETCH_ALLOWED_HOSTS", "").split(",")
+                    if host.strip()
+                ]
+            },
+            "IMAGES": {
+                # 生成图片的本地缓存目录与总大小上限（字节），超过后按最近使用淘汰
+                "CACHE_DIR": os.environ.get("IMAGE_CACHE_DIR", "data/images"),
+                "CACHE_BYTES": int(os.environ.get("IMAGE_CACHE_BYTES", 512 * 1024 * 1024)),
+                "ASSET_URL": "https://assets.grok.com",
+                # 返回给客户端的图片地址前缀，留空时使用请求的 Host
+                "PUBLIC_URL": os.environ.get("IMAGE_PUBLIC_URL", "").rstrip("/"),
+                "MAX_BYTES": 20 * 1024 * 1024,
+                "FETCH_TIMEOUT": 30,
+                "SOURCE_CACHE_SIZE": 4096
+            },
+            "PROFILER": {
+                # 单次采样的最长时间（秒）
+                "MAX_SECONDS": 60
+            },
+            "CLUSTER": {
+                # 多节点协调存储: redis://[:password@]host:port/db，local:// 为进程内替身，留空则只用本地状态
+                "STORE_URL": os.environ.get("CLUSTER_STORE_URL", ""),
+                "PREFIX": os.environ.get("CLUSTER_PREFIX", "grok2api:"),
+                "TIMEOUT": float(os.environ.get("CLUSTER_TIMEOUT", 0.2)),
+                # 集群视图缓存时间（秒），租约的有效期（秒，持有期间每 1/3 有效期续期一次），存储不可用后的重试间隔（秒）
+                "VIEW_TTL": 0.2,
+                "LEASE_TTL": 60,
+                "RETRY_INTERVAL": 5
+            },
+            "ROUTING": {
+                # 令牌亲和路由: off（轮询）/ conversation（按会话指纹）/ api_key（按 API Key）
+                "AFFINITY": os.environ.get("TOKEN_AFFINITY", "off").lower()
+            },
+            "RATE_LIMIT": {
+                # 根据 429 反馈学习每个令牌在各模型上的配额并提前限速
+                "ENABLED": os.environ.get("RATE_LEARNING", "true").lower() == "true",
+                # 配额统计窗口（秒），可按模型覆盖
+                "WINDOW": int(os.environ.get("RATE_WINDOW", 7200)),
+                "WINDOWS": {},
+                "INCREASE": 1.0,
+                "DECREASE": 0.9,
+                # 没有 Retry-After 时冷却时间的下限与上限（秒），达到估计上限后探测请求的间隔（秒）
+                "MIN_COOLDOWN": 60,
+                "MAX_COOLDOWN": int(os.environ.get("RATE_MAX_COOLDOWN", 300)),
+                "PROBE_INTERVAL": int(os.environ.get("RATE_PROBE_INTERVAL", 60))
+            },
             "RETRY": {
                 "RETRYSWITCH": False,
                 "MAX_ATTEMPTS": 2
@@ -53,8 +258,11 @@ class ConfigManager:
     def get_models(self):
         return self.get("MODELS", {})
     
+    def get_model_profile(self, model):
+        return self.get("MODEL_REGISTRY", {}).get(model) or {"reasoning": False, "pipeline": ["plain", "text"], "context": 0}
+
     def is_reasoning_model(self, model):
-        return model in ["grok-4", "grok-4-fast"]
+        return self.get_model_profile(model)["reasoning"]
     
     def is_valid_model(self, model):
         return model in self.get_models()
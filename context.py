@@ -0,0 +1,122 @@
+from config import config_manager
+from metrics import metrics
+from tokenizer import count_message, MESSAGE_OVERHEAD, REPLY_OVERHEAD
+
+TOOL_ROLES = ("tool", "function")
+
+
+def context_budget(model):
+    """模型的上下文预算（token）：取注册表中的上下文长度与 CONTEXT.BUDGET 中较小的非零值，0 表示不裁剪"""
+    limits = [
+        value for value in (
+            config_manager.get_model_profile(model).get("context", 0),
+            config_manager.get("CONTEXT.BUDGET", 0)
+        ) if value
+    ]
+    return min(limits) if limits else 0
+
+
+def message_text(message):
+    content = message.get("content", "")
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content if isinstance(content, str) else str(content)
+
+
+def truncate_text(text, tokens, max_tokens):
+    """保留开头和结尾，按字符比例估算需要保留的长度"""
+    keep = int(len(text) * max_tokens / tokens)
+    head = keep * 2 // 3
+    tail = keep - head
+    return f"{text[:head]}\n…[已截断约 {tokens - max_tokens} tokens]…\n{text[len(text) - tail:]}"
+
+
+class TrimReport:
+    __slots__ = ("budget", "before", "after", "dropped", "truncated")
+
+    def __init__(self, budget, before):
+        self.budget = budget
+        self.before = before
+        self.after = before
+        self.dropped = 0
+        self.truncated = 0
+
+    def header(self):
+        """写入响应头 X-Context-Trimmed 的内容"""
+        return (
+            f"dropped={self.dropped}; truncated={self.truncated}; "
+            f"tokens={self.before}->{self.after}; budget={self.budget}"
+        )
+
+
+def trim_messages(messages, model):
+    """历史超过模型上下文预算时裁剪，返回 (消息列表, TrimReport 或 None)
+
+    依次执行：截断超长的工具输出；保留系统消息和最近的 CONTEXT.KEEP_RECENT 条消息，
+    从最早的中间消息开始丢弃，丢弃的部分替换为一条占位消息。每条消息的计数由 tokenizer 按内容缓存，
+    多轮会话中只有新消息需要重新分词。
+    """
+    budget = context_budget(model)
+    if not budget or not messages:
+        return messages, None
+
+    counts = [count_message(message) for message in messages]
+    total = sum(counts) + REPLY_OVERHEAD
+    if total <= budget:
+        return messages, None
+
+    report = TrimReport(budget, total)
+    messages = list(messages)
+
+    # 1. 截断超长的工具输出（最后一条消息保持完整）
+    tool_max = config_manager.get("CONTEXT.TOOL_OUTPUT_MAX", 4000)
+    truncated = set()
+    for index, message in enumerate(messages[:-1]):
+        if total <= budget:
+            break
+        if message.get("role") not in TOOL_ROLES or counts[index] - MESSAGE_OVERHEAD <= tool_max:
+            continue
+        text = message_text(message)
+        messages[index] = {"role": message.get("role"), "content": truncate_text(text, counts[index], tool_max)}
+        new_count = count_message(messages[index])
+        total -= counts[index] - new_count
+        counts[index] = new_count
+        truncated.add(index)
+
+    # 2. 从最早的非系统消息开始丢弃，保留最近的若干条
+    keep_recent = max(1, config_manager.get("CONTEXT.KEEP_RECENT", 8))
+    protected_from = max(0, len(messages) - keep_recent)
+    dropped_at = None
+    dropped_tokens = 0
+    for index in range(protected_from):
+        if total <= budget:
+            break
+        if messages[index].get("role") == "system":
+            continue
+        if dropped_at is None:
+            dropped_at = index
+        total -= counts[index]
+        dropped_tokens += counts[index]
+        counts[index] = None
+        report.dropped += 1
+
+    if report.dropped:
+        placeholder = {
+            "role": "user",
+            "content": f"[为控制上下文长度，已省略 {report.dropped} 条较早的消息，约 {dropped_tokens} tokens]"
+        }
+        kept = []
+        for index, message in enumerate(messages):
+            if index == dropped_at:
+                kept.append(placeholder)
+            if counts[index] is not None:
+                kept.append(message)
+        messages = kept
+        total += count_message(placeholder)
+
+    # 截断后又被丢弃的不计入
+    report.truncated = sum(1 for index in truncated if counts[index] is not None)
+    report.after = total
+    metrics.incr("context_trimmed")
+    metrics.incr("context_tokens_saved", report.before - report.after)
+    return messages, report
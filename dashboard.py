@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+from config import config_manager
+from metrics import metrics
+
+
+def sse(event, data, event_id=None):
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Dashboard:
+    """管理页面的实时事件流
+
+    令牌变更按版本推送增量（游标为 "<epoch>.<version>"，断线重连时通过 Last-Event-ID 补发），
+    聚合指标由一个后台线程按固定间隔采样一次，所有订阅者共享；没有订阅者时后台线程退出。
+    """
+
+    def __init__(self, token_manager, upstream):
+        self.token_manager = token_manager
+        self.upstream = upstream
+        self.stats = None
+        # 每次有新的令牌版本或新的指标时递增，订阅者据此判断是否需要唤醒
+        self.seq = 0
+        self.subscribers = 0
+        self._changed = threading.Condition()
+        self._thread = None
+        self._counters = None
+        self._sampled_at = None
+
+    def cursor(self, version):
+        return f"{self.token_manager.epoch}.{version}"
+
+    def parse_cursor(self, cursor):
+        """返回游标中的版本；游标缺失、格式错误或来自其他进程时返回 None"""
+        epoch, _, version = (cursor or "").partition(".")
+        if epoch != self.token_manager.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def changes(self, since):
+        """返回 (游标, 变更列表或 None)，None 表示需要重新获取快照"""
+        version, items = self.token_manager.changes_since(since, config_manager.get("DASHBOARD.MAX_DIFF", 5000))
+        return self.cursor(version), items
+
+    def _sample(self):
+        """按与上次采样的差值计算吞吐、延迟和 429 数量"""
+        now = time.monotonic()
+        counters = metrics.snapshot()["counters"]
+        previous = self._counters or counters
+        elapsed = now - self._sampled_at if self._sampled_at is not None else 0
+        self._counters = counters
+        self._sampled_at = now
+
+        def delta(name):
+            return counters.get(name, 0) - previous.get(name, 0)
+
+        latency_count = delta("upstream_headers_ms_count")
+        return {
+            "time": int(time.time()),
+            "interval": round(elapsed, 2),
+            "requests": delta("requests_total"),
+            "rps": round(delta("requests_total") / elapsed, 2) if elapsed else 0,
+            "rate_limited": delta("upstream_status_429"),
+            "error_frames": delta("upstream_error_frames"),
+            "failovers": delta("stream_failovers"),
+            "latency_ms": round(delta("upstream_headers_ms_sum") / latency_count, 1) if latency_count else None,
+            "streams": len(self.upstream.streams),
+            **self.token_manager.health_summary()
+        }
+
+    def _notify(self):
+        with self._changed:
+            self.seq += 1
+            self._changed.notify_all()
+
+    def _run(self):
+        version = self.token_manager.version
+        next_stats = 0
+        while True:
+            with self._changed:
+                if not self.subscribers:
+                    self._thread = None
+                    return
+            changed = self.token_manager.version != version
+            version = self.token_manager.version
+            if time.monotonic() >= next_stats:
+                self.stats = self._sample()
+                next_stats = time.monotonic() + config_manager.get("DASHBOARD.STATS_INTERVAL", 5)
+                changed = True
+            if changed:
+                self._notify()
+            time.sleep(config_manager.get("DASHBOARD.TICK", 1))
+
+    def _join(self):
+        with self._changed:
+            self.subscribers += 1
+            if self._thread is None:
+                self.stats = None
+                self._counters = None
+                self._sampled_at = None
+                self._thread = threading.Thread(target=self._run, name="dashboard", daemon=True)
+                self._thread.start()
+        metrics.incr("dashboard_subscriptions")
+
+    def _leave(self):
+        with self._changed:
+            self.subscribers -= 1
+
+    def subscribe(self, cursor):
+        """单个订阅者的 SSE 事件：tokens（增量）、stats（聚合指标）、reset（需要重新获取快照）"""
+        since = self.parse_cursor(cursor)
+        if since is None:
+            yield sse("reset", {"cursor": self.cursor(self.token_manager.version)})
+            return
+
+        self._join()
+        seen_stats = None
+        try:
+            while True:
+                with self._changed:
+                    seq = self.seq
+                current, items = self.changes(since)
+                if items is None:
+                    yield sse("reset", {"cursor": current})
+                    return
+                if items:
+                    since = self.parse_cursor(current)
+                    yield sse("tokens", {"cursor": current, "changes": items}, current)
+                stats = self.stats
+                if stats is not None and stats is not seen_stats:
+                    seen_stats = stats
+                    yield sse("stats", stats)
+                with self._changed:
+                    idle = self.seq == seq and not self._changed.wait(config_manager.get("DASHBOARD.KEEPALIVE", 15))
+                if idle:
+                    # 长时间没有事件时发送注释行，保持连接并及时发现已断开的客户端
+                    yield ": keepalive\n\n"
+        finally:
+            self._leave()
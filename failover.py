@@ -0,0 +1,114 @@
+from logger import logger
+from config import config_manager
+from metrics import metrics
+
+
+# 判断续写是否与已输出内容重叠时，最多比较已输出内容末尾的字符数，以及最短的有效重叠
+OVERLAP_WINDOW = 256
+MIN_OVERLAP = 3
+# 续写开头少于该长度时先缓存，避免过早判断
+PROBE_CHARS = 24
+
+
+class Splicer:
+    """把续写的流接在已输出内容之后，去掉与已输出内容重叠的开头
+
+    续写可能从头重新生成（开头与已输出内容相同），也可能重复已输出内容的最后几个词；
+    两种情况下重叠部分都不会再发给客户端。
+    """
+
+    def __init__(self, relayed):
+        self.relayed = relayed
+        self.pending = ""
+        self.decided = False
+
+    def feed(self, text):
+        if self.decided:
+            return text
+        self.pending += text
+        if self.relayed.startswith(self.pending):
+            # 仍与已输出内容的开头一致，可能是从头重新生成
+            return ""
+        if self.pending.startswith(self.relayed):
+            self.decided = True
+            return self.pending[len(self.relayed):]
+        if len(self.pending) < PROBE_CHARS:
+            return ""
+        return self._decide()
+
+    def flush(self):
+        if self.decided or self.relayed.startswith(self.pending):
+            return ""
+        return self._decide()
+
+    def _decide(self):
+        self.decided = True
+        tail = self.relayed[-OVERLAP_WINDOW:]
+        for size in range(min(len(tail), len(self.pending)), MIN_OVERLAP - 1, -1):
+            if tail.endswith(self.pending[:size]):
+                metrics.incr("failover_overlap_chars", size)
+                return self.pending[size:]
+        return self.pending
+
+
+class StreamFailover:
+    """流式响应中途失败时换令牌续写
+
+    续写请求在原消息之后追加 assistant 消息（已输出的正文）和一条继续输出的指令，
+    新流经 Splicer 去重后接在原流之后，客户端看到的是一条连续的流。
+    """
+
+    def __init__(self, handler, messages, model, token, tried_tokens, images=None, priority="normal",
+                 max_inflight=None, healthy_only=False, affinity_key=None, capture=None):
+        self.handler = handler
+        self.messages = messages
+        self.model = model
+        self.token = token
+        self.tried_tokens = tried_tokens
+        self.images = images or []
+        self.priority = priority
+        self.max_inflight = max_inflight
+        self.healthy_only = healthy_only
+        self.affinity_key = affinity_key
+        self.capture = capture
+        self.attempts = 0
+
+    def reopen(self, relayed, reason):
+        """返回续写的上游响应；没有剩余次数或未尝试过的可用令牌时返回 None，由调用方结束流"""
+        # 次数用完（包括关闭续写）时 error 帧背后的令牌同样要记录限流
+        if reason == "error":
+            self.handler.token_manager.record_rate_limited(self.token, self.model)
+        if self.attempts >= config_manager.get("STREAM.FAILOVER_ATTEMPTS", 2):
+            return None
+        self.attempts += 1
+
+        messages = list(self.messages)
+        if relayed:
+            messages.append({"role": "assistant", "content": relayed})
+            messages.append({"role": "user", "content": config_manager.get("STREAM.CONTINUE_PROMPT")})
+
+        logger.warning(
+            f"上游流中断（{reason}），已输出 {len(relayed)} 字符，第 {self.attempts} 次换令牌续写", "Failover"
+        )
+        try:
+            opened = self.handler.open_stream(
+                messages, self.model, self.tried_tokens, self.images, self.priority,
+                self.max_inflight, self.healthy_only, self.affinity_key, capture=self.capture,
+                # 续写只用本次请求未尝试过的令牌，不退回刚失败的令牌
+                untried_only=True
+            )
+        except Exception as error:
+            logger.error(f"续写请求失败: {str(error)}", "Failover")
+            metrics.incr("stream_failover_failed")
+            return None
+        if opened is None:
+            logger.warning("没有未尝试过的可用令牌，结束续写", "Failover")
+            metrics.incr("stream_failover_failed")
+            return None
+        if opened[0].status_code != 200:
+            metrics.incr("stream_failover_failed")
+            return None
+        response, self.token = opened
+        self.handler.token_manager.record_success(self.token, self.model)
+        metrics.incr("stream_failovers")
+        return response
@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import urlparse
+from logger import logger
+from config import config_manager
+from metrics import metrics
+from attachments import MIME_EXTENSIONS, check_remote_host
+
+# 缓存文件名：内容 sha256 + 扩展名，对外的图片地址只接受这种形式
+BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.(png|jpg|gif|webp)$")
+
+
+class BlobCache:
+    """内容寻址的磁盘缓存，文件名为内容的 sha256，按最近使用顺序和总字节数淘汰"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # 重启后按修改时间恢复淘汰顺序（读取时会刷新修改时间）
+        files = []
+        for name in os.listdir(self.directory):
+            if BLOB_NAME.match(name):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total += size
+        self._evict()
+
+    def _evict(self):
+        while self.max_bytes and self.total > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            metrics.incr("blob_cache_evictions")
+
+    def put(self, data, mime):
+        """写入内容并返回文件名；相同内容只保存一份"""
+        name = f"{hashlib.sha256(data).hexdigest()}.{MIME_EXTENSIONS.get(mime, 'png')}"
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                return name
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            if name not in self.entries:
+                self.entries[name] = len(data)
+                self.total += len(data)
+            self.entries.move_to_end(name)
+            self._evict()
+        return name
+
+    def path(self, name):
+        """返回缓存文件路径并标记为最近使用，不存在时返回 None"""
+        with self._lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self.entries), "bytes": self.total, "max_bytes": self.max_bytes}
+
+
+def _same_origin(url, other):
+    first, second = urlparse(url), urlparse(other)
+    try:
+        return (first.scheme, first.hostname, first.port) == (second.scheme, second.hostname, second.port)
+    except ValueError:
+        return False
+
+
+class GeneratedImages:
+    """从上游资源地址下载生成的图片并存入 BlobCache
+
+    同一上游地址只下载一次：已下载的记录地址 -> 缓存文件名，下载中的由并发请求共享。
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.cache = BlobCache(
+            config_manager.get("IMAGES.CACHE_DIR", "data/images"),
+            config_manager.get("IMAGES.CACHE_BYTES", 0)
+        )
+        self.sources = OrderedDict()
+        self._sources_lock = threading.Lock()
+        # 上游地址 -> asyncio.Future，只在事件循环线程中访问
+        self._pending = {}
+
+    def _known(self, path):
+        with self._sources_lock:
+            name = self.sources.get(path)
+            if name is not None:
+                self.sources.move_to_end(path)
+            return name
+
+    def _remember(self, path, name):
+        with self._sources_lock:
+            self.sources[path] = name
+            self.sources.move_to_end(path)
+            while len(self.sources) > config_manager.get("IMAGES.SOURCE_CACHE_SIZE", 4096):
+                self.sources.popitem(last=False)
+
+    def start(self, path, headers, request_options):
+        """开始下载，返回 concurrent.futures.Future，结果为缓存文件名"""
+        return self.upstream.submit(self._fetch(path, headers, request_options))
+
+    async def _fetch(self, path, headers, request_options):
+        name = self._known(path)
+        if name is not None and self.cache.path(name):
+            metrics.incr("generated_image_cache_hits")
+            return name
+
+        pending = self._pending.get(path)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[path] = future
+        try:
+            asset_url = config_manager.get("IMAGES.ASSET_URL", "https://assets.grok.com")
+            url = path if path.startswith(("http://", "https://")) else f"{asset_url}/{path.lstrip('/')}"
+            resolve = None
+            if not _same_origin(url, asset_url):
+                # 上游帧中的其他主机地址：不带令牌 Cookie 等请求头，并与输入图片一样检查并固定解析地址
+                headers = None
+                resolve = await check_remote_host(url)
+                metrics.incr("generated_image_foreign_hosts")
+            status_code, response_headers, body = await self.upstream.fetch(
+                "GET", url,
+                headers=headers,
+                resolve=resolve,
+                max_bytes=config_manager.get("IMAGES.MAX_BYTES", 0),
+                impersonate="chrome133a",
+                timeout=config_manager.get("IMAGES.FETCH_TIMEOUT", 30),
+                **request_options
+            )
+            if status_code != 200:
+                raise ValueError(f"生成图片下载失败，状态码 {status_code}")
+            mime = (response_headers.get("content-type") or "image/jpeg").split(";")[0].strip().lower()
+            # 写文件放到线程池，不阻塞事件循环上的其他流
+            name = await asyncio.get_running_loop().run_in_executor(None, self.cache.put, body, mime)
+            self._remember(path, name)
+            metrics.incr("generated_image_downloads")
+            future.set_result(name)
+            return name
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()
+            raise
+        finally:
+            self._pending.pop(path, None)
+
+
+class ImageCollector:
+    """单个响应中的生成图片：收到图片帧时立即开始下载，按出现顺序在下载完成后输出"""
+
+    def __init__(self, images, headers, request_options, base_url):
+        self.images = images
+        self.headers = headers
+        self.request_options = request_options
+        self.base_url = base_url
+        self.seen = set()
+        self.queue = []
+
+    def add(self, path):
+        if not path or path in self.seen:
+            return
+        self.seen.add(path)
+        self.queue.append(self.images.start(path, self.headers, self.request_options))
+
+    def _render(self, future, timeout):
+        try:
+            name = future.result(timeout)
+        except FutureTimeoutError:
+            raise
+        except Exception as error:
+            logger.error(f"生成图片获取失败: {str(error)}", "Images")
+            metrics.incr("generated_image_errors")
+            return ""
+        return f"\n![image]({self.base_url}/images/{name})\n"
+
+    def ready(self):
+        """已下载完成的图片（保持顺序，遇到未完成的即停止），不阻塞"""
+        while self.queue and self.queue[0].done():
+            text = self._render(self.queue.pop(0), 0)
+            if text:
+                yield text
+
+    def finish(self):
+        """等待剩余图片下载完成"""
+        deadline = time.monotonic() + config_manager.get("IMAGES.FETCH_TIMEOUT", 30)
+        while self.queue:
+            future = self.queue.pop(0)
+            try:
+                text = self._render(future, max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                logger.warning("生成图片下载超时，已跳过", "Images")
+                future.cancel()
+                continue
+            if text:
+                yield text
@@ -0,0 +1,164 @@
+import json
+from config import config_manager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+MESSAGE_ROLES = ("system", "developer", "user", "assistant", "tool", "function")
+# 其他类型的内容部分（如 input_audio）无法转发给上游，解析时直接跳过
+PART_TYPES = ("text", "image_url", "input_text")
+
+# 不上传图片时 image_url 部分只会变成 "[图片]" 占位文本，解析后立即丢弃其中的 base64 内容
+IMAGE_PLACEHOLDER = {"type": "image_url"}
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def loads(data):
+    """优先使用 orjson 解析 bytes，未安装时退回标准库"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as error:
+            raise ValueError(f"请求体不是有效的 JSON: {str(error)}")
+    try:
+        return json.loads(data)
+    except ValueError as error:
+        raise ValueError(f"请求体不是有效的 JSON: {str(error)}")
+
+
+def read_body(request, max_bytes):
+    """按大小上限读取请求体：声明的 Content-Length 超限时不读取正文直接拒绝，分块传输时读到上限即停止"""
+    if request.mimetype and request.mimetype != "application/json":
+        raise ValueError("Content-Type 必须为 application/json")
+    length = request.content_length
+    if max_bytes and length is not None and length > max_bytes:
+        raise BodyTooLarge(f"请求体超过 {max_bytes} 字节")
+
+    if length is not None:
+        return request.get_data(cache=False)
+    # 分块输入流的一次 read 可能只返回一个分块，循环读到结束或超过上限
+    chunks = []
+    size = 0
+    while True:
+        chunk = request.stream.read(65536)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise BodyTooLarge(f"请求体超过 {max_bytes} 字节")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+class ChatMessage:
+    """一条聊天消息；保留 dict 风格的 get / [] 访问，消息处理与计数代码无需区分来源"""
+
+    __slots__ = ("role", "content", "name")
+
+    def __init__(self, role, content, name=None):
+        self.role = role
+        self.content = content
+        self.name = name
+
+    def get(self, key, default=None):
+        if key in ChatMessage.__slots__:
+            value = getattr(self, key)
+            return default if value is None else value
+        return default
+
+    def __getitem__(self, key):
+        if key not in ChatMessage.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+class ChatRequest:
+    """校验后的 /v1/chat/completions 请求；未识别的字段保存在 extra 中"""
+
+    __slots__ = ("model", "messages", "stream", "stream_options", "extra")
+
+    def __init__(self, model, messages, stream=False, stream_options=None, extra=None):
+        self.model = model
+        self.messages = messages
+        self.stream = stream
+        self.stream_options = stream_options
+        self.extra = extra or {}
+
+    def get(self, key, default=None):
+        if key in ChatRequest.__slots__ and key != "extra":
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+def _parse_content(content, index, keep_images):
+    if content is None or isinstance(content, str):
+        return content
+    if isinstance(content, dict):
+        content = [content]
+    if not isinstance(content, list):
+        raise ValueError(f"messages[{index}].content 格式错误")
+
+    parts = []
+    for part in content:
+        kind = part.get("type") if isinstance(part, dict) else None
+        if kind not in PART_TYPES:
+            continue
+        if kind == "image_url":
+            # 只保留对原字符串的引用，不复制 base64 内容；不上传图片时连引用也不保留
+            parts.append(part if keep_images else IMAGE_PLACEHOLDER)
+        elif kind == "input_text":
+            parts.append({"type": "text", "text": part.get("text", "")})
+        else:
+            if not isinstance(part.get("text", ""), str):
+                raise ValueError(f"messages[{index}].content 中的 text 必须为字符串")
+            parts.append(part)
+    return parts
+
+
+def parse_chat_request(data):
+    """把解析后的 JSON 校验并转换为 ChatRequest，格式错误时抛出 ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("请求体必须为 JSON 对象")
+
+    model = data.get("model")
+    if not model:
+        raise ValueError("模型参数缺失")
+    if not config_manager.is_valid_model(model):
+        raise ValueError(f"不支持的模型: {model}")
+
+    raw_messages = data.get("messages")
+    if not raw_messages or not isinstance(raw_messages, list):
+        raise ValueError("消息参数缺失或格式错误")
+    max_messages = config_manager.get("REQUEST.MAX_MESSAGES", 0)
+    if max_messages and len(raw_messages) > max_messages:
+        raise ValueError(f"消息数量超过上限 {max_messages}")
+
+    keep_images = config_manager.get("ATTACHMENTS.ENABLED", True)
+    messages = []
+    for index, message in enumerate(raw_messages):
+        if not isinstance(message, dict):
+            raise ValueError(f"messages[{index}] 必须为对象")
+        role = message.get("role")
+        if role not in MESSAGE_ROLES:
+            raise ValueError(f"messages[{index}].role 无效: {role}")
+        messages.append(ChatMessage(role, _parse_content(message.get("content"), index, keep_images), message.get("name")))
+
+    stream_options = data.get("stream_options")
+    if stream_options is not None and not isinstance(stream_options, dict):
+        raise ValueError("stream_options 格式错误")
+
+    extra = {key: value for key, value in data.items() if key not in ChatRequest.__slots__}
+    return ChatRequest(model, messages, bool(data.get("stream", False)), stream_options, extra)
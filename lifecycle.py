@@ -0,0 +1,210 @@
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from logger import logger
+from config import config_manager
+
+
+# 由 Supervisor 传给工作进程的环境变量：继承的监听 socket 与就绪通知管道
+LISTEN_FD_ENV = "GROK_LISTEN_FD"
+READY_FD_ENV = "GROK_READY_FD"
+
+
+class Lifecycle:
+    """进程生命周期：统计进行中的请求，收到 SIGTERM 后停止接收新请求并等待其结束"""
+
+    def __init__(self):
+        self.state = "starting"
+        self.active = 0
+        self._cond = threading.Condition()
+        self._server = None
+        self._stopped = threading.Event()
+        self._shutdown_hooks = []
+        self._drain_hooks = []
+
+    def on_shutdown(self, hook):
+        self._shutdown_hooks.append(hook)
+
+    def on_drain(self, hook):
+        """开始优雅退出时立即执行的钩子，用于停止后台任务（不等待进行中的请求）"""
+        self._drain_hooks.append(hook)
+
+    def begin(self):
+        with self._cond:
+            self.active += 1
+
+    def end(self):
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            self._cond.notify_all()
+
+    def is_draining(self):
+        return self.state in ("draining", "stopped")
+
+    def wait_idle(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.active > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def drain(self):
+        """停止接收新请求，等待进行中的请求（包括 SSE 流）结束，执行落盘钩子后关闭服务
+
+        单进程运行时继续 accept 以便对新请求和就绪探针返回 503；由 Supervisor 管理时
+        立即停止 accept，把新连接让给共享同一监听 socket 的新工作进程。
+        """
+        if self.is_draining():
+            return
+        self.state = "draining"
+        timeout = config_manager.get("LIFECYCLE.DRAIN_TIMEOUT", 120)
+        logger.info(f"开始优雅退出，等待 {self.active} 个进行中的请求，最长 {timeout} 秒", "Lifecycle")
+
+        supervised = bool(os.environ.get(LISTEN_FD_ENV))
+        if supervised and self._server is not None:
+            # 监听 socket 与新工作进程共享，立即停止 accept，新连接全部由新进程处理
+            self._server.shutdown()
+
+        for hook in self._drain_hooks:
+            try:
+                hook()
+            except Exception as error:
+                logger.error(f"退出钩子执行失败: {str(error)}", "Lifecycle")
+
+        if not self.wait_idle(timeout):
+            logger.warning(f"等待超时，仍有 {self.active} 个请求未结束", "Lifecycle")
+
+        for hook in self._shutdown_hooks:
+            try:
+                hook()
+            except Exception as error:
+                logger.error(f"退出钩子执行失败: {str(error)}", "Lifecycle")
+
+        self.state = "stopped"
+        logger.info("优雅退出完成", "Lifecycle")
+        self._stopped.set()
+        if not supervised and self._server is not None:
+            self._server.shutdown()
+
+    def serve(self, app, host, port, reload_config):
+        """启动 WSGI 服务并注册信号：SIGTERM 优雅退出，SIGHUP 重新加载配置"""
+        from werkzeug.serving import make_server
+
+        listen_fd = os.environ.get(LISTEN_FD_ENV)
+        fd = int(listen_fd) if listen_fd else None
+        self._server = make_server(host, port, app, threaded=True, fd=fd)
+
+        def on_term(signum, frame):
+            # 退出流程在独立线程中执行，信号处理函数立即返回
+            threading.Thread(target=self.drain, name="drain", daemon=True).start()
+
+        def on_hup(signum, frame):
+            threading.Thread(target=reload_config, name="reload", daemon=True).start()
+
+        signal.signal(signal.SIGTERM, on_term)
+        signal.signal(signal.SIGINT, on_term)
+        signal.signal(signal.SIGHUP, on_hup)
+
+        self.state = "running"
+        ready_fd = os.environ.pop(READY_FD_ENV, None)
+        if ready_fd:
+            os.write(int(ready_fd), b"1")
+            os.close(int(ready_fd))
+
+        self._server.serve_forever()
+        # serve_forever 返回后请求线程仍在运行，等待优雅退出流程结束
+        self._stopped.wait()
+
+
+class Supervisor:
+    """主进程持有监听 socket 并管理工作进程
+
+    SIGHUP 时启动新的工作进程（加载新代码和配置），新进程就绪后再让旧进程优雅退出，
+    两者共享同一个监听 socket，切换期间不会拒绝连接，旧进程上的流也会正常结束。
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.worker = None
+        self.retiring = []
+        self._stopping = False
+        self._reloading = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1024)
+        self.sock.set_inheritable(True)
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ, **{LISTEN_FD_ENV: str(self.sock.fileno()), READY_FD_ENV: str(write_fd)})
+        worker = subprocess.Popen(
+            [sys.executable] + sys.argv,
+            env=env,
+            pass_fds=(self.sock.fileno(), write_fd)
+        )
+        os.close(write_fd)
+
+        timeout = config_manager.get("LIFECYCLE.READY_TIMEOUT", 60)
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        ready = bool(readable) and os.read(read_fd, 1) == b"1"
+        os.close(read_fd)
+        if not ready:
+            logger.error(f"工作进程 {worker.pid} 未能在 {timeout} 秒内就绪", "Supervisor")
+            worker.terminate()
+            return None
+        logger.info(f"工作进程 {worker.pid} 已就绪", "Supervisor")
+        return worker
+
+    def reload(self):
+        with self._reloading:
+            worker = self.spawn()
+            if worker is None:
+                logger.warning("新工作进程启动失败，继续使用旧进程", "Supervisor")
+                return
+            old, self.worker = self.worker, worker
+            if old is not None:
+                old.send_signal(signal.SIGTERM)
+                self.retiring.append(old)
+
+    def stop(self):
+        self._stopping = True
+        for worker in [self.worker] + self.retiring:
+            if worker is not None and worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self.reload, daemon=True).start())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+        self.worker = self.spawn()
+        if self.worker is None:
+            sys.exit(1)
+
+        while True:
+            time.sleep(0.5)
+            self.retiring = [worker for worker in self.retiring if worker.poll() is None]
+            if self.worker.poll() is not None:
+                if self._stopping:
+                    break
+                # 工作进程意外退出时重新拉起
+                logger.error(f"工作进程 {self.worker.pid} 退出，退出码 {self.worker.returncode}，重新启动", "Supervisor")
+                worker = self.spawn()
+                if worker is not None:
+                    self.worker = worker
+        for worker in self.retiring:
+            worker.wait()
+        logger.info("主进程退出", "Supervisor")
+
+
+lifecycle = Lifecycle()
@@ -3,6 +3,9 @@ import sys
 import inspect
 
 
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+
 class Logger:
     _instance = None
 
@@ -14,15 +17,28 @@ class Logger:
     def __init__(self):
         if not hasattr(self, 'initialized'):
             self.initialized = True
+            self.level = self._get_log_level_from_env()
+            self._logger = None
+            self._loaded = False
+
+    @property
+    def logger(self):
+        # loguru 在第一条需要输出的日志时才导入，低于当前级别的日志不会触发导入
+        if not self._loaded:
+            self._loaded = True
             self._init_logger()
+        return self._logger
 
     def _init_logger(self):
         try:
             from loguru import logger
-            self.logger = logger
+            self._logger = logger
             self._setup_logger()
         except ImportError:
-            self.logger = None
+            self._logger = None
+
+    def _enabled(self, level):
+        return LEVELS[level] >= LEVELS.get(self.level, 40)
 
     def _get_log_level_from_env(self):
         """从环境变量获取日志级别，避免循环导入"""
@@ -30,10 +46,9 @@ class Logger:
 
     def _setup_logger(self):
         # 移除默认handler
-        self.logger.remove()
+        self._logger.remove()
 
-        # 从环境变量获取日志级别
-        level = self._get_log_level_from_env()
+        level = self.level
 
         # 设置格式
         format = (
@@ -43,7 +58,7 @@ class Logger:
             "<level>{message}</level>"
         )
 
-        self.handler_id = self.logger.add(
+        self.handler_id = self._logger.add(
             sys.stderr,
             level=level,
             format=format,
@@ -54,10 +69,15 @@ class Logger:
 
     def set_level(self, level):
         """动态设置日志级别"""
-        if self.logger and hasattr(self, 'handler_id'):
+        if level.upper() not in LEVELS:
+            return False
+        self.level = level.upper()
+        if not self._loaded:
+            return True
+        if self._logger and hasattr(self, 'handler_id'):
             try:
                 # 移除旧的handler
-                self.logger.remove(self.handler_id)
+                self._logger.remove(self.handler_id)
 
                 # 设置格式
                 format = (
@@ -68,7 +88,7 @@ class Logger:
                 )
 
                 # 添加新的handler
-                self.handler_id = self.logger.add(
+                self.handler_id = self._logger.add(
                     sys.stderr,
                     level=level,
                     format=format,
@@ -101,6 +121,8 @@ class Logger:
             del frame
 
     def info(self, message, source="API"):
+        if not self._enabled("INFO"):
+            return
         if self.logger:
             caller_info = self._get_caller_info()
             self.logger.bind(**caller_info).info(f"[{source}] {message}")
@@ -108,6 +130,8 @@ class Logger:
             print(f"[INFO] [{source}] {message}")
 
     def error(self, message, source="API"):
+        if not self._enabled("ERROR"):
+            return
         if self.logger:
             caller_info = self._get_caller_info()
             if isinstance(message, Exception):
@@ -118,6 +142,8 @@ class Logger:
             print(f"[ERROR] [{source}] {message}")
 
     def warning(self, message, source="API"):
+        if not self._enabled("WARNING"):
+            return
         if self.logger:
             caller_info = self._get_caller_info()
             self.logger.bind(**caller_info).warning(f"[{source}] {message}")
@@ -125,6 +151,8 @@ class Logger:
             print(f"[WARNING] [{source}] {message}")
 
     def debug(self, message, source="API"):
+        if not self._enabled("DEBUG"):
+            return
         if self.logger:
             caller_info = self._get_caller_info()
             self.logger.bind(**caller_info).debug(f"[{source}] {message}")
@@ -2,6 +2,7 @@ import uuid
 import time
 import json
 import re
+import hashlib
 from logger import logger
 from config import config_manager
 
@@ -250,10 +251,14 @@ class MessageProcessor:
         return base_request
     
     @staticmethod
-    def process_model_response(response, model):
-        result = {"token": None}
-        
-        if model in ["grok-3", "grok-4", "grok-4-fast"]:
-            result["token"] = response.get("token")
-        
-        return result
+    def conversation_fingerprint(messages):
+        """以系统消息和第一条用户消息作为会话指纹，多轮对话中保持不变"""
+        digest = hashlib.sha1()
+        for message in messages:
+            role = message.get("role")
+            if role in ("system", "user"):
+                digest.update(role.encode("utf-8"))
+                digest.update(json.dumps(message.get("content", ""), ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            if role == "user":
+                break
+        return digest.hexdigest()
@@ -0,0 +1,33 @@
+import threading
+import time
+from collections import defaultdict
+
+
+class Metrics:
+    """进程内计数器，供管理接口查看请求量、上游状态码与耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.started = time.time()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        # 累计 sum/count，平均值在 snapshot 中计算
+        with self._lock:
+            self.counters[f"{name}_sum"] += value
+            self.counters[f"{name}_count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "uptime": int(time.time() - self.started),
+            "counters": counters
+        }
+
+
+metrics = Metrics()
@@ -0,0 +1,120 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+# 叶子帧位于这些标准库文件中时视为空闲（等待锁、队列、socket 或 select）
+IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "socket.py", "socketserver.py", "ssl.py")
+IDLE_FUNCTIONS = ("sleep", "wait", "select", "poll", "accept", "recv", "recv_into", "readline", "_wait_for_tstate_lock")
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def is_idle(frame):
+    code = frame.f_code
+    return os.path.basename(code.co_filename) in IDLE_FILES or code.co_name in IDLE_FUNCTIONS
+
+
+def thread_group(name):
+    # 同类线程合并为一组：Thread-12 (process_request_thread) -> Thread-N (process_request_thread)
+    return re.sub(r"\d+", "N", name)
+
+
+class SamplingProfiler:
+    """按需运行的统计采样分析器
+
+    采样期间定时读取所有线程的当前栈（sys._current_frames），不安装 trace/profile 钩子，
+    对被采样线程几乎没有额外开销；未运行时不存在任何后台线程。同一时间只允许一个采样任务。
+    """
+
+    def __init__(self):
+        self._running = threading.Lock()
+
+    def is_running(self):
+        return self._running.locked()
+
+    def profile(self, seconds, interval=0.01, include_idle=False):
+        """在调用线程中采样 seconds 秒，返回折叠栈计数及统计；已有采样任务时返回 None"""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            return self._sample(seconds, interval, include_idle)
+        finally:
+            self._running.release()
+
+    def _sample(self, seconds, interval, include_idle):
+        own = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        idle = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        sampling_cost = 0.0
+
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                samples += 1
+                if is_idle(frame):
+                    idle += 1
+                    if not include_idle:
+                        continue
+                labels = []
+                while frame is not None:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                labels.append(thread_group(names.get(ident, str(ident))))
+                stacks[";".join(reversed(labels))] += 1
+            sampling_cost += time.perf_counter() - now
+            time.sleep(max(0.0, interval - (time.perf_counter() - now)))
+
+        duration = time.perf_counter() - started
+        return {
+            "duration": round(duration, 3),
+            "interval": interval,
+            "samples": samples,
+            "idle_samples": idle,
+            # 采样线程自身占用的时间比例，用于确认分析本身的开销
+            "overhead": round(sampling_cost / duration, 4) if duration else 0,
+            "stacks": stacks
+        }
+
+
+def collapsed(stacks):
+    """flamegraph.pl / speedscope 可直接读取的折叠栈文本"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def thread_snapshot():
+    """每个线程的名称、是否空闲以及当前执行位置（最内层的若干帧）"""
+    frames = sys._current_frames()
+    threads = []
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stack = []
+        current = frame
+        while current is not None and len(stack) < 8:
+            stack.append(f"{frame_label(current)}:{current.f_lineno}")
+            current = current.f_back
+        threads.append({
+            "name": thread.name,
+            "ident": thread.ident,
+            "daemon": thread.daemon,
+            "state": "idle" if frame is not None and is_idle(frame) else "busy",
+            "stack": stack
+        })
+    return threads
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,119 @@
+from collections import deque
+from config import config_manager
+
+
+class RateEstimator:
+    """单个令牌在单个模型上的配额估计（AIMD）
+
+    记录窗口内的成功请求时间；首次收到 429 时以窗口内成功数作为上限，之后再遇到 429
+    则乘性下调，每次成功加性上调 1/limit（约每个窗口 +1）以试探配额是否上涨。处于冷却期时不再放行，
+    冷却结束时间按窗口内最早一次成功请求滑出窗口的时刻预测，没有 Retry-After 时最长 MAX_COOLDOWN 秒。
+    达到估计上限后每 PROBE_INTERVAL 秒放行一个探测请求，探测成功时上限翻倍，偶发的错误不会让令牌闲置整个窗口。
+    """
+    __slots__ = ("window", "limit", "successes", "cooling_until", "backoff", "rate_limited", "probe_at", "probing")
+
+    def __init__(self, window):
+        self.window = window
+        self.limit = None
+        self.successes = deque()
+        self.cooling_until = 0.0
+        self.backoff = 0.0
+        self.rate_limited = 0
+        self.probe_at = 0.0
+        self.probing = False
+
+    def _prune(self, now):
+        cutoff = now - self.window
+        successes = self.successes
+        while successes and successes[0] <= cutoff:
+            successes.popleft()
+
+    def _at_limit(self, now):
+        if self.limit is None:
+            return False
+        self._prune(now)
+        return len(self.successes) >= self.limit
+
+    def admit(self, now):
+        if now < self.cooling_until:
+            return False
+        return not self._at_limit(now) or now >= self.probe_at
+
+    def on_acquired(self, now):
+        """令牌被选中时调用：超出估计上限放行的请求记为探测，下一次探测至少间隔 PROBE_INTERVAL 秒"""
+        if self._at_limit(now):
+            self.probing = True
+            self.probe_at = now + config_manager.get("RATE_LIMIT.PROBE_INTERVAL", 60)
+
+    def on_success(self, now):
+        self._prune(now)
+        self.successes.append(now)
+        self.backoff = 0.0
+        if self.limit is None:
+            return
+        if self.probing:
+            # 探测成功：配额已恢复或被低估，按窗口内实际成功数翻倍放宽，真实上限由下一次 429 重新学习
+            self.probing = False
+            self.limit = max(self.limit, float(len(self.successes))) * 2
+        else:
+            self.limit += config_manager.get("RATE_LIMIT.INCREASE", 1.0) / self.limit
+
+    def on_rate_limited(self, now, retry_after=None):
+        self._prune(now)
+        self.rate_limited += 1
+        self.probing = False
+        observed = len(self.successes)
+        if self.limit is None:
+            # 首次 429：窗口内的成功数就是观测到的上限
+            self.limit = float(max(1, observed)) if observed else None
+        else:
+            decreased = self.limit * config_manager.get("RATE_LIMIT.DECREASE", 0.9)
+            self.limit = max(1.0, float(min(observed, decreased)) if observed else decreased)
+
+        max_cooldown = min(config_manager.get("RATE_LIMIT.MAX_COOLDOWN", 300), self.window)
+        if retry_after:
+            self.cooling_until = now + retry_after
+        elif observed:
+            # 窗口内最早的成功请求滑出窗口时才会空出一个名额；之后由探测请求确认
+            self.cooling_until = min(self.successes[0] + self.window, now + max_cooldown)
+        else:
+            # 窗口内没有成功记录（额度被其他客户端用掉），指数退避
+            min_cooldown = config_manager.get("RATE_LIMIT.MIN_COOLDOWN", 60)
+            self.backoff = min(max(self.backoff * 2, min_cooldown), max_cooldown)
+            self.cooling_until = now + self.backoff
+
+    def next_available(self, now):
+        """预测的恢复时间（单调时钟），当前可用时返回 now"""
+        if now < self.cooling_until:
+            return self.cooling_until
+        if self.limit is None:
+            return now
+        self._prune(now)
+        excess = len(self.successes) - int(self.limit)
+        if excess < 0:
+            return now
+        return min(self.successes[excess] + self.window, max(now, self.probe_at))
+
+    def snapshot(self, now):
+        self._prune(now)
+        return {
+            "limit": round(self.limit, 2) if self.limit is not None else None,
+            "used": len(self.successes),
+            "window": self.window,
+            "rate_limited": self.rate_limited,
+            "cooling": now < self.cooling_until,
+            "recover_in": round(max(0.0, self.next_available(now) - now), 1)
+        }
+
+
+def parse_retry_after(headers):
+    value = headers.get("retry-after") if headers else None
+    try:
+        return max(0, int(value)) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def model_window(model):
+    windows = config_manager.get("RATE_LIMIT.WINDOWS", {})
+    return windows.get(model, config_manager.get("RATE_LIMIT.WINDOW", 7200))
@@ -1,16 +1,38 @@
 import json
 import time
-from flask import stream_with_context, Response, jsonify
-from curl_cffi import requests as curl_requests
+from flask import stream_with_context, Response, jsonify, request, has_request_context, g
 from logger import logger
 from config import config_manager
 from token_manager import AuthTokenManager
 from message_processor import MessageProcessor
+from upstream import UpstreamClient, StreamDropped
+from attachments import AttachmentUploader, AttachmentError, UploadError, ImageRef, image_urls
+from image_cache import GeneratedImages, ImageCollector
+from context import trim_messages
+from failover import Splicer, StreamFailover
+from capture import recorder
+from metrics import metrics
+from rate_limiter import parse_retry_after
+from stream_pipeline import build_pipeline
+from tokenizer import StreamCounter, count_messages, count_tokens, make_usage
+from scheduler import PriorityScheduler, QueueTimeout
+
+
+class RetryableError(ValueError):
+    """暂时性失败（令牌不足、限流、被抢占或上游异常），稍后重试可能成功"""
+
+
+class NoTokenError(RetryableError):
+    """没有可用令牌，不再重试"""
 
 
 class RequestHandler:
     def __init__(self, token_manager: AuthTokenManager):
         self.token_manager = token_manager
+        self.upstream = UpstreamClient()
+        self.attachments = AttachmentUploader(self.upstream)
+        self.generated_images = GeneratedImages(self.upstream)
+        self.scheduler = PriorityScheduler()
         
         self.default_headers = {
             'Accept': '*/*',
@@ -50,77 +72,152 @@ class RequestHandler:
                 proxy_options["proxies"] = {"https": proxy, "http": proxy}     
         return proxy_options
 
-    def handle_non_stream_response(self, response, model):
+    def warm_up(self):
+        """后台预热上游连接池"""
+        count = config_manager.get("UPSTREAM.WARMUP_CONNECTIONS", 0)
+        if count <= 0:
+            self.upstream.mark_ready()
+            return
+
+        headers = {k: v for k, v in self.default_headers.items() if k != 'Content-Type'}
+        self.upstream.warm_up(
+            config_manager.get('API.BASE_URL'),
+            count,
+            headers=headers,
+            impersonate="chrome133a",
+            timeout=10,
+            **self.get_proxy_options()
+        )
+
+    def send_conversation(self, token, request_payload):
+        """使用指定令牌向上游发起新会话请求"""
+        return self.upstream.post(
+            f"{config_manager.get('API.BASE_URL')}/rest/app-chat/conversations/new",
+            headers={
+                **self.default_headers,
+                "Cookie": token
+            },
+            data=json.dumps(request_payload),
+            impersonate="chrome133a",
+            timeout=10,
+            **self.get_proxy_options()
+        )
+
+    def probe_token(self, token, model="grok-3"):
+        """使用指定令牌发送探测请求，不修改令牌管理器的共享状态，返回结果及耗时"""
+        started = time.perf_counter()
+        request_payload = MessageProcessor.prepare_chat_messages([{"role": "user", "content": "hi"}], model)
+        response = self.send_conversation(token, request_payload)
+        headers_ms = int((time.perf_counter() - started) * 1000)
+
+        if response.status_code != 200:
+            response.close()
+            return {
+                "success": False,
+                "status_code": response.status_code,
+                "error": f"上游返回状态码 {response.status_code}",
+                "headers_ms": headers_ms,
+                "latency_ms": headers_ms
+            }
+
+        # 探测请求不计入全局用量指标
+        result = self.handle_non_stream_response(response, model, record_usage=False)
+        success = bool(result and result.get("choices"))
+        return {
+            "success": success,
+            "status_code": 200,
+            "error": None if success else "响应格式异常",
+            "headers_ms": headers_ms,
+            "latency_ms": int((time.perf_counter() - started) * 1000)
+        }
+
+    def iter_text_events(self, response, model):
+        """按模型注册表组装的流水线逐个产出事件，upstream error 帧记录日志后原样交给调用方"""
+        for kind, data in build_pipeline(model)(response.iter_lines()):
+            if kind == "error":
+                metrics.incr("upstream_error_frames")
+                logger.error(json.dumps(data, indent=2), "Server")
+            yield kind, data
+
+    def build_final_message(self, model, model_response, streamed_text):
+        # 如果有 modelResponse，优先使用它的内容
+        if model_response:
+            if config_manager.is_reasoning_model(model) and model_response.get("thinkingTrace"):
+                # 对于推理模型，将思考内容包装在 think 标签中
+                return f"<think>{model_response['thinkingTrace']}</think>{model_response.get('message', '')}"
+            return model_response.get('message', '')
+
+        # 如果没有 modelResponse，使用流水线拼接的内容（已包含 think 标签）
+        return streamed_text
+
+    def report_usage(self, model, messages, completion_tokens, on_usage=None):
+        """请求结束后再计算 prompt token（消息级缓存），计入指标并回调给调用方记账"""
+        usage = make_usage(count_messages(messages), completion_tokens)
+        metrics.incr("prompt_tokens", usage["prompt_tokens"])
+        metrics.incr("completion_tokens", usage["completion_tokens"])
+        metrics.incr(f"completion_tokens_{model}", usage["completion_tokens"])
+        if on_usage is not None:
+            try:
+                on_usage(usage)
+            except Exception as error:
+                logger.error(f"用量记录失败: {str(error)}", "Server")
+        return usage
+
+    def handle_non_stream_response(self, response, model, messages=None, on_usage=None, images=None,
+                                   record_usage=True, on_error=None):
         try:
             logger.info("开始处理非流式响应（拼接流式内容）", "Server")
-            
-            # 解析流式响应的所有行，拼接完整内容和思考内容
-            stream = response.iter_lines()
-            full_content = ""
-            thinking_content = ""
-            model_response = None
-            
-            for chunk in stream:
-                if not chunk:
-                    continue
-                try:
-                    line_json = json.loads(chunk.decode("utf-8").strip())
-                    
-                    if line_json.get("error"):
-                        logger.error(json.dumps(line_json, indent=2), "Server")
-                        raise ValueError("RateLimitError")
-                        
-                    response_data = line_json.get("result", {}).get("response")
-                    if not response_data:
-                        continue
-                    
-                    # 处理 grok-4 和 grok-4-fast 的思考内容
-                    if model in ["grok-4", "grok-4-fast"]:
-                        # 收集思考内容 (isThinking: true)
-                        if response_data.get("isThinking") and response_data.get("token"):
-                            thinking_content += response_data["token"]
 
-                        # 收集最终内容 (isThinking: false, messageTag: "final")
-                        elif not response_data.get("isThinking") and response_data.get("messageTag") == "final" and response_data.get("token"):
-                            full_content += response_data["token"]
+            # 聚合流水线的输出：按块收集内容，最后一次性拼接，避免逐帧字符串累加
+            max_chars = config_manager.get("RESPONSE.MAX_CHARS", 0)
+            parts = []
+            size = 0
+            truncated = False
+            think_open = False
+            model_response = None
 
-                    # 处理 grok-3 和其他非推理模型
-                    else:
-                        # 获取token并拼接内容
-                        token = response_data.get("token", "")
-                        if token:
-                            full_content += token
-                    
-                    # 检查是否有最终响应（modelResponse）
-                    if response_data.get("modelResponse"):
-                        model_response = response_data["modelResponse"]
-                        break
-                        
-                except json.JSONDecodeError:
+            for kind, value in self.iter_text_events(response, model):
+                if kind == "model_response":
+                    model_response = value
+                    break
+                if kind == "tag":
+                    think_open = value == "<think>"
+                    parts.append(value)
                     continue
-                except Exception as e:
-                    logger.error(f"处理非流式响应行时出错: {str(e)}", "Server")
+                if kind == "image":
+                    if images is not None:
+                        images.add(value)
                     continue
-            
-            # 如果有 modelResponse，优先使用它的内容
-            if model_response:
-                if model in ["grok-4", "grok-4-fast"] and model_response.get("thinkingTrace"):
-                    # 对于推理模型，将思考内容包装在 think 标签中
-                    thinking_trace = model_response["thinkingTrace"]
-                    final_message = f"<think>{thinking_trace}</think>{model_response.get('message', '')}"
-                else:
-                    final_message = model_response.get('message', '')
-            else:
-                # 如果没有 modelResponse，手动拼接内容
-                if model in ["grok-4", "grok-4-fast"] and thinking_content:
-                    final_message = f"<think>{thinking_content}</think>{full_content}"
-                else:
-                    final_message = full_content
+                if kind == "error":
+                    # 与流式响应一致，error 帧按限流记入该令牌
+                    if on_error is not None:
+                        on_error()
+                        on_error = None
+                    continue
+
+                size += len(value)
+                if max_chars and size > max_chars:
+                    truncated = True
+                    logger.warning(f"响应内容超过上限 {max_chars} 字符，已截断", "Server")
+                    if think_open:
+                        parts.append("</think>")
+                    break
+                parts.append(value)
+
+            final_message = self.build_final_message(model, None if truncated else model_response, "".join(parts))
             
             if not final_message:
                 logger.warning("未找到响应内容", "Server")
                 final_message = ""
+            if images is not None:
+                final_message += "".join(images.finish())
             
+            completion_tokens = count_tokens(final_message)
+            if record_usage:
+                usage = self.report_usage(model, messages, completion_tokens, on_usage)
+            else:
+                usage = make_usage(count_messages(messages), completion_tokens)
+
             # 构建标准OpenAI兼容格式响应
             openai_response = {
                 "id": f"chatcmpl-{int(time.time())}",
@@ -134,14 +231,10 @@ class RequestHandler:
                             "role": "assistant",
                             "content": final_message
                         },
-                        "finish_reason": "stop"
+                        "finish_reason": "length" if truncated else "stop"
                     }
                 ],
-                "usage": {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
-                }
+                "usage": usage
             }
             
             logger.info(f"成功构建OpenAI响应，内容长度: {len(final_message)}", "Server")
@@ -150,74 +243,220 @@ class RequestHandler:
         except Exception as error:
             logger.error(f"处理非流式响应时出错: {str(error)}", "Server")
             raise
+        finally:
+            response.close()
 
-    def handle_stream_response(self, response, model):
+    def stream_non_stream_response(self, response, model, messages=None, on_usage=None, images=None, on_error=None):
+        """以增量方式输出非流式响应的 JSON 正文，不在内存中拼出完整回复"""
         def generate():
-            logger.info("开始处理流式响应", "Server")
+            max_chars = config_manager.get("RESPONSE.MAX_CHARS", 0)
+            created = int(time.time())
+            size = 0
+            finish_reason = "stop"
+            think_open = False
+            tagged = False
+            counter = StreamCounter()
 
-            try:
-                stream = response.iter_lines()
-                thinking_started = False
-                thinking_ended = False
+            def escape(text):
+                counter.feed(text)
+                return json.dumps(text)[1:-1]
 
-                for chunk in stream:
-                    if not chunk:
+            head = json.dumps({
+                "id": f"chatcmpl-{created}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model
+            })
+            yield head[:-1] + ', "choices": [{"index": 0, "message": {"role": "assistant", "content": "'
+
+            try:
+                for kind, value in self.iter_text_events(response, model):
+                    if kind == "model_response":
+                        # 没有收到任何增量时，才使用 modelResponse 的完整内容；已输出的思考标签不再重复输出
+                        if size == 0 and not tagged:
+                            yield escape(self.build_final_message(model, value, ""))
+                        elif size == 0:
+                            if think_open:
+                                think_open = False
+                                yield escape(f"{value.get('thinkingTrace', '')}</think>")
+                            yield escape(value.get("message", ""))
+                        break
+                    if kind == "error":
+                        if on_error is not None:
+                            on_error()
+                            on_error = None
+                        continue
+                    if kind == "image":
+                        if images is not None:
+                            images.add(value)
+                        continue
+                    if kind == "tag":
+                        think_open = value == "<think>"
+                        tagged = True
+                        yield escape(value)
                         continue
-                    try:
-                        line_json = json.loads(chunk.decode("utf-8").strip())
 
-                        if line_json.get("error"):
-                            logger.error(json.dumps(line_json, indent=2), "Server")
-                            yield f"data: {json.dumps({'error': {'message': 'RateLimitError', 'type': 'rate_limit_error'}})}\n\n"
-                            return
+                    size += len(value)
+                    if max_chars and size > max_chars:
+                        finish_reason = "length"
+                        logger.warning(f"响应内容超过上限 {max_chars} 字符，已截断", "Server")
+                        break
+                    yield escape(value)
+            except Exception as e:
+                finish_reason = "error"
+                logger.error(f"处理非流式响应时出错: {str(e)}", "Server")
+            finally:
+                response.close()
 
-                        response_data = line_json.get("result", {}).get("response")
-                        if not response_data:
+            if think_open:
+                yield escape("</think>")
+            if images is not None:
+                for text in images.finish():
+                    yield json.dumps(text)[1:-1]
+            usage = self.report_usage(model, messages, counter.total(), on_usage)
+            yield f'"}}, "finish_reason": "{finish_reason}"}}], "usage": {json.dumps(usage)}}}'
+
+        return generate()
+
+    def stream_deltas(self, response, model, messages=None, on_usage=None, images=None, failover=None,
+                      on_response=None, on_error=None):
+        """流式响应的核心处理，与输出格式无关（SSE 与 WebSocket 共用）
+
+        依次产生 ("delta", 文本)；正常结束时产生 ("usage", usage)；上游限流且无法续写时产生 ("rate_limited", None) 后结束。
+        on_response 在每次开始读取一个上游响应（包括续写）时调用，供调用方在取消时关闭该响应。
+        on_error 在没有 failover 时收到 error 帧后调用（有 failover 时由其记录当前令牌的限流）。
+        """
+        logger.info("开始处理流式响应", "Server")
+        counter = StreamCounter()
+        reported = False
+        current = response
+        coalesce = current.buffer.policy == "coalesce"
+        pending = []
+        # 已发给客户端的正文（不含思考内容），中途失败时作为续写的前文
+        relayed = []
+        think_open = False
+        resumed = False
+        splicer = None
+        if on_response is not None:
+            on_response(current)
+
+        try:
+            while True:
+                failure = None
+                try:
+                    for kind, value in self.iter_text_events(current, model):
+                        if kind == "error":
+                            failure = "error"
+                            break
+                        if kind == "model_response":
+                            continue
+                        if kind == "image":
+                            # 图片在后台下载，下载完成后插在随后的正文之间输出
+                            if images is not None:
+                                images.add(value)
                             continue
+                        if kind in ("tag", "thinking"):
+                            # 续写的流只接正文，思考部分已在中断时结束
+                            if resumed:
+                                continue
+                            if kind == "tag":
+                                think_open = value == "<think>"
+                        elif kind == "content":
+                            if splicer is not None:
+                                value = splicer.feed(value)
+                                if not value:
+                                    continue
+                            relayed.append(value)
+                        if images is not None and images.queue and images.queue[0].done():
+                            if pending:
+                                yield "delta", "".join(pending)
+                                pending = []
+                            for text in images.ready():
+                                yield "delta", text
+                        counter.feed(value)
+                        if coalesce:
+                            # 客户端跟不上时把积压的增量合并成一个事件，减少写出次数和字节数
+                            pending.append(value)
+                            if current.backlogged():
+                                continue
+                            value = "".join(pending)
+                            pending = []
+                        yield "delta", value
+                except StreamDropped:
+                    # 慢客户端被断开时直接结束，不换令牌续写
+                    raise
+                except Exception as e:
+                    if failover is None:
+                        raise
+                    failure = str(e) or type(e).__name__
 
-                        # 处理 grok-4 和 grok-4-fast 的特殊流式响应
-                        if model in ["grok-4", "grok-4-fast"]:
-                            # 处理思考内容的开始
-                            if response_data.get("isThinking") and not thinking_started:
-                                thinking_started = True
-                                # 发送开始思考标签
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response('<think>', model, True))}\n\n"
-
-                            # 处理思考过程中的内容（显示给用户，仅在思考阶段，过滤header内容和工具使用标签）
-                            if response_data.get("isThinking") and not thinking_ended and response_data.get("messageTag") != "header":
-                                # 处理工具响应内容，包括web搜索结果
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:  # 只输出非空内容
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                            # 处理思考结束，准备最终内容（只有当有实际的最终内容时才结束思考）
-                            elif not response_data.get("isThinking") and thinking_started and not thinking_ended and response_data.get("messageTag") == "final" and response_data.get("token"):
-                                thinking_ended = True
-                                # 发送结束思考标签
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response('</think>', model, True))}\n\n"
-                                # 处理工具响应内容，发送最终内容
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                            # 处理最终内容的后续部分（思考结束后的纯回复）
-                            elif not response_data.get("isThinking") and thinking_ended and response_data.get("messageTag") == "final":
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                        # 处理 grok-3 和其他非推理模型
-                        else:
-                            result = MessageProcessor.process_model_response(response_data, model)
-                            if result["token"]:
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response(result['token'], model, True))}\n\n"
+                if failure is None:
+                    if splicer is not None:
+                        tail = splicer.flush()
+                        if tail:
+                            relayed.append(tail)
+                            counter.feed(tail)
+                            pending.append(tail)
+                    break
 
-                    except json.JSONDecodeError:
-                        continue
-                    except Exception as e:
-                        logger.error(f"处理流式响应行时出错: {str(e)}", "Server")
-                        continue
+                current.close()
+                next_response = failover.reopen("".join(relayed), failure) if failover is not None else None
+                if next_response is None:
+                    if pending:
+                        yield "delta", "".join(pending)
+                    if failure == "error":
+                        if failover is None and on_error is not None:
+                            on_error()
+                        yield "rate_limited", None
+                        return
+                    raise RuntimeError(failure)
+
+                if think_open:
+                    # 中断时仍在思考，先结束思考标签，续写只输出正文
+                    think_open = False
+                    pending.append("</think>")
+                current = next_response
+                if on_response is not None:
+                    on_response(current)
+                resumed = True
+                splicer = Splicer("".join(relayed))
+                if images is not None:
+                    images.headers = {**images.headers, "Cookie": failover.token}
 
+            if pending:
+                yield "delta", "".join(pending)
+            if images is not None:
+                for text in images.finish():
+                    yield "delta", text
+
+            usage = self.report_usage(model, messages, counter.total(), on_usage)
+            reported = True
+            yield "usage", usage
+        finally:
+            current.close()
+            # 中途断开或出错的流也按已输出的内容计费
+            if not reported:
+                self.report_usage(model, messages, counter.total(), on_usage)
+
+    def handle_stream_response(self, response, model, messages=None, include_usage=False, on_usage=None, images=None,
+                               failover=None, on_error=None):
+        def generate():
+            def chunk(text):
+                return f"data: {json.dumps(MessageProcessor.create_chat_response(text, model, True))}\n\n"
+
+            events = self.stream_deltas(response, model, messages, on_usage, images, failover, on_error=on_error)
+            try:
+                for kind, value in events:
+                    if kind == "delta":
+                        yield chunk(value)
+                    elif kind == "rate_limited":
+                        yield f"data: {json.dumps({'error': {'message': 'RateLimitError', 'type': 'rate_limit_error'}})}\n\n"
+                        return
+                    elif include_usage:
+                        # stream_options.include_usage：最后一个数据块只携带 usage，choices 为空
+                        usage_chunk = MessageProcessor.create_chat_response("", model, True)
+                        usage_chunk.update({"choices": [], "usage": value})
+                        yield f"data: {json.dumps(usage_chunk)}\n\n"
                 yield "data: [DONE]\n\n"
 
             except Exception as e:
@@ -225,57 +464,250 @@ class RequestHandler:
                 # 发送错误响应
                 yield f"data: {json.dumps({'error': {'message': f'Stream processing error: {str(e)}', 'type': 'stream_error'}})}\n\n"
                 yield "data: [DONE]\n\n"
+            finally:
+                events.close()
 
         return generate()
 
-    def make_grok_request(self, data, model, stream=False):
+    def read_passthrough_head(self, response):
+        """读取到第一个完整帧为止，首帧为 error 帧时返回 None"""
+        parts = []
+        chunks = response.iter_content()
+        for chunk in chunks:
+            parts.append(chunk)
+            if b"\n" in chunk:
+                break
+        head = b"".join(parts)
+        first_line = head.split(b"\n", 1)[0]
+
+        if b'"error"' in first_line:
+            try:
+                if json.loads(first_line).get("error"):
+                    logger.error(first_line.decode("utf-8", "replace"), "Server")
+                    response.close()
+                    return None
+            except ValueError:
+                pass
+        return head
+
+    def handle_passthrough_response(self, response, head):
+        """原样转发上游 NDJSON 字节，只扫描 error 帧，不做解码和重新序列化"""
+        def generate():
+            sent = len(head)
+            tail = b""
+            try:
+                yield head
+                for chunk in response.iter_content():
+                    # 帧可能跨块切分，拼上前一块的末尾再查找
+                    if b'"error"' in chunk or (tail and b'"error"' in tail + chunk[:7]):
+                        metrics.incr("upstream_error_frames")
+                        logger.error("透传流中收到上游 error 帧", "Server")
+                    tail = chunk[-7:]
+                    sent += len(chunk)
+                    yield chunk
+            except Exception as e:
+                logger.error(f"透传响应处理异常: {str(e)}", "Server")
+            finally:
+                metrics.incr("stream_bytes", sent)
+                response.close()
+
+        return generate()
+
+    def open_stream(self, messages, model, tried_tokens, images=None, priority="normal", max_inflight=None,
+                    healthy_only=False, affinity_key=None, acquire_timeout=0, capture=None, untried_only=False):
+        """换一个未试过的令牌发起一次会话请求，返回 (响应, 令牌)；没有可用令牌时返回 None
+
+        非 200 的响应已关闭（429 已记录限流），由调用方按状态码决定是否重试。
+        untried_only 时只使用 tried_tokens 之外的令牌，否则都试过后可退回已试过的令牌。
+        """
+        # 先选择令牌再经过优先级调度拿上游名额：等待令牌并发名额（批处理最长 acquire_timeout 秒）时不占用上游名额
+        token = self.token_manager.get_next_token_for_model(
+            model, max_inflight=max_inflight, healthy_only=healthy_only, timeout=acquire_timeout,
+            affinity_key=affinity_key, exclude=tried_tokens, untried_only=untried_only
+        )
+        if not token:
+            return None
+        tried_tokens.add(token)
+        try:
+            has_slot = self.scheduler.acquire(priority)
+        except Exception:
+            self.token_manager.release_token(token)
+            raise
+
+        config_manager.set("API.SIGNATURE_COOKIE", token)
+        logger.info(f"当前令牌: {token[:50]}...", "Server")
+
+        response = None
+        try:
+            # 附件按令牌缓存，先在后台开始上传，与组装请求体并行
+            uploads = None
+            if images:
+                uploads = self.attachments.start(
+                    self.token_manager.token_id(token), images,
+                    {**self.default_headers, "Cookie": token}, self.get_proxy_options()
+                )
+            request_payload = MessageProcessor.prepare_chat_messages(messages, model)
+            if uploads is not None:
+                request_payload["fileAttachments"] = uploads.result()
+            if capture is not None:
+                capture.payload(request_payload)
+
+            started = time.perf_counter()
+            response = self.send_conversation(token, request_payload)
+            # 响应读完或被关闭时归还令牌的并发名额和调度名额
+            response.on_close(lambda token=token, has_slot=has_slot: self.release_slot(token, has_slot))
+            if capture is not None:
+                capture.upstream(response, self.token_manager.token_id(token))
+        except Exception:
+            if response is None:
+                self.release_slot(token, has_slot)
+            else:
+                response.close()
+            raise
+        metrics.observe("upstream_headers_ms", (time.perf_counter() - started) * 1000)
+        metrics.incr(f"upstream_status_{response.status_code}")
+        metrics.incr(f"upstream_http_{response.http_version or 'unknown'}")
+        logger.info(f"请求状态码: {response.status_code}", "Server")
+
+        if response.status_code != 200:
+            response.close()
+            if response.status_code == 429:
+                self.token_manager.record_rate_limited(token, model, parse_retry_after(response.headers))
+        return response, token
+
+    def image_base_url(self):
+        """生成图片地址的前缀：优先使用配置，其次是当前请求的 Host（批处理等无请求上下文时为相对地址）"""
+        public_url = config_manager.get("IMAGES.PUBLIC_URL")
+        if public_url:
+            return public_url
+        if has_request_context():
+            return request.host_url.rstrip("/")
+        return ""
+
+    @staticmethod
+    def captured(capture, output):
+        """被采样的请求在输出的同时记录发给客户端的内容"""
+        return output if capture is None else capture.wrap(output)
+
+    def release_slot(self, token, has_slot):
+        self.token_manager.release_token(token)
+        if has_slot:
+            self.scheduler.release()
+
+    def make_grok_request(self, data, model, stream=False, passthrough=False, stream_body=False,
+                          max_inflight=None, healthy_only=False, acquire_timeout=0, priority="normal",
+                          affinity_key=None, on_usage=None, events=False, on_response=None):
         response_status_code = 500
+        metrics.incr("requests_total")
+        if passthrough:
+            metrics.incr("passthrough_requests")
         
+        # 被采样的请求记录上游请求体、原始帧和输出，见 capture.py
+        capture = recorder.start(model, stream or passthrough)
         try:
             retry_count = 0
+            tried_tokens = set()
+            # 超出上下文预算的历史先裁剪，之后的图片、请求体和用量统计都基于裁剪后的消息
+            messages, trim = trim_messages(data.get("messages", []), model)
+            if trim is not None:
+                logger.info(f"上下文已裁剪: {trim.header()}", "Server")
+                if has_request_context():
+                    g.context_trim = trim
+            # 重复出现的同一图片地址只处理一次；解码或下载的内容在重试时复用
+            images = []
+            if config_manager.get("ATTACHMENTS.ENABLED", True):
+                images = [ImageRef(url) for url in dict.fromkeys(image_urls(messages))]
             
             while retry_count < config_manager.get("RETRY.MAX_ATTEMPTS", 2):
                 retry_count += 1
+                if retry_count > 1:
+                    # 有更高优先级的请求在排队时，低优先级请求不再发起重试
+                    if self.scheduler.has_higher_waiters(priority):
+                        metrics.incr("retries_preempted")
+                        raise RetryableError('上游繁忙，低优先级请求已放弃重试')
+                    metrics.incr("retries")
                 
-                token = self.token_manager.get_next_token_for_model(model)
-                if not token:
-                    raise ValueError('无可用令牌')
-                
-                config_manager.set("API.SIGNATURE_COOKIE", token)
-                logger.info(f"当前令牌: {token[:50]}...", "Server")
-                
+                response = None
                 try:
-                    request_payload = MessageProcessor.prepare_chat_messages(data.get("messages", []), model)
-                    
-                    proxy_options = self.get_proxy_options()
-                    response = curl_requests.post(
-                        f"{config_manager.get('API.BASE_URL')}/rest/app-chat/conversations/new",
-                        headers={
-                            **self.default_headers,
-                            "Cookie": token
-                        },
-                        data=json.dumps(request_payload),
-                        impersonate="chrome133a",
-                        stream=True,
-                        timeout=10,
-                        **proxy_options
+                    opened = self.open_stream(
+                        messages, model, tried_tokens, images, priority, max_inflight, healthy_only,
+                        affinity_key, acquire_timeout, capture
                     )
-                    
-                    logger.info(f"请求状态码: {response.status_code}", "Server")
+                    if opened is None:
+                        recover_in = self.token_manager.next_recovery(model)
+                        if recover_in > 0:
+                            metrics.incr("rate_limit_paced")
+                            raise NoTokenError(f'令牌配额已用完，预计 {int(recover_in) + 1} 秒后恢复')
+                        raise NoTokenError('无可用令牌')
+                    response, token = opened
                     
                     if response.status_code == 200:
                         response_status_code = 200
                         logger.info("请求成功", "Server")
                         
+                        if passthrough:
+                            head = self.read_passthrough_head(response)
+                            if head is None:
+                                # 首帧即为 error 帧，视同限流继续轮询其他令牌
+                                response_status_code = 429
+                                self.token_manager.record_rate_limited(token, model)
+                                metrics.incr("upstream_error_frames")
+                                logger.warning(f"令牌首帧返回错误，继续轮询其他令牌: {token[:20]}...", "Server")
+                                continue
+                            self.token_manager.record_success(token, model)
+                            return Response(
+                                stream_with_context(
+                                    self.captured(capture, self.handle_passthrough_response(response, head))
+                                ),
+                                content_type='application/x-ndjson'
+                            )
+
+                        self.token_manager.record_success(token, model)
+                        # 生成的图片需要用同一令牌从上游资源站下载
+                        generated = ImageCollector(
+                            self.generated_images, {**self.default_headers, "Cookie": token},
+                            self.get_proxy_options(), self.image_base_url()
+                        )
+                        on_error = lambda token=token: self.token_manager.record_rate_limited(token, model)
                         if stream:
+                            failover = StreamFailover(
+                                self, messages, model, token, tried_tokens, images, priority,
+                                max_inflight, healthy_only, affinity_key, capture
+                            )
+                            if events:
+                                # WebSocket 等自行编码输出的调用方直接读取事件
+                                return self.captured(capture, self.stream_deltas(
+                                    response, model, messages, on_usage, generated, failover, on_response, on_error
+                                ))
+                            include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
                             return Response(
-                                stream_with_context(self.handle_stream_response(response, model)),
+                                stream_with_context(self.captured(
+                                    capture,
+                                    self.handle_stream_response(
+                                        response, model, messages, include_usage, on_usage, generated, failover, on_error
+                                    )
+                                )),
                                 content_type='text/event-stream'
                             )
+                        elif stream_body:
+                            return Response(
+                                stream_with_context(self.captured(
+                                    capture, self.stream_non_stream_response(
+                                        response, model, messages, on_usage, generated, on_error
+                                    )
+                                )),
+                                content_type='application/json'
+                            )
                         else:
-                                return self.handle_non_stream_response(response, model)
+                            result = self.handle_non_stream_response(
+                                response, model, messages, on_usage, generated, on_error=on_error
+                            )
+                            if capture is not None:
+                                capture.output(result)
+                                capture.finish()
+                            return result
                             
-                    elif response.status_code == 403:
+                    if response.status_code == 403:
                         response_status_code = 403
                         logger.error("IP暂时被封禁，请稍后重试或者更换IP", "Server")
                         raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
@@ -286,8 +718,17 @@ class RequestHandler:
                     else:
                         logger.warning(f"令牌返回异常状态码 {response.status_code}，继续轮询: {token[:20]}...", "Server")
                         
+                except (NoTokenError, QueueTimeout):
+                    raise
                 except Exception as e:
+                    if response is not None:
+                        response.close()
                     logger.error(f"请求处理异常: {str(e)}", "Server")
+                    if isinstance(e, AttachmentError):
+                        # 图片本身无效，直接返回给调用方
+                        raise
+                    if isinstance(e, UploadError):
+                        continue
                     # 检查是否是超时或网络异常，这些通常可以重试
                     if "timeout" in str(e).lower() or "connection" in str(e).lower():
                         logger.warning(f"网络异常，继续重试: {str(e)[:100]}", "Server")
@@ -297,24 +738,14 @@ class RequestHandler:
                         break
             
             if response_status_code == 403:
-                raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
-            elif response_status_code == 500:
-                raise ValueError('请求失败，请检查网络连接或稍后重试')    
+                raise RetryableError('IP暂时被封无法破盾，请稍后重试或者更换ip')
+            elif response_status_code == 429:
+                raise RetryableError('令牌配额已用完，请稍后重试')
+            else:
+                raise RetryableError('请求失败，请检查网络连接或稍后重试')
                 
         except Exception as error:
             logger.error(str(error), "ChatAPI")
+            if capture is not None:
+                capture.finish(str(error))
             raise
-            
-    def validate_request(self, request_data):
-        model = request_data.get("model")
-        if not model:
-            raise ValueError("模型参数缺失")
-            
-        if not config_manager.is_valid_model(model):
-            raise ValueError(f"不支持的模型: {model}")
-            
-        messages = request_data.get("messages")
-        if not messages or not isinstance(messages, list):
-            raise ValueError("消息参数缺失或格式错误")
-            
-        return True
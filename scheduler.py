@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import deque
+from config import config_manager
+from metrics import metrics
+
+
+# 优先级从高到低
+PRIORITY_CLASSES = ["high", "normal", "low"]
+
+
+class QueueTimeout(ValueError):
+    """排队等待上游名额超时"""
+
+
+class PriorityScheduler:
+    """上游并发名额的加权公平调度
+
+    每个优先级一个等待队列，按 stride 调度（每次放行后该级别的 pass 增加 1/权重）
+    选择 pass 最小的队列放行。保留名额只允许 high 使用。总名额为 0 时不做限制。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.waiting = {cls: deque() for cls in PRIORITY_CLASSES}
+        self.passes = {cls: 0.0 for cls in PRIORITY_CLASSES}
+        self._vtime = 0.0
+
+    @staticmethod
+    def normalize(priority):
+        return priority if priority in PRIORITY_CLASSES else "normal"
+
+    def _capacity(self):
+        return config_manager.get("SCHEDULER.MAX_CONCURRENT", 0)
+
+    def _can_start(self, cls, capacity):
+        free = capacity - self.in_use
+        if cls != "high":
+            free -= config_manager.get("SCHEDULER.RESERVED_HIGH", 0)
+        return free > 0
+
+    def _next_ticket(self, capacity):
+        candidates = [cls for cls in PRIORITY_CLASSES if self.waiting[cls] and self._can_start(cls, capacity)]
+        if not candidates:
+            return None
+        cls = min(candidates, key=lambda c: (self.passes[c], PRIORITY_CLASSES.index(c)))
+        return self.waiting[cls][0]
+
+    def acquire(self, priority="normal", timeout=None):
+        """阻塞直到拿到名额；返回是否占用了名额（未限制总名额时为 False），排队超时抛出 QueueTimeout"""
+        capacity = self._capacity()
+        if capacity <= 0:
+            return False
+
+        cls = self.normalize(priority)
+        weights = config_manager.get("SCHEDULER.WEIGHTS", {})
+        timeout = config_manager.get("SCHEDULER.QUEUE_TIMEOUT", 60) if timeout is None else timeout
+        started = time.monotonic()
+        ticket = object()
+
+        with self._cond:
+            if not self.waiting[cls]:
+                # 空闲的级别重新入队时不能积攒历史额度
+                self.passes[cls] = max(self.passes[cls], self._vtime)
+            self.waiting[cls].append(ticket)
+
+            while self._next_ticket(capacity) is not ticket:
+                remaining = started + timeout - time.monotonic()
+                if remaining <= 0:
+                    self.waiting[cls].remove(ticket)
+                    self._cond.notify_all()
+                    metrics.incr(f"scheduler_timeouts_{cls}")
+                    raise QueueTimeout('上游请求排队超时，请稍后重试')
+                self._cond.wait(remaining)
+                capacity = self._capacity()
+
+            self.waiting[cls].popleft()
+            self.in_use += 1
+            self._vtime = self.passes[cls]
+            self.passes[cls] += 1.0 / max(weights.get(cls, 1), 1)
+            self._cond.notify_all()
+
+        metrics.observe(f"scheduler_wait_ms_{cls}", (time.monotonic() - started) * 1000)
+        return True
+
+    def release(self):
+        with self._cond:
+            self.in_use = max(0, self.in_use - 1)
+            self._cond.notify_all()
+
+    def has_higher_waiters(self, priority):
+        """是否有更高优先级的请求在排队，低优先级请求据此放弃重试"""
+        rank = PRIORITY_CLASSES.index(self.normalize(priority))
+        return any(self.waiting[cls] for cls in PRIORITY_CLASSES[:rank])
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "capacity": self._capacity(),
+                "reserved_high": config_manager.get("SCHEDULER.RESERVED_HIGH", 0),
+                "in_use": self.in_use,
+                "waiting": {cls: len(queue) for cls, queue in self.waiting.items()}
+            }
@@ -0,0 +1,123 @@
+import json
+from config import config_manager
+from message_processor import MessageProcessor
+
+
+# 每个阶段都是 iterable -> iterator 的生成器函数，事件为 (类型, 数据) 二元组：
+#   error / model_response / token：classify 产出，token 的数据为上游 response 字典
+#   thinking / content：思考与正文，text/tools 阶段之后数据为字符串
+#   tag：<think> / </think> 标签字符串
+#   image：生成完成的图片在上游资源站的路径
+
+
+def decode(lines):
+    """上游 NDJSON 行 -> 帧字典，跳过空行和无法解析的行"""
+    for line in lines:
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+def classify(frames):
+    for frame in frames:
+        if frame.get("error"):
+            yield "error", frame
+            continue
+
+        response_data = frame.get("result", {}).get("response")
+        if not response_data:
+            continue
+        if response_data.get("token") or response_data.get("webSearchResults"):
+            yield "token", response_data
+
+        # 图片生成进度帧：进度到 100 时带有最终图片地址
+        generation = response_data.get("streamingImageGenerationResponse") or \
+            response_data.get("cachedImageGenerationResponse")
+        if generation and generation.get("imageUrl") and generation.get("progress", 100) >= 100:
+            yield "image", generation["imageUrl"]
+
+        model_response = response_data.get("modelResponse")
+        if model_response:
+            for image_url in model_response.get("generatedImageUrls") or []:
+                yield "image", image_url
+            yield "model_response", model_response
+
+
+def plain(events):
+    """非推理模型：所有 token 都是正文"""
+    for kind, data in events:
+        yield ("content", data) if kind == "token" else (kind, data)
+
+
+def think(events):
+    """推理模型的思考标签状态机：思考内容包在 <think></think> 中，之后只输出 final 正文"""
+    started = False
+    ended = False
+    for kind, data in events:
+        if kind != "token":
+            yield kind, data
+            continue
+
+        if data.get("isThinking"):
+            if ended:
+                continue
+            if not started:
+                started = True
+                yield "tag", "<think>"
+            # 过滤 header 内容
+            if data.get("messageTag") != "header":
+                yield "thinking", data
+        elif data.get("messageTag") == "final":
+            # 只有出现实际的最终内容时才结束思考
+            if started and not ended and data.get("token"):
+                ended = True
+                yield "tag", "</think>"
+            yield "content", data
+
+    if started and not ended:
+        yield "tag", "</think>"
+
+
+def tools(events):
+    """处理工具响应内容（web 搜索结果、tool_usage_card 等），只输出非空文本"""
+    for kind, data in events:
+        if kind in ("thinking", "content"):
+            data = MessageProcessor.process_tool_response(data)
+            if not data:
+                continue
+        yield kind, data
+
+
+def text(events):
+    for kind, data in events:
+        if kind in ("thinking", "content"):
+            data = data.get("token")
+            if not data:
+                continue
+        yield kind, data
+
+
+STAGES = {
+    "decode": decode,
+    "classify": classify,
+    "plain": plain,
+    "think": think,
+    "tools": tools,
+    "text": text
+}
+
+
+def build_pipeline(model):
+    """按模型注册表选出阶段，返回 lines -> 事件流 的处理函数；每个请求只选择一次"""
+    stages = [STAGES[name] for name in ["decode", "classify"] + config_manager.get_model_profile(model)["pipeline"]]
+
+    def run(lines):
+        events = lines
+        for stage in stages:
+            events = stage(events)
+        return events
+
+    return run
@@ -1,5 +1,31 @@
 import os
+import json
+import time
+import hashlib
+import threading
+from collections import deque
 from logger import logger
+from config import config_manager
+from rate_limiter import RateEstimator, model_window
+
+
+# 亲和路由的固定分桶数：先在桶间、再在桶内做 rendezvous 哈希，单次选择约 O(桶数 + 桶大小)
+AFFINITY_BUCKETS = 256
+_MASK64 = (1 << 64) - 1
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _mix64(x):
+    # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+_BUCKET_SEEDS = [_mix64(i + 1) for i in range(AFFINITY_BUCKETS)]
 
 
 class AuthTokenManager:
@@ -7,114 +33,178 @@ class AuthTokenManager:
         self.tokens = []
         self.current_index = 0
         self.last_round_index = -1
-        
+        # token -> 状态记录（sso 只在加入时解析一次），sso -> token 反向索引
+        self.token_info = {}
+        self.sso_index = {}
+        # token -> 进行中的上游请求数
+        self.inflight = {}
+        # 亲和路由分桶，令牌按哈希种子固定落入某个桶
+        self.buckets = [[] for _ in range(AFFINITY_BUCKETS)]
+        # token -> {model -> RateEstimator}，由 429 反馈学习每个令牌的真实配额
+        self.rates = {}
+        # 每次增删令牌或更新状态时递增，状态落盘线程据此判断是否需要写文件
+        self.version = 0
+        # 最近的令牌变更 (version, token, sso)，管理页面据此只获取增量；
+        # epoch 区分进程，早于 _changes_floor 的版本无法从日志还原，需要重新获取快照
+        self.changes = deque(maxlen=config_manager.get("TOKENS.CHANGE_LOG_SIZE", 10000))
+        self.epoch = format(int(time.time() * 1000), "x")
+        self._changes_floor = 0
+        # 可选的多节点协调器（cluster.ClusterCoordinator），为 None 时只使用本地状态
+        self.cluster = None
+        self._saved_version = 0
+        self._saver = None
+        self._lock = threading.RLock()
+        self._slot_released = threading.Condition(self._lock)
+
+    @staticmethod
+    def extract_sso(token_str):
+        if "sso=" in token_str:
+            return token_str.split("sso=")[1].split(";")[0]
+        return None
+
+    @staticmethod
+    def normalize_token(value):
+        # 如果输入的是完整的cookie字符串，直接使用；否则构造完整的cookie字符串
+        if 'sso=' in value and 'sso-rw=' in value:
+            return value
+        return f"sso-rw={value};sso={value}"
+
+    def _register(self, token_str):
+        sso = self.extract_sso(token_str)
+        seed = _hash64(token_str)
+        self.token_info[token_str] = {
+            "sso": sso,
+            "isValid": True,
+            "checked": False,
+            "lastChecked": None,
+            "error": None,
+            "seed": seed
+        }
+        if sso:
+            self.sso_index[sso] = token_str
+        self.buckets[seed % AFFINITY_BUCKETS].append(token_str)
+        self.version += 1
+        self._log_change(token_str, sso)
+
+    def _unregister(self, token_str):
+        info = self.token_info.pop(token_str, None)
+        if info and info["sso"] and self.sso_index.get(info["sso"]) == token_str:
+            del self.sso_index[info["sso"]]
+        if info:
+            self.buckets[info["seed"] % AFFINITY_BUCKETS].remove(token_str)
+        self.rates.pop(token_str, None)
+        self.version += 1
+        self._log_change(token_str, info["sso"] if info else None)
+
+    def _log_change(self, token_str, sso):
+        if len(self.changes) == self.changes.maxlen:
+            self._changes_floor = self.changes[0][0]
+        self.changes.append((self.version, token_str, sso))
+
     def add_token(self, token_str):
         if isinstance(token_str, dict):
             token_str = token_str.get("token", "")
-        
-        if token_str and token_str not in self.tokens:
-            self.tokens.append(token_str)
-            self.current_index = 0
-            self.last_round_index = -1
-            logger.info(f"令牌添加成功: {token_str[:20]}...", "TokenManager")
-            return True
+
+        with self._lock:
+            if token_str and token_str not in self.token_info:
+                self.tokens.append(token_str)
+                self._register(token_str)
+                self.current_index = 0
+                self.last_round_index = -1
+                logger.info(f"令牌添加成功: {token_str[:20]}...", "TokenManager")
+                return True
         return False
-    
+
     def add_tokens_batch(self, token_strs):
         """批量添加tokens，优化性能"""
         if not token_strs:
             return {"success": 0, "failed": 0, "duplicates": 0}
-        
+
         # 转换为列表如果是其他类型
         if isinstance(token_strs, str):
             token_strs = [token_strs]
-        
-        # 使用set进行快速去重检查
-        existing_tokens_set = set(self.tokens)
+
         new_tokens = []
+        pending = set()
         duplicates = 0
         failed = 0
-        
-        for token_str in token_strs:
-            if isinstance(token_str, dict):
-                token_str = token_str.get("token", "")
-            
-            if not token_str:
-                failed += 1
-                continue
-                
-            # 如果输入的是完整的cookie字符串，直接使用
-            if 'sso=' in token_str and 'sso-rw=' in token_str:
-                formatted_token = token_str
-            else:
-                # 如果只是cookie值，构造完整的cookie字符串
-                formatted_token = f"sso-rw={token_str};sso={token_str}"
-            
-            if formatted_token in existing_tokens_set:
-                duplicates += 1
-            else:
-                new_tokens.append(formatted_token)
-                existing_tokens_set.add(formatted_token)
-        
-        # 批量添加新tokens
-        if new_tokens:
-            self.tokens.extend(new_tokens)
-            # 只在最后重置索引一次
-            self.current_index = 0
-            self.last_round_index = -1
-            logger.info(f"批量添加令牌完成: 成功 {len(new_tokens)} 个，重复 {duplicates} 个，失败 {failed} 个", "TokenManager")
-        
+
+        with self._lock:
+            for token_str in token_strs:
+                if isinstance(token_str, dict):
+                    token_str = token_str.get("token", "")
+
+                if not token_str or not isinstance(token_str, str):
+                    failed += 1
+                    continue
+
+                formatted_token = self.normalize_token(token_str)
+
+                # token_info 本身即为去重索引
+                if formatted_token in self.token_info or formatted_token in pending:
+                    duplicates += 1
+                else:
+                    new_tokens.append(formatted_token)
+                    pending.add(formatted_token)
+
+            # 批量添加新tokens
+            if new_tokens:
+                self.tokens.extend(new_tokens)
+                for formatted_token in new_tokens:
+                    self._register(formatted_token)
+                # 只在最后重置索引一次
+                self.current_index = 0
+                self.last_round_index = -1
+                logger.info(f"批量添加令牌完成: 成功 {len(new_tokens)} 个，重复 {duplicates} 个，失败 {failed} 个", "TokenManager")
+
         return {
-            "success": len(new_tokens), 
-            "failed": failed, 
+            "success": len(new_tokens),
+            "failed": failed,
             "duplicates": duplicates
         }
-        
+
     def set_token(self, token_str):
         if isinstance(token_str, dict):
             token_str = token_str.get("token", "")
-            
-        self.tokens = [token_str]
-        self.current_index = 0
-        self.last_round_index = -1
+
+        with self._lock:
+            self.tokens = [token_str]
+            self.token_info = {}
+            self.sso_index = {}
+            self.buckets = [[] for _ in range(AFFINITY_BUCKETS)]
+            self.rates = {}
+            self._register(token_str)
+            # 整体替换后旧版本的增量没有意义
+            self.changes.clear()
+            self._changes_floor = self.version
+            self.current_index = 0
+            self.last_round_index = -1
         logger.info(f"设置单个令牌: {token_str[:20]}...", "TokenManager")
 
     def delete_token(self, token):
         try:
             if isinstance(token, dict):
                 token = token.get("token", "")
-            
-            # 首先尝试直接匹配
-            if token in self.tokens:
-                self.tokens.remove(token)
-                # 重置轮询状态以避免索引越界
-                self.current_index = 0
-                self.last_round_index = -1
-                logger.info(f"令牌已成功移除: {token[:20]}...", "TokenManager")
-                return True
-            
-            # 如果直接匹配失败，尝试通过SSO值匹配完整token
-            for stored_token in self.tokens[:]:  # 创建副本以避免在迭代时修改列表
-                if "sso=" in stored_token:
-                    sso_value = stored_token.split("sso=")[1].split(";")[0]
-                    if sso_value == token:
-                        self.tokens.remove(stored_token)
-                        # 重置轮询状态以避免索引越界
-                        self.current_index = 0
-                        self.last_round_index = -1
-                        logger.info(f"令牌已成功移除: {stored_token[:20]}...", "TokenManager")
-                        return True
-            
+
+            with self._lock:
+                # 先按完整token匹配，再通过SSO值匹配完整token
+                stored_token = token if token in self.token_info else self.sso_index.get(token)
+                if stored_token:
+                    self.tokens.remove(stored_token)
+                    self._unregister(stored_token)
+                    # 重置轮询状态以避免索引越界
+                    self.current_index = 0
+                    self.last_round_index = -1
+                    logger.info(f"令牌已成功移除: {stored_token[:20]}...", "TokenManager")
+                    return True
+
             logger.warning(f"未找到要删除的令牌: {token[:20]}...", "TokenManager")
             return False
         except Exception as error:
             logger.error(f"令牌删除失败: {str(error)}", "TokenManager")
             return False
-    
-    def get_next_token_for_model(self, model_id):
-        if not self.tokens:
-            return None
-            
+
+    def _rotate(self):
         # 检查是否开始新的一轮轮询
         if self.current_index == 0 and self.last_round_index != -1:
             # 开始新一轮轮询，重置索引
@@ -123,42 +213,395 @@ class AuthTokenManager:
             # 记录上一轮的最后索引
             if self.current_index == len(self.tokens) - 1:
                 self.last_round_index = self.current_index
-        
+
         # 按序号依次轮询
         token = self.tokens[self.current_index]
-        
+
         # 移动到下一个索引
         self.current_index = (self.current_index + 1) % len(self.tokens)
-        
+
         return token
 
+    def _is_available(self, token, model_id, now, max_inflight, healthy_only, view=None):
+        if view is not None:
+            cooling, remote_inflight = view
+            token_id = self.token_id(token)
+            if token_id in cooling:
+                return False
+            if max_inflight is not None and remote_inflight.get(token_id, 0) >= max_inflight:
+                return False
+        if max_inflight is not None and self.inflight.get(token, 0) >= max_inflight:
+            return False
+        if healthy_only:
+            info = self.token_info.get(token)
+            if info is not None and info["checked"] and not info["isValid"]:
+                return False
+        estimator = self.rates.get(token, {}).get(model_id)
+        if estimator is not None and not estimator.admit(now):
+            return False
+        return True
+
+    def token_id(self, token):
+        """令牌在集群存储中的标识，不暴露 cookie 本身"""
+        return f"{self.token_info[token]['seed']:016x}"
+
+    def _estimator(self, token, model_id):
+        models = self.rates.setdefault(token, {})
+        estimator = models.get(model_id)
+        if estimator is None:
+            estimator = models[model_id] = RateEstimator(model_window(model_id))
+        return estimator
+
+    def record_success(self, token, model_id):
+        if not config_manager.get("RATE_LIMIT.ENABLED", True):
+            return
+        with self._lock:
+            if token in self.token_info:
+                self._estimator(token, model_id).on_success(time.monotonic())
+
+    def record_rate_limited(self, token, model_id, retry_after=None):
+        """令牌返回 429：下调该模型的估计配额，并让令牌冷却到预测的恢复时间"""
+        if not config_manager.get("RATE_LIMIT.ENABLED", True):
+            return
+        with self._lock:
+            if token in self.token_info:
+                estimator = self._estimator(token, model_id)
+                now = time.monotonic()
+                estimator.on_rate_limited(now, retry_after)
+                if self.cluster is not None:
+                    # 让其他节点在同一冷却期内也跳过该令牌
+                    self.cluster.report_cooldown(
+                        self.token_id(token), model_id, time.time() + estimator.next_available(now) - now
+                    )
+                logger.info(
+                    f"令牌配额估计更新: {token[:20]}... {model_id} limit={estimator.limit}", "TokenManager"
+                )
+
+    def next_recovery(self, model_id):
+        """所有令牌都被限流时，距最早恢复的秒数；有可用令牌时返回 0"""
+        now = time.monotonic()
+        with self._lock:
+            earliest = None
+            for token in self.tokens:
+                estimator = self.rates.get(token, {}).get(model_id)
+                if estimator is None:
+                    return 0
+                available = estimator.next_available(now)
+                if earliest is None or available < earliest:
+                    earliest = available
+            return max(0, earliest - now) if earliest is not None else 0
+
+    def _next_wakeup(self, model_id):
+        now = time.monotonic()
+        pending = [
+            models[model_id].next_available(now) - now
+            for models in self.rates.values() if model_id in models
+        ]
+        pending = [delay for delay in pending if delay > 0]
+        return min(pending) if pending else None
+
+    def get_rate_limits(self):
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for token, models in self.rates.items():
+                info = self.token_info[token]
+                result[info["sso"] or token[:20]] = {
+                    model_id: estimator.snapshot(now) for model_id, estimator in models.items()
+                }
+            return result
+
+    def iter_affinity(self, affinity_key):
+        """按 rendezvous 哈希得分从高到低产出令牌，增删令牌只影响落在该令牌上的键"""
+        key = _hash64(affinity_key)
+        buckets = sorted(
+            (b for b in range(AFFINITY_BUCKETS) if self.buckets[b]),
+            key=lambda b: _mix64(key ^ _BUCKET_SEEDS[b]),
+            reverse=True
+        )
+        for b in buckets:
+            yield from sorted(
+                self.buckets[b],
+                key=lambda t: _mix64(key ^ self.token_info[t]["seed"]),
+                reverse=True
+            )
+
+    def _pick(self, model_id, max_inflight, healthy_only, affinity_key, exclude, view=None, untried_only=False):
+        now = time.monotonic()
+        # 优先选择本次请求未尝试过的令牌，都尝试过时再退回已尝试的（untried_only 时不退回）
+        fallback = None
+        if affinity_key is None:
+            for _ in range(len(self.tokens)):
+                token = self._rotate()
+                if not self._is_available(token, model_id, now, max_inflight, healthy_only, view):
+                    continue
+                if not exclude or token not in exclude:
+                    return token
+                if fallback is None and not untried_only:
+                    fallback = token
+            return fallback
+
+        # 亲和路由按得分从高到低
+        for token in self.iter_affinity(affinity_key):
+            if not self._is_available(token, model_id, now, max_inflight, healthy_only, view):
+                continue
+            if not exclude or token not in exclude:
+                return token
+            if fallback is None and not untried_only:
+                fallback = token
+        return fallback
+
+    def get_next_token_for_model(self, model_id, max_inflight=None, healthy_only=False, timeout=0,
+                                 affinity_key=None, exclude=None, untried_only=False):
+        """取下一个令牌并计入进行中请求数
+
+        默认按轮询顺序；指定 affinity_key 时按一致性哈希选择首选令牌，exclude 中的令牌
+        （同一请求已尝试过的）只在没有其他可用令牌时才会被选中，untried_only 时不会被选中。
+        max_inflight 限制单个令牌的并发数，healthy_only 跳过已校验为无效的令牌，
+        已达到该模型估计配额或处于冷却期的令牌也会跳过；所有令牌都不可用时最多等待 timeout 秒。
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            # 集群视图（其他节点上报的冷却与租约）在锁外读取，最多一次存储往返
+            view = self._cluster_view(model_id, max_inflight)
+            with self._lock:
+                if not self.tokens:
+                    return None
+
+                token = self._pick(model_id, max_inflight, healthy_only, affinity_key, exclude, view, untried_only)
+                if token is not None:
+                    self.inflight[token] = self.inflight.get(token, 0) + 1
+                    estimator = self.rates.get(token, {}).get(model_id)
+                    if estimator is not None:
+                        estimator.on_acquired(time.monotonic())
+                    if self.cluster is not None:
+                        self.cluster.acquire_lease(self.token_id(token))
+                    return token
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # 冷却中的令牌恢复时不会有通知，按最早的预测恢复时间醒来重新检查
+                wakeup = self._next_wakeup(model_id)
+                if view is not None:
+                    wakeup = min(wakeup or 1.0, 1.0)
+                self._slot_released.wait(remaining if wakeup is None else min(remaining, wakeup))
+
+    def _cluster_view(self, model_id, max_inflight):
+        if self.cluster is None:
+            return None
+        return self.cluster.view(model_id, max_inflight is not None)
+
+    def release_token(self, token):
+        """上游请求结束后归还令牌的并发名额"""
+        if self.cluster is not None and token in self.token_info:
+            self.cluster.release_lease(self.token_id(token))
+        with self._lock:
+            count = self.inflight.get(token, 0) - 1
+            if count > 0:
+                self.inflight[token] = count
+            else:
+                self.inflight.pop(token, None)
+            self._slot_released.notify_all()
 
     def get_all_tokens(self):
         return self.tokens.copy()
-        
+
+    def set_token_status(self, token_str, is_valid, error=None, checked_at=None):
+        with self._lock:
+            info = self.token_info.get(token_str)
+            if info is None:
+                return False
+            info["isValid"] = is_valid
+            info["checked"] = True
+            info["lastChecked"] = checked_at
+            info["error"] = error
+            self.version += 1
+            self._log_change(token_str, info["sso"])
+            return True
+
+    def _status_entry(self, token_str, index):
+        info = self.token_info[token_str]
+        return {
+            "sso": info["sso"] or f"token_{index}",
+            "isValid": info["isValid"],
+            "checked": info["checked"],
+            "lastChecked": info["lastChecked"],
+            "error": info["error"],
+            "index": index
+        }
+
+    def changes_since(self, since, limit=0):
+        """返回 (当前版本, 自 since 以来的变更)，同一令牌只保留最新状态
+
+        变更为 {"op": "upsert", 状态字段...} 或 {"op": "delete", "sso": ...}；since 不在变更日志覆盖范围内，
+        或变更数超过 limit 时返回 None，调用方应重新获取分页快照。
+        """
+        with self._lock:
+            version = self.version
+            if since > version or since < self._changes_floor:
+                return version, None
+            latest = {}
+            for entry_version, token_str, sso in reversed(self.changes):
+                if entry_version <= since:
+                    break
+                latest.setdefault(token_str, sso)
+                if limit and len(latest) > limit:
+                    return version, None
+            items = []
+            for token_str, sso in latest.items():
+                if token_str in self.token_info:
+                    entry = self._status_entry(token_str, None)
+                    del entry["index"]
+                    items.append({"op": "upsert", **entry})
+                elif sso:
+                    items.append({"op": "delete", "sso": sso})
+        return version, items
+
+    def health_summary(self):
+        """令牌总数、各校验状态的数量、冷却中的令牌数和进行中的上游请求数"""
+        now = time.monotonic()
+        with self._lock:
+            valid = invalid = 0
+            for info in self.token_info.values():
+                if info["checked"]:
+                    if info["isValid"]:
+                        valid += 1
+                    else:
+                        invalid += 1
+            cooling = sum(
+                1 for models in self.rates.values()
+                if any(estimator.cooling_until > now for estimator in models.values())
+            )
+            return {
+                "tokens": len(self.tokens),
+                "valid": valid,
+                "invalid": invalid,
+                "unchecked": len(self.tokens) - valid - invalid,
+                "cooling": cooling,
+                "inflight": sum(self.inflight.values())
+            }
+
+    def _matches(self, info, status, query):
+        if status == "valid" and not (info["checked"] and info["isValid"]):
+            return False
+        if status == "invalid" and not (info["checked"] and not info["isValid"]):
+            return False
+        if status == "unchecked" and info["checked"]:
+            return False
+        if query and query not in (info["sso"] or ""):
+            return False
+        return True
+
+    def list_tokens(self, offset=0, limit=100, status=None, query=None):
+        """分页列出令牌状态；无过滤条件时只访问当前页"""
+        tokens = self.tokens
+        # 快照对应的版本，之后通过 changes_since 只获取增量
+        version = self.version
+        if not status and not query:
+            page = [self._status_entry(t, offset + i) for i, t in enumerate(tokens[offset:offset + limit])]
+            return {"total": len(tokens), "offset": offset, "limit": limit, "version": version, "items": page}
+
+        items = []
+        total = 0
+        for i, token_str in enumerate(tokens):
+            info = self.token_info.get(token_str)
+            if info is None or not self._matches(info, status, query):
+                continue
+            if offset <= total < offset + limit:
+                items.append(self._status_entry(token_str, i))
+            total += 1
+        return {"total": total, "offset": offset, "limit": limit, "version": version, "items": items}
+
+    def iter_token_status(self, status=None, query=None):
+        """遍历令牌快照，用于流式导出"""
+        for i, token_str in enumerate(self.get_all_tokens()):
+            info = self.token_info.get(token_str)
+            if info is not None and self._matches(info, status, query):
+                yield token_str, self._status_entry(token_str, i)
+
     def get_token_status_map(self):
         status_map = {}
-        for i, token in enumerate(self.tokens):
-            if "sso=" in token:
-                sso = token.split("sso=")[1].split(";")[0]
-            else:
-                sso = f"token_{i}"
-                
+        for i, token in enumerate(self.get_all_tokens()):
+            info = self.token_info.get(token)
+            sso = info["sso"] if info and info["sso"] else f"token_{i}"
+
             status_map[sso] = {
-                "isValid": True,
+                "isValid": info["isValid"] if info else True,
                 "index": i
             }
         return status_map
-    
+
     def load_from_env(self):
-        sso_array = os.environ.get("TOK_E", "").split(',')
-        if sso_array and sso_array[0]:
-            for value in sso_array:
-                if value.strip():
-                    token_str = f"sso-rw={value.strip()};sso={value.strip()}"
-                    self.add_token(token_str)
-        
-        logger.info(f"令牌加载完成，共加载: {len(self.get_all_tokens())}个令牌", "TokenManager")
-    
+        # 启动时走批量路径，集合去重且只输出一条汇总日志
+        sso_array = [value.strip() for value in os.environ.get("TOK_E", "").split(',') if value.strip()]
+        if sso_array:
+            self.add_tokens_batch(sso_array)
+
+        logger.info(f"令牌加载完成，共加载: {len(self.tokens)}个令牌", "TokenManager")
+
+    def save_state(self, path=None):
+        """把令牌及校验状态写入状态文件（先写临时文件再替换），无变化时跳过"""
+        path = path or config_manager.get("TOKENS.STATE_FILE")
+        if not path:
+            return False
+        with self._lock:
+            version = self.version
+            if version == self._saved_version and os.path.exists(path):
+                return False
+            items = [
+                {
+                    "token": token,
+                    "isValid": self.token_info[token]["isValid"],
+                    "checked": self.token_info[token]["checked"],
+                    "lastChecked": self.token_info[token]["lastChecked"],
+                    "error": self.token_info[token]["error"]
+                }
+                for token in self.tokens
+            ]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"tokens": items}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._saved_version = version
+        return True
+
+    def load_state(self, path=None):
+        path = path or config_manager.get("TOKENS.STATE_FILE")
+        if not path or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                items = json.load(f).get("tokens", [])
+        except Exception as error:
+            logger.error(f"读取令牌状态文件失败: {str(error)}", "TokenManager")
+            return 0
+
+        self.add_tokens_batch([item["token"] for item in items])
+        for item in items:
+            if item.get("checked"):
+                self.set_token_status(item["token"], item.get("isValid", True), item.get("error"), item.get("lastChecked"))
+        with self._lock:
+            self._saved_version = self.version
+        logger.info(f"已从状态文件恢复 {len(items)} 个令牌", "TokenManager")
+        return len(items)
+
+    def start_state_saver(self):
+        """按固定间隔把有变化的令牌状态落盘，新进程启动时可据此恢复运行期的增删"""
+        if self._saver is not None or not config_manager.get("TOKENS.STATE_FILE"):
+            return
+
+        def run():
+            while True:
+                time.sleep(config_manager.get("TOKENS.STATE_INTERVAL", 5))
+                try:
+                    self.save_state()
+                except Exception as error:
+                    logger.error(f"令牌状态落盘失败: {str(error)}", "TokenManager")
+
+        self._saver = threading.Thread(target=run, name="token-state-saver", daemon=True)
+        self._saver.start()
+
     def is_empty(self):
         return len(self.tokens) == 0
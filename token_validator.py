@@ -0,0 +1,135 @@
+import threading
+import time
+import uuid
+from logger import logger
+from config import config_manager
+
+
+class TokenValidationJob:
+    """后台令牌健康检查任务，使用固定数量的工作线程并发探测"""
+
+    def __init__(self, request_handler, tokens, concurrency, model="grok-3", remove_invalid=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.request_handler = request_handler
+        self.token_manager = request_handler.token_manager
+        self.tokens = tokens
+        self.concurrency = max(1, min(concurrency, len(tokens) or 1))
+        self.model = model
+        self.remove_invalid = remove_invalid
+
+        self.state = "pending"
+        self.created = time.time()
+        self.finished = None
+        self.done = 0
+        self.valid = 0
+        self.invalid = 0
+        self.results = []
+        self._next = 0
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def start(self):
+        self.state = "running"
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"validate-{self.id}-{i}", daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for worker in self._workers:
+            worker.start()
+        threading.Thread(target=self._wait, name=f"validate-{self.id}", daemon=True).start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _take(self):
+        with self._lock:
+            if self._cancelled.is_set() or self._next >= len(self.tokens):
+                return None
+            token = self.tokens[self._next]
+            self._next += 1
+            return token
+
+    def _worker(self):
+        while True:
+            token = self._take()
+            if token is None:
+                return
+
+            try:
+                result = self.request_handler.probe_token(token, self.model)
+            except Exception as error:
+                result = {"success": False, "status_code": None, "error": str(error), "latency_ms": None}
+
+            checked_at = int(time.time())
+            self.token_manager.set_token_status(token, result["success"], result["error"], checked_at)
+            # 只有上游明确拒绝认证时才删除；网络异常、限流或 IP 被封（403）不能说明令牌失效
+            if not result["success"] and self.remove_invalid and result["status_code"] == 401:
+                self.token_manager.delete_token(token)
+
+            with self._lock:
+                self.done += 1
+                if result["success"]:
+                    self.valid += 1
+                else:
+                    self.invalid += 1
+                self.results.append({
+                    "sso": self.token_manager.extract_sso(token) or token[:20],
+                    **result,
+                    "checkedAt": checked_at
+                })
+
+    def _wait(self):
+        for worker in self._workers:
+            worker.join()
+        self.finished = time.time()
+        self.state = "cancelled" if self._cancelled.is_set() else "finished"
+        logger.info(f"令牌校验任务 {self.id} 结束: 有效 {self.valid} 个，无效 {self.invalid} 个", "TokenValidator")
+
+    def snapshot(self, since=0, limit=1000):
+        """返回进度以及从 since 开始的增量结果"""
+        with self._lock:
+            results = self.results[since:since + limit]
+            return {
+                "id": self.id,
+                "state": self.state,
+                "total": len(self.tokens),
+                "done": self.done,
+                "valid": self.valid,
+                "invalid": self.invalid,
+                "concurrency": self.concurrency,
+                "created": int(self.created),
+                "finished": int(self.finished) if self.finished else None,
+                "results": results,
+                "next": since + len(results)
+            }
+
+
+class TokenValidator:
+    def __init__(self, request_handler):
+        self.request_handler = request_handler
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def start_job(self, tokens=None, concurrency=None, model="grok-3", remove_invalid=False):
+        if tokens is None:
+            tokens = self.request_handler.token_manager.get_all_tokens()
+        concurrency = concurrency or config_manager.get("VALIDATION.CONCURRENCY", 32)
+        concurrency = min(concurrency, config_manager.get("VALIDATION.MAX_CONCURRENCY", 256))
+
+        job = TokenValidationJob(self.request_handler, tokens, concurrency, model, remove_invalid)
+        with self._lock:
+            self._prune()
+            self.jobs[job.id] = job
+        job.start()
+        logger.info(f"令牌校验任务 {job.id} 已启动: {len(tokens)} 个令牌，并发 {job.concurrency}", "TokenValidator")
+        return job
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _prune(self):
+        # 只保留最近的若干个已结束任务
+        keep = config_manager.get("VALIDATION.KEEP_JOBS", 10)
+        finished = sorted((j for j in self.jobs.values() if j.finished), key=lambda j: j.finished)
+        for job in finished[:max(0, len(finished) - keep + 1)]:
+            del self.jobs[job.id]
@@ -0,0 +1,110 @@
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from config import config_manager
+
+
+# 本地近似分词，不依赖网络和词表文件，与 cl100k 类 BPE 的计数误差通常在 10% 以内：
+# CJK 字符按单字计；字母串按长度估算（短词 1 个 token，长词约每 4 个字符 1 个）；
+# 数字按每 3 位 1 个；标点逐个计；单个空格并入下一个词，连续空白或换行计 1 个。
+_CJK = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_PIECE = re.compile(
+    rf"[{_CJK}]|(?:(?![{_CJK}])[^\W\d_])+|\d{{1,3}}| ?\n\s*|\s{{2,}}| |[^\s\w]|_",
+    re.UNICODE
+)
+
+# OpenAI 计费口径：每条消息固定开销，以及回复的起始开销
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+IMAGE_TOKENS = 85
+
+
+def _piece_tokens(piece):
+    if piece == " ":
+        return 0
+    length = len(piece)
+    if length <= 6 or not piece[0].isalpha():
+        return 1
+    return (length + 3) // 4
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    return sum(_piece_tokens(piece) for piece in _PIECE.findall(text))
+
+
+# (角色, 内容摘要, 图片数) -> token 数；键只保存摘要，缓存不会让长消息正文常驻内存
+_message_counts = OrderedDict()
+_message_counts_lock = threading.Lock()
+
+
+def _count_message(role, text, images):
+    key = (role, hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest(), images)
+    with _message_counts_lock:
+        count = _message_counts.get(key)
+        if count is not None:
+            _message_counts.move_to_end(key)
+            return count
+    count = MESSAGE_OVERHEAD + count_tokens(role) + count_tokens(text) + images * IMAGE_TOKENS
+    with _message_counts_lock:
+        _message_counts[key] = count
+        while len(_message_counts) > config_manager.get("USAGE.CACHE_SIZE", 20000):
+            _message_counts.popitem(last=False)
+    return count
+
+
+def count_message(message):
+    """单条消息的 token 数；按 (角色, 内容) 缓存，多轮对话中重复的历史消息不会重复分词"""
+    content = message.get("content", "")
+    images = 0
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                images += 1
+        content = "\n".join(texts)
+    elif not isinstance(content, str):
+        content = str(content)
+    return _count_message(message.get("role", ""), content, images)
+
+
+def count_messages(messages):
+    return sum(count_message(message) for message in messages or []) + REPLY_OVERHEAD
+
+
+class StreamCounter:
+    """对流式增量文本逐块计数；末尾可能被截断的片段留到下一块再计"""
+
+    def __init__(self):
+        self.tokens = 0
+        self._tail = ""
+
+    def feed(self, text):
+        if not text:
+            return
+        text = self._tail + text
+        last = None
+        for match in _PIECE.finditer(text):
+            if last is not None:
+                self.tokens += _piece_tokens(last)
+            last = match.group()
+        if last and len(last) > 64:
+            # 超长且不断增长的片段（如无分隔的长串）直接计入，避免每块都重新扫描
+            self.tokens += _piece_tokens(last)
+            last = ""
+        self._tail = last or ""
+
+    def total(self):
+        return self.tokens + _piece_tokens(self._tail) if self._tail else self.tokens
+
+
+def make_usage(prompt_tokens, completion_tokens):
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
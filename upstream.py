@@ -0,0 +1,389 @@
+import asyncio
+import queue
+import threading
+import time
+from logger import logger
+from config import config_manager
+from metrics import metrics
+
+
+_STREAM_END = object()
+
+# curl_easy_pause 参数
+CURLPAUSE_RECV = 1
+CURLPAUSE_CONT = 0
+
+# CURLINFO_HTTP_VERSION 的取值
+HTTP_VERSION_NAMES = {1: "1.0", 2: "1.1", 3: "2", 30: "3"}
+
+
+class StreamDropped(ValueError):
+    """客户端读取过慢，缓冲区按 drop 策略断开了该流；换令牌续写也无济于事"""
+
+
+class StreamBuffer:
+    """单个上游流的缓冲区：后台事件循环写入，Flask 工作线程读取
+
+    客户端读得慢时工作线程阻塞在写出上，缓冲区随之增长。超过高水位后按策略处理：
+    pause / coalesce 暂停 libcurl 接收（上游由流量控制窗口限速），读到一半高水位以下再恢复；
+    drop 丢弃缓冲并断开该流。coalesce 还会让下游把积压的增量合并成较少的事件输出。
+    """
+
+    def __init__(self, policy, high_water):
+        self.policy = policy
+        self.high_water = high_water
+        self.created = time.time()
+        self.size = 0
+        self.peak = 0
+        self.received = 0
+        self.pauses = 0
+        self.paused = False
+        self.dropped = False
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._resume = None
+
+    async def put(self, chunk, curl):
+        """事件循环线程中调用"""
+        with self._lock:
+            self.size += len(chunk)
+            self.received += len(chunk)
+            if self.size > self.peak:
+                self.peak = self.size
+            over = self.high_water and self.size > self.high_water
+        self._queue.put(chunk)
+        if not over:
+            return
+
+        if self.policy == "drop":
+            self.drop()
+            return
+        await self._wait_drain(curl)
+
+    async def _wait_drain(self, curl):
+        self._loop = asyncio.get_running_loop()
+        self._resume = asyncio.Event()
+        with self._lock:
+            if self.size <= self.high_water // 2:
+                return
+            self.paused = True
+            self.pauses += 1
+        metrics.incr("stream_backpressure_pauses")
+        # 传输已结束时句柄无法暂停，此时剩余数据已全部到达，只需等待消费
+        curl_paused = self._pause(curl, CURLPAUSE_RECV)
+        try:
+            await self._resume.wait()
+        finally:
+            self.paused = False
+            if curl_paused:
+                self._pause(curl, CURLPAUSE_CONT)
+
+    @staticmethod
+    def _pause(curl, action):
+        if curl is None:
+            return False
+        try:
+            curl.pause(action)
+            return True
+        except Exception:
+            return False
+
+    def drop(self):
+        with self._lock:
+            self.dropped = True
+            self.size = 0
+        with self._queue.mutex:
+            self._queue.queue.clear()
+        metrics.incr("stream_backpressure_drops")
+        self._queue.put(StreamDropped("客户端读取过慢，已断开该流"))
+
+    def put_nowait(self, item):
+        self._queue.put(item)
+
+    def get(self):
+        item = self._queue.get()
+        if isinstance(item, bytes):
+            with self._lock:
+                self.size = max(0, self.size - len(item))
+                wake = self.paused and self.size <= self.high_water // 2
+            if wake:
+                self._loop.call_soon_threadsafe(self._resume.set)
+        return item
+
+    def backlogged(self):
+        return bool(self.high_water) and self.size > self.high_water // 2
+
+    def snapshot(self):
+        return {
+            "policy": self.policy,
+            "buffered": self.size,
+            "peak": self.peak,
+            "received": self.received,
+            "pauses": self.pauses,
+            "paused": self.paused,
+            "dropped": self.dropped,
+            "age": round(time.time() - self.created, 1)
+        }
+
+
+class UpstreamResponse:
+    """上游流式响应的同步视图，供 Flask 工作线程逐块/逐行读取"""
+
+    def __init__(self, client, status_code, headers, buffer, task, http_version=None):
+        self.client = client
+        self.status_code = status_code
+        self.headers = headers
+        self.http_version = http_version
+        self.buffer = buffer
+        self._task = task
+        self._closed = False
+        self._callbacks = []
+        # 流量采样时包装逐块读取，记录原始帧（capture.Capture.upstream）；逐行读取和透传都经过它
+        self.tap = None
+
+    def on_close(self, callback):
+        """注册响应结束（读完或被关闭）时执行一次的回调"""
+        self._callbacks.append(callback)
+
+    def _finish(self):
+        self.client.streams.pop(id(self), None)
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as error:
+                logger.error(f"响应关闭回调执行失败: {str(error)}", "Upstream")
+
+    def iter_content(self):
+        chunks = self._iter_buffer()
+        return chunks if self.tap is None else self.tap(chunks)
+
+    def _iter_buffer(self):
+        while True:
+            item = self.buffer.get()
+            if item is _STREAM_END:
+                self._closed = True
+                self._finish()
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def iter_lines(self):
+        pending = b""
+        for chunk in self.iter_content():
+            if pending:
+                chunk = pending + chunk
+            lines = chunk.split(b"\n")
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def backlogged(self):
+        """下游消费落后（缓冲超过一半高水位）"""
+        return self.buffer.backlogged()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.client.cancel(self._task)
+        # 取消后关闭上游连接可能还要等待一段时间，先让正在读取的线程（如被取消的 WebSocket 补全）立即结束
+        self.buffer.put_nowait(_STREAM_END)
+        self._finish()
+
+
+class UpstreamClient:
+    """基于 curl_cffi AsyncSession 的共享上游客户端
+
+    所有上游请求都在一个后台事件循环线程中执行，连接由 CurlMulti 统一缓存复用，
+    因此可以在启动时预热连接池。curl_cffi 在首次使用时才导入，以缩短冷启动时间。
+    使用 HTTP/2 或 HTTP/3 时，同一出口的会话流在少量连接上多路复用，
+    每个流的流量控制窗口由 libcurl 按流维护。
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        self.warmup_status = {"state": "pending"}
+        # id -> 进行中的 UpstreamResponse，用于查看每个流的缓冲占用
+        self.streams = {}
+
+    def _ensure_loop(self):
+        if self._loop is not None:
+            return self._loop
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name="upstream-loop", daemon=True)
+                self._thread.start()
+                self._loop = loop
+        return self._loop
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def _http_version(self):
+        from curl_cffi import CurlHttpVersion
+        version = str(config_manager.get("UPSTREAM.HTTP_VERSION", "2"))
+        if version == "3" and config_manager.get("API.PROXY"):
+            # HTTP/3 无法经过 HTTP/SOCKS 代理，退回 HTTP/2
+            logger.warning("配置了代理，上游 HTTP/3 退回为 HTTP/2", "Upstream")
+            version = "2"
+        return {
+            "1.1": CurlHttpVersion.V1_1,
+            "2": CurlHttpVersion.V2TLS,
+            "3": CurlHttpVersion.V3
+        }.get(version, CurlHttpVersion.V2TLS)
+
+    def _get_session(self):
+        # 仅在事件循环线程内调用
+        if self._session is None:
+            from curl_cffi import CurlMOpt, CurlOpt, CurlHttpVersion
+            from curl_cffi.requests import AsyncSession
+            http_version = self._http_version()
+            multiplex = http_version != CurlHttpVersion.V1_1
+            session = AsyncSession(
+                max_clients=config_manager.get("UPSTREAM.MAX_CLIENTS", 256),
+                http_version=http_version,
+                # PIPEWAIT：连接建立中时新请求先等待确认能否复用，而不是各自新建连接
+                curl_options={CurlOpt.PIPEWAIT: 1} if multiplex else None
+            )
+            if multiplex:
+                # CURLPIPE_MULTIPLEX：新请求复用已有连接上的空闲流
+                session.acurl.setopt(CurlMOpt.PIPELINING, 2)
+                session.acurl.setopt(CurlMOpt.MAX_CONCURRENT_STREAMS, config_manager.get("UPSTREAM.MAX_CONCURRENT_STREAMS", 100))
+                session.acurl.setopt(CurlMOpt.MAX_HOST_CONNECTIONS, config_manager.get("UPSTREAM.MAX_HOST_CONNECTIONS", 4))
+            self._session = session
+        return self._session
+
+    def cancel(self, task):
+        if task is not None and not task.done():
+            self._loop.call_soon_threadsafe(task.cancel)
+
+    async def _pump(self, response, buffer):
+        try:
+            async for chunk in response.aiter_content():
+                await buffer.put(chunk, response.curl)
+                if buffer.dropped:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            buffer.put_nowait(error)
+        finally:
+            try:
+                await response.aclose()
+            finally:
+                buffer.put_nowait(_STREAM_END)
+
+    async def _open(self, method, url, kwargs, buffer):
+        response = await self._get_session().request(method, url, stream=True, **kwargs)
+        task = asyncio.ensure_future(self._pump(response, buffer))
+        return response, task
+
+    def request(self, method, url, **kwargs):
+        """发送请求并在收到响应头后返回，响应体在后台持续读取"""
+        buffer = StreamBuffer(
+            config_manager.get("STREAM.BACKPRESSURE", "pause"),
+            config_manager.get("STREAM.HIGH_WATER", 0)
+        )
+        response, task = self._submit(self._open(method, url, kwargs, buffer)).result()
+        upstream_response = UpstreamResponse(
+            self, response.status_code, response.headers, buffer, task,
+            HTTP_VERSION_NAMES.get(getattr(response, "http_version", None))
+        )
+        self.streams[id(upstream_response)] = upstream_response
+        return upstream_response
+
+    def stream_stats(self):
+        """进行中的上游流及其缓冲占用"""
+        items = [response.buffer.snapshot() for response in list(self.streams.values())]
+        return {
+            "active": len(items),
+            "buffered": sum(item["buffered"] for item in items),
+            "paused": sum(1 for item in items if item["paused"]),
+            "streams": sorted(items, key=lambda item: item["buffered"], reverse=True)
+        }
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    async def fetch(self, method, url, max_bytes=0, resolve=None, **kwargs):
+        """在事件循环中完整读取一个响应，返回 (状态码, 响应头, 响应体)；超过 max_bytes 时抛出 ValueError
+
+        resolve 为 "host:port:address" 时使用独立会话并通过 CURLOPT_RESOLVE 固定连接地址，
+        不复用共享连接池中可能连到其他地址的连接。
+        """
+        if resolve is None:
+            return await self._read_all(self._get_session(), method, url, max_bytes, kwargs)
+        from curl_cffi import CurlOpt
+        from curl_cffi.requests import AsyncSession
+        session = AsyncSession(curl_options={CurlOpt.RESOLVE: [resolve]})
+        try:
+            return await self._read_all(session, method, url, max_bytes, kwargs)
+        finally:
+            await session.close()
+
+    @staticmethod
+    async def _read_all(session, method, url, max_bytes, kwargs):
+        response = await session.request(method, url, stream=True, **kwargs)
+        try:
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_content():
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ValueError(f"响应体超过 {max_bytes} 字节")
+                chunks.append(chunk)
+            return response.status_code, response.headers, b"".join(chunks)
+        finally:
+            await response.aclose()
+
+    def submit(self, coro):
+        """在上游事件循环中执行协程，返回 concurrent.futures.Future"""
+        return self._submit(coro)
+
+    async def _warm_up(self, url, count, kwargs):
+        session = self._get_session()
+        results = await asyncio.gather(
+            *(session.request("HEAD", url, **kwargs) for _ in range(count)),
+            return_exceptions=True
+        )
+        return [r for r in results if isinstance(r, Exception)]
+
+    def warm_up(self, url, count, **kwargs):
+        """在后台预热上游连接池，完成后置位 ready"""
+        started = time.time()
+        self.warmup_status = {"state": "running", "connections": count}
+
+        def on_done(future):
+            try:
+                errors = future.result()
+            except Exception as error:
+                errors = [error]
+            self.warmup_status = {
+                "state": "done",
+                "connections": count,
+                "failed": len(errors),
+                "duration_ms": int((time.time() - started) * 1000)
+            }
+            if errors:
+                logger.warning(f"上游连接预热部分失败: {str(errors[0])[:100]}", "Upstream")
+            else:
+                logger.info(f"上游连接预热完成，耗时 {self.warmup_status['duration_ms']}ms", "Upstream")
+            self.ready.set()
+
+        self._submit(self._warm_up(url, count, kwargs)).add_done_callback(on_done)
+
+    def mark_ready(self):
+        self.warmup_status = {"state": "skipped"}
+        self.ready.set()
+
+    def is_ready(self):
+        return self.ready.is_set()
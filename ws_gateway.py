@@ -0,0 +1,202 @@
+import json
+import threading
+import time
+from flask import copy_current_request_context
+from logger import logger
+from config import config_manager
+from metrics import metrics
+from api_keys import api_keys
+from lifecycle import lifecycle
+from ingest import loads, parse_chat_request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode(frame):
+    """紧凑的 JSON 文本帧"""
+    if orjson is not None:
+        return orjson.dumps(frame).decode()
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+
+
+class Completion:
+    """会话中进行中的一个补全；取消时关闭当前读取的上游响应，不必等到下一个增量"""
+
+    __slots__ = ("cancelled", "response", "_lock")
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.response = None
+        self._lock = threading.Lock()
+
+    def attach(self, response):
+        with self._lock:
+            self.response = response
+        if self.cancelled.is_set():
+            response.close()
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            response = self.response
+        if response is not None:
+            response.close()
+
+
+class WebSocketSession:
+    """一条 WebSocket 连接上多路复用的补全会话
+
+    客户端帧（JSON 文本）:
+      {"type": "request", "id": "r1", "body": {...}}  开始补全，body 与 /v1/chat/completions 的请求体相同，id 在连接内唯一
+      {"type": "cancel", "id": "r1"}                  取消进行中的补全
+      {"type": "ping"}
+    服务端帧:
+      {"type": "ready", "max_concurrent": 32} / {"type": "pong"}
+      {"id": "r1", "d": "增量文本"}
+      {"id": "r1", "done": true, "usage": {...}}
+      {"id": "r1", "cancelled": true}
+      {"id": "r1", "error": {"message": "...", "type": "..."}}
+    每个补全在独立线程中运行，与 HTTP 接口共用 RequestHandler 的令牌选择、续写和用量统计，并同样计入该 API Key 的速率和并发流限制。
+    """
+
+    def __init__(self, ws, request_handler, api_key, priority, resolve_affinity_key):
+        self.ws = ws
+        self.request_handler = request_handler
+        self.api_key = api_key
+        self.priority = priority
+        self.resolve_affinity_key = resolve_affinity_key
+        self.active = {}
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def send(self, frame):
+        """发送一帧，返回发送的字节数；连接已关闭时返回 0"""
+        text = encode(frame)
+        with self._send_lock:
+            if self.closed:
+                return 0
+            try:
+                self.ws.send(text)
+            except Exception:
+                self.closed = True
+                return 0
+        return len(text)
+
+    def error(self, request_id, message, kind="invalid_request_error"):
+        frame = {"error": {"message": message, "type": kind}}
+        if request_id is not None:
+            frame = {"id": request_id, **frame}
+        self.send(frame)
+
+    def run(self):
+        metrics.incr("ws_connections")
+        self.send({"type": "ready", "max_concurrent": config_manager.get("WEBSOCKET.MAX_CONCURRENT", 32)})
+        try:
+            while not self.closed:
+                message = self.ws.receive(timeout=1)
+                if message is None:
+                    # 优雅退出时不再接受新的补全，进行中的全部结束后关闭连接
+                    if lifecycle.is_draining() and not self.active:
+                        self.ws.close(reason=1001, message="服务正在重启")
+                        break
+                    continue
+                self.dispatch(message)
+        finally:
+            self.closed = True
+            for completion in list(self.active.values()):
+                completion.cancel()
+
+    def dispatch(self, message):
+        try:
+            frame = loads(message)
+        except ValueError as error:
+            self.error(None, str(error))
+            return
+        if not isinstance(frame, dict):
+            self.error(None, "消息必须为 JSON 对象")
+            return
+
+        kind = frame.get("type")
+        request_id = frame.get("id")
+        if kind == "ping":
+            self.send({"type": "pong"})
+        elif kind == "cancel":
+            completion = self.active.get(request_id)
+            if completion is not None:
+                metrics.incr("ws_cancelled")
+                completion.cancel()
+        elif kind == "request":
+            self.start(request_id, frame.get("body"))
+        else:
+            self.error(request_id, f"不支持的消息类型: {kind}")
+
+    def start(self, request_id, body):
+        if not isinstance(request_id, str) or not request_id:
+            self.error(None, "id 缺失或格式错误")
+            return
+        if request_id in self.active:
+            self.error(request_id, "id 与进行中的请求重复")
+            return
+        if lifecycle.is_draining():
+            self.error(request_id, "服务正在重启，请稍后重试", "service_unavailable")
+            return
+        if len(self.active) >= config_manager.get("WEBSOCKET.MAX_CONCURRENT", 32):
+            self.error(request_id, "该连接上进行中的请求数量已达到上限", "rate_limit_error")
+            return
+        if not api_keys.allow_request(self.api_key):
+            self.error(request_id, "请求过于频繁，已超出该 API Key 的速率限制", "rate_limit_error")
+            return
+        try:
+            data = parse_chat_request(body)
+        except ValueError as error:
+            self.error(request_id, str(error))
+            return
+        if not api_keys.acquire_stream(self.api_key):
+            self.error(request_id, "并发流数量已达到该 API Key 的上限", "rate_limit_error")
+            return
+
+        completion = Completion()
+        self.active[request_id] = completion
+        metrics.incr("ws_requests")
+        # 工作线程沿用连接的请求上下文（Host、请求头），生成图片地址等与 HTTP 接口一致
+        worker = copy_current_request_context(self.complete)
+        threading.Thread(
+            target=worker, args=(request_id, data, self.resolve_affinity_key(data, self.api_key), completion),
+            name="ws-completion", daemon=True
+        ).start()
+
+    def complete(self, request_id, data, affinity_key, completion):
+        started = time.time()
+        sent = 0
+        events = None
+        try:
+            events = self.request_handler.make_grok_request(
+                data, data.model, True, priority=self.priority, affinity_key=affinity_key,
+                on_usage=lambda usage: api_keys.record_tokens(self.api_key, usage),
+                events=True, on_response=completion.attach
+            )
+            for kind, value in events:
+                if completion.cancelled.is_set() or self.closed:
+                    break
+                if kind == "delta":
+                    sent += self.send({"id": request_id, "d": value})
+                elif kind == "rate_limited":
+                    self.error(request_id, "RateLimitError", "rate_limit_error")
+                else:
+                    sent += self.send({"id": request_id, "done": True, "usage": value})
+            if completion.cancelled.is_set():
+                self.send({"id": request_id, "cancelled": True})
+        except ValueError as error:
+            self.error(request_id, str(error))
+        except Exception as error:
+            logger.error(f"WebSocket 补全处理异常: {str(error)}", "WebSocket")
+            self.error(request_id, str(error), "server_error")
+        finally:
+            if events is not None:
+                events.close()
+                api_keys.record(self.api_key, upstream_seconds=time.time() - started, stream_bytes=sent)
+            api_keys.release_stream(self.api_key)
+            self.active.pop(request_id, None)